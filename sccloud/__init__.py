@@ -32,6 +32,9 @@ from .tools import (
     set_group_attribute,
     correct_batch,
     neighbors,
+    query_neighbors,
+    benchmark_nearest_neighbors,
+    prune_graph,
     calc_kBET,
     calc_kSIM,
     diffmap,
@@ -50,8 +53,11 @@ from .tools import (
     net_umap,
     net_fle,
     de_analysis,
+    pairwise_de_analysis,
+    get_de_results,
     markers,
     write_results_to_excel,
+    write_markers,
     find_markers,
     infer_path,
 )
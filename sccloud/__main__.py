@@ -30,6 +30,7 @@ Sub-commands:
   MISC:
     check_indexes           Check CITE-Seq/hashing indexes to avoid index collision.
     down_sample             Down sample molecule_info to get raw_feature matrix.
+    knn_benchmark           Benchmark recall and speed of the kNN search over a grid of hnsw parameters.
 
 Options:
   -h, --help          Show help information.
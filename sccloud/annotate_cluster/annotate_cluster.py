@@ -8,6 +8,8 @@ from natsort import natsorted
 from typing import List, Dict, Union
 from anndata import AnnData
 
+from sccloud.tools import get_de_results
+
 logger = logging.getLogger("sccloud")
 
 
@@ -266,7 +268,7 @@ def infer_cell_types(
         False discovery rate for controling family-wide error.
 
     de_key : ``str``, optional, default: ``"de_res"``
-        The keyword in ``data.varm`` that stores DE analysis results.
+        The keyword in ``data.uns`` that stores DE analysis results.
 
     threshold : ``float``, optional, defaut: ``0.5``
         Only report putative cell types with a score larger than or equal to ``threshold``.
@@ -306,38 +308,25 @@ def infer_cell_types(
 
     anno = Annotator(markers, data.var_names)
 
-    clusts = natsorted(
-        [
-            x.rpartition(":")[2]
-            for x in data.varm[de_key].dtype.names
-            if x.startswith("WAD_score:")
-        ]
-    )
+    de_res = get_de_results(data, de_key)
+    clusts = natsorted(de_res.clusters)
     cell_type_results = {}
     for clust_id in clusts:
-        idx = data.varm[de_key]["{0}_qval:{1}".format(de_test, clust_id)] <= de_alpha
+        df = de_res.get_cluster(clust_id, data.var_names)
+        idx = df["{0}_qval".format(de_test)].values <= de_alpha
 
-        idx_up = idx & (data.varm[de_key]["log_fold_change:{0}".format(clust_id)] > 0.0)
-        idx_down = idx & (
-            data.varm[de_key]["log_fold_change:{0}".format(clust_id)] < 0.0
-        )
+        idx_up = idx & (df["log_fold_change"].values > 0.0)
+        idx_down = idx & (df["log_fold_change"].values < 0.0)
         assert idx_up.sum() + idx_down.sum() == idx.sum()
 
         cols = [
-            "{0}:{1}".format(x, clust_id)
-            for x in [
-                "percentage_fold_change" if de_test == "fisher" else "log_fold_change",
-                "percentage",
-            ]
+            "percentage_fold_change" if de_test == "fisher" else "log_fold_change",
+            "percentage",
         ]
-        de_up = pd.DataFrame(
-            data=data.varm[de_key][cols][idx_up], index=data.var_names[idx_up]
-        )
-        de_up.rename(columns={cols[0]: "fc", cols[1]: "percent"}, inplace=True)
-        de_down = pd.DataFrame(
-            data=data.varm[de_key][cols][idx_down], index=data.var_names[idx_down]
-        )
-        de_down.rename(columns={cols[0]: "fc", cols[1]: "percent"}, inplace=True)
+        de_up = df.loc[idx_up, cols]
+        de_up.columns = ["fc", "percent"]
+        de_down = df.loc[idx_down, cols]
+        de_down.columns = ["fc", "percent"]
 
         if de_test != "fisher":
             de_up["fc"] = np.exp(de_up["fc"])
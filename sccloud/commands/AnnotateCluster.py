@@ -20,7 +20,7 @@ Options:
   --marker-file <file>                    JSON file for markers. Could also be human_immune/mouse_immune/mouse_brain/human_brain, which triggers sccloud to markers included in the package. [default: human_immune]
   --de-test <test>                        DE test to use to infer cell types. [default: t]
   --de-alpha <alpha>                      False discovery rate to control family-wise error rate. [default: 0.05]
-  --de-key <key>                          Keyword where the DE results store in varm. [default: de_res]
+  --de-key <key>                          Keyword where the DE results store in uns. [default: de_res]
   --minimum-report-score <score>          Minimum cell type score to report a potential cell type. [default: 0.5]
   --do-not-use-non-de-genes               Do not count non DE genes as down-regulated.
 
@@ -13,17 +13,18 @@ Usage:
 
 Arguments:
   input_h5ad_file        Single cell data with clustering calculated. DE results would be written back.
-  output_spreadsheet     Output spreadsheet with DE results.
+  output_spreadsheet     Output spreadsheet with DE results. If it ends with .csv or .parquet, write a CSV or Parquet file with cluster and direction columns instead.
 
 Options:
   -p <threads>                     Use <threads> threads. [default: 1]
   --labels <attr>                  <attr> used as cluster labels. [default: louvain_labels]
-  --result-key <key>               Store DE results into AnnData varm with key = <key>. [default: de_res]
+  --result-key <key>               Store DE results into AnnData uns with key = <key>. [default: de_res]
   --auc                            Calculate area under ROC (AUROC) and area under Precision-Recall (AUPR).
   --t                              Calculate Welch's t-test.
   --fisher                         Calculate Fisher's exact test.
   --mwu                            Calculate Mann-Whitney U test.
-  --temp-folder <temp_folder>      Joblib temporary folder for memmapping numpy arrays.
+  --temp-folder <temp_folder>      Deprecated and ignored. Kept for compatibility with existing scripts.
+  --block-size <size>              Read the expression matrix <size> cells at a time instead of loading it into memory. [default: 100000]
   --alpha <alpha>                  Control false discovery rate at <alpha>. [default: 0.05]
   --ndigits <ndigits>              Round non p-values and q-values to <ndigits> after decimal point in the excel. [default: 3]
 
@@ -31,7 +32,7 @@ Options:
   -h, --help                       Print out help information.
 
 Outputs:
-  input_h5ad_file        DE results would be written back to the 'varm' field with name set by --result-key <key>.
+  input_h5ad_file        DE results would be written back to the 'uns' field with name set by --result-key <key>.
   output_spreadsheet     An excel spreadsheet containing DE results. Each cluster has two tabs in the spreadsheet. One is for up-regulated genes and the other is for down-regulated genes.
 
 Examples:
@@ -50,6 +51,7 @@ Examples:
             fisher=self.args["--fisher"],
             mwu=self.args["--mwu"],
             temp_folder=self.args["--temp-folder"],
+            block_size=int(self.args["--block-size"]),
             verbose=not self.args["--quiet"],
             alpha=float(self.args["--alpha"]),
             ndigits=int(self.args["--ndigits"]),
@@ -0,0 +1,54 @@
+from .Base import Base
+from sccloud.tools import run_knn_benchmark
+
+
+class KnnBenchmark(Base):
+    """
+Benchmark recall, speed and index size of the hnsw kNN search over a grid of parameters.
+
+Usage:
+  sccloud knn_benchmark [options] <output_csv>
+  sccloud knn_benchmark -h
+
+Arguments:
+  output_csv             Output CSV file with one row per parameter combination.
+
+Options:
+  --input <h5ad_file>              Benchmark on the <rep> representation of this h5ad file. If not set, use synthetic data.
+  --rep <rep>                      Representation used to calculate kNN. [default: pca]
+  --n-cells <number>               Number of synthetic cells. [default: 100000]
+  --n-dims <number>                Number of synthetic dimensions. [default: 50]
+  -K <number>                      Number of nearest neighbors, including the cell itself. [default: 100]
+  -M <list>                        Comma-separated list of hnsw M values, i.e. number of links per node. [default: 20]
+  --efC <list>                     Comma-separated list of hnsw efC values used at index construction. [default: 200]
+  --efS <list>                     Comma-separated list of hnsw efS values used at query time. [default: 200]
+  -p <list>                        Comma-separated list of thread counts. More than one thread builds the index at full speed, i.e. not reproducibly. [default: 1]
+  --n-queries <number>             Number of sampled query cells, whose exact neighbors are computed to measure recall. [default: 1000]
+  --check-reproducibility          Build each index twice and report the fraction of query cells with identical neighbors.
+  --random-state <seed>            Random number generator seed. [default: 0]
+  -h, --help                       Print out help information.
+
+Outputs:
+  output_csv             Columns are sccloud version, data source, n_cells, n_dims, K, M, efC, efS, n_jobs, build_time, query_time, queries_per_sec, recall, index_size_mb and, if requested, reproducibility.
+
+Examples:
+  sccloud knn_benchmark -M 10,20,40 --efS 50,100,200 -p 1,8 knn_benchmark.csv
+  sccloud knn_benchmark --input manton_bm.h5ad -p 1,8 --check-reproducibility manton_bm_knn_benchmark.csv
+    """
+
+    def execute(self):
+        run_knn_benchmark(
+            self.args["--input"],
+            self.args["<output_csv>"],
+            rep=self.args["--rep"],
+            n_cells=int(self.args["--n-cells"]),
+            n_dims=int(self.args["--n-dims"]),
+            K=int(self.args["-K"]),
+            M=[int(x) for x in self.split_string(self.args["-M"])],
+            efC=[int(x) for x in self.split_string(self.args["--efC"])],
+            efS=[int(x) for x in self.split_string(self.args["--efS"])],
+            n_jobs=[int(x) for x in self.split_string(self.args["-p"])],
+            n_queries=int(self.args["--n-queries"]),
+            check_reproducibility=self.args["--check-reproducibility"],
+            random_state=int(self.args["--random-state"]),
+        )
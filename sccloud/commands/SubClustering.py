@@ -32,8 +32,15 @@ Options:
   --temp-folder <temp_folder>                      Joblib temporary folder for memmapping numpy arrays.
 
   --nPC <number>                                   Number of principal components. [default: 50]
+  --pca-method <method>                            PCA engine. 'dense' standardizes a dense copy of the highly variable feature matrix and runs scikit-learn PCA. 'sparse' runs randomized SVD on the sparse feature matrix with implicit centering and scaling, never building the dense matrix. 'streaming' reads the matrix in blocks of --pca-block-size cells and never densifies more than one block, with the same results as 'dense'. [default: dense]
+  --pca-block-size <number>                        Number of cells densified at a time by --pca-method streaming. [default: 100000]
   --knn-K <number>                                 Number of nearest neighbors for building kNN graph. [default: 100]
   --knn-full-speed                                 For the sake of reproducibility, we only run one thread for building kNN indices. Turn on this option will allow multiple threads to be used for index building. However, it will also reduce reproducibility due to the racing between multiple threads.
+  --knn-save-index                                 Save the hnsw index next to the output h5ad file as <output_name>.pca.hnsw, so that kNN queries with a larger K or from new cells can reuse it.
+  --knn-shard-size <number>                        Build one hnsw index per shard of at most <number> cells in parallel processes and merge their neighbors, for data sets whose single kNN index does not fit in memory. Unless --knn-full-speed is set, each shard index is built single-threaded, so results do not depend on the number of threads, and data sets of 400,000 cells or more are split into shards by default. Set <number> to 0 to always build a single index.
+  --prune-graph <method>                           Prune the affinity matrix after building it, to speed up clustering, diffusion maps and force-directed layouts. <method> is one of 'mutual' (keep mutual kNN edges), 'jaccard' (keep edges whose cells share enough neighbors) and 'topk' (keep each cell's strongest edges). The fraction of kept edges is reported in the log.
+  --prune-jaccard-cutoff <cutoff>                  Minimum Jaccard index of two cells' kNN sets for keeping their edge, if --prune-graph jaccard. [default: 0.0667]
+  --prune-top-k <k>                                Number of strongest edges kept per cell, if --prune-graph topk. [default: 15]
 
   --kBET                                           Calculate kBET.
   --kBET-batch <batch>                             kBET batch keyword.
@@ -138,8 +145,15 @@ Examples:
             "random_state": int(self.args["--random-state"]),
             "temp_folder": self.args["--temp-folder"],
             "nPC": int(self.args["--nPC"]),
+            "pca_method": self.args["--pca-method"],
+            "pca_block_size": int(self.args["--pca-block-size"]),
             "K": int(self.args["--knn-K"]),
             "full_speed": self.args["--knn-full-speed"],
+            "knn_save_index": self.args["--knn-save-index"],
+            "knn_shard_size": self.convert_to_int(self.args["--knn-shard-size"]),
+            "prune_graph": self.args["--prune-graph"],
+            "prune_jaccard_cutoff": float(self.args["--prune-jaccard-cutoff"]),
+            "prune_top_k": int(self.args["--prune-top-k"]),
             "kBET": self.args["--kBET"],
             "kBET_batch": self.args["--kBET-batch"],
             "kBET_alpha": float(self.args["--kBET-alpha"]),
@@ -4,6 +4,7 @@ from typing import List
 from anndata import AnnData
 
 from sccloud.io import read_input
+from sccloud.tools import get_de_results
 
 
 def search_genes(
@@ -26,7 +27,7 @@ def search_genes(
         A list of gene symbols.
 
     rec_key: ``str``, optional, default: ``"de_res"``
-        Keyword of DE analysis result stored in ``data.varm``.
+        Keyword of DE analysis result stored in ``data.uns``.
 
     measure : ``str``, optional, default: ``"percentage"``
         Can be either ``"percentage"`` or ``"mean_logExpr"``:
@@ -43,8 +44,8 @@ def search_genes(
     >>> results = scc.search_genes(adata, ['CD3E', 'CD4', 'CD8'])
     """
 
-    columns = [x for x in data.varm[rec_key].dtype.names if x.startswith(measure + ":")]
-    df = pd.DataFrame(data=data.varm[rec_key][columns], index=data.var_names)
+    df = get_de_results(data, rec_key).get_stat(measure, data.var_names)
+    df.columns = [measure + ":" + x for x in df.columns]
     return df.reindex(index=gene_list)
 
 
@@ -74,7 +75,7 @@ def search_de_genes(
         A list of gene symbols.
 
     rec_key: ``str``, optional, default: ``"de_res"``
-        Keyword of DE analysis result stored in ``data.varm``.
+        Keyword of DE analysis result stored in ``data.uns``.
 
     de_test : ``str``, optional, default: ``"fisher"``
         Differential expression test to look at, could be either ``t``, ``fisher`` or ``mwu``.
@@ -95,27 +96,19 @@ def search_de_genes(
     >>> df = sccloud.misc.search_de_genes(adata, ['CD3E', 'CD4', 'CD8'], thre = 2.0)
     """
 
-    columns = [
-        x for x in data.varm[rec_key].dtype.names if x.startswith(de_test + "_qval:")
-    ]
-    df_de = pd.DataFrame(data.varm[rec_key][columns], index=data.var_names)
+    de_res = get_de_results(data, rec_key)
+    df_de = de_res.get_stat(de_test + "_qval", data.var_names)
     df_de = df_de.reindex(index=gene_list)
 
-    columns = [
-        x
-        for x in data.varm[rec_key].dtype.names
-        if (
-            x.startswith("percentage_fold_change:")
-            if de_test == "fisher"
-            else x.startswith("log_fold_change:")
-        )
-    ]
-    df_fc = pd.DataFrame(data.varm[rec_key][columns], index=data.var_names)
+    df_fc = de_res.get_stat(
+        "percentage_fold_change" if de_test == "fisher" else "log_fold_change",
+        data.var_names,
+    )
     df_fc = df_fc.reindex(index=gene_list)
     if de_test != "fisher":
         df_fc = np.exp(df_fc)
 
-    results = np.zeros((len(gene_list), len(columns)), dtype=np.dtype("U4"))
+    results = np.zeros((len(gene_list), len(de_res.clusters)), dtype=np.dtype("U4"))
     results[:] = "?"
     results[np.isnan(df_de)] = "NaN"
     results[(df_de <= de_alpha).values & (df_fc > 1.0).values] = "+"
@@ -123,8 +116,7 @@ def search_de_genes(
     results[(df_de <= de_alpha).values & (df_fc < 1.0).values] = "-"
     results[(df_de <= de_alpha).values & (df_fc <= 1.0 / thre).values] = "--"
 
-    clusts = [x.rpartition(":")[2] for x in columns]
-    df = pd.DataFrame(data=results, index=gene_list, columns=clusts)
+    df = pd.DataFrame(data=results, index=gene_list, columns=de_res.clusters)
     return df
 
 
@@ -68,7 +68,7 @@ def run_pipeline(input_file, output_name, **kwargs):
                 raw_data = adata.copy()  # raw as count
 
             # normailize counts and then transform to log space
-            tools.log_norm(adata, kwargs["norm_count"])
+            tools.log_norm(adata, kwargs["norm_count"], to_float32=True)
 
             # set group attribute
             if kwargs["batch_correction"] and kwargs["group_attribute"] is not None:
@@ -106,6 +106,9 @@ def run_pipeline(input_file, output_name, **kwargs):
             n_components=kwargs["nPC"],
             features="highly_variable_features",
             random_state=kwargs["random_state"],
+            method=kwargs.get("pca_method", "dense"),
+            n_jobs=kwargs["n_jobs"],
+            block_size=kwargs.get("pca_block_size", 100000),
         )
 
         # Find K neighbors
@@ -116,7 +119,20 @@ def run_pipeline(input_file, output_name, **kwargs):
             n_jobs=kwargs["n_jobs"],
             random_state=kwargs["random_state"],
             full_speed=kwargs["full_speed"],
+            index_file=output_name + ".pca.hnsw"
+            if kwargs.get("knn_save_index", False)
+            else None,
+            shard_size=kwargs.get("knn_shard_size", None),
         )
+        if kwargs.get("prune_graph", None) is not None:
+            tools.prune_graph(
+                adata,
+                rep="pca",
+                K=kwargs["K"],
+                method=kwargs["prune_graph"],
+                jaccard_cutoff=kwargs["prune_jaccard_cutoff"],
+                top_k=kwargs["prune_top_k"],
+            )
 
         # calculate diffmap
         if (
@@ -147,6 +163,8 @@ def run_pipeline(input_file, output_name, **kwargs):
             K=kwargs["kBET_K"],
             alpha=kwargs["kBET_alpha"],
             n_jobs=kwargs["n_jobs"],
+            random_state=kwargs["random_state"],
+            full_speed=kwargs["full_speed"],
         )
         print(
             "kBET stat_mean = {:.2f}, pvalue_mean = {:.4f}, accept_rate = {:.2%}.".format(
@@ -358,10 +376,17 @@ def run_pipeline(input_file, output_name, **kwargs):
     if kwargs["seurat_compatible"]:
         seurat_data = adata.copy()
         seurat_data.raw = raw_data
-        seurat_data.uns["scale.data"] = adata.uns["fmat_highly_variable_features"]
-        seurat_data.uns["scale.data.rownames"] = adata.var_names[
-            adata.var["highly_variable_features"]
-        ].values
+        if "fmat_highly_variable_features" in adata.uns:
+            seurat_data.uns["scale.data"] = adata.uns["fmat_highly_variable_features"]
+            seurat_data.uns["scale.data.rownames"] = adata.var_names[
+                adata.var["highly_variable_features"]
+            ].values
+        else:
+            print(
+                "Scaled feature matrix is not available with --pca-method {}, scale.data is not written.".format(
+                    kwargs["pca_method"]
+                )
+            )
         io.write_output(seurat_data, output_name + ".seurat.h5ad")
 
     # write out results
@@ -1,4 +1,14 @@
-from .utils import update_rep, X_from_rep, W_from_rep, knn_is_cached
+from .utils import (
+    update_rep,
+    X_from_rep,
+    iter_dense_blocks,
+    calc_group_sums,
+    W_from_rep,
+    calc_fingerprint,
+    knn_cache,
+    SharedArrays,
+    attach_array,
+)
 
 from .data_aggregation import aggregate_matrices
 from .preprocessing import (
@@ -16,6 +26,10 @@ from .nearest_neighbors import (
     calculate_nearest_neighbors,
     get_neighbors,
     neighbors,
+    query_neighbors,
+    benchmark_nearest_neighbors,
+    run_knn_benchmark,
+    prune_graph,
     calculate_affinity_matrix,
     calc_kBET,
     calc_kSIM,
@@ -35,7 +49,15 @@ from .visualization import (
     net_umap,
     net_fle,
 )
-from .diff_expr import de_analysis, markers, write_results_to_excel, run_de_analysis
+from .diff_expr import (
+    de_analysis,
+    pairwise_de_analysis,
+    get_de_results,
+    markers,
+    write_results_to_excel,
+    write_markers,
+    run_de_analysis,
+)
 from .gradient_boosting import find_markers, run_find_markers
 from .convert_to_parquet import convert_to_parquet, run_conversion
 from .scp_output import (
@@ -19,7 +19,7 @@ except ImportError:
 from sklearn.cluster import KMeans
 from typing import List
 
-from sccloud.tools import construct_graph
+from sccloud.tools import construct_graph, SharedArrays, attach_array
 import logging
 
 logger = logging.getLogger("sccloud")
@@ -210,7 +210,8 @@ def recover_numpy_thread(library_type: str, library_obj: object, value: int):
         library_obj.openblas_set_num_threads(value)
 
 
-def run_one_instance_of_kmeans(n_clusters: int, X: "np.array", seed: int) -> List[str]:
+def run_one_instance_of_kmeans(n_clusters: int, X_handle: str, seed: int) -> List[str]:
+    X = attach_array(X_handle)
     library_type, library_obj, value = set_numpy_thread_to_one()
     km = KMeans(n_clusters=n_clusters, n_init=1, n_jobs=1, random_state=seed)
     km.fit(X)
@@ -238,9 +239,12 @@ def run_multiple_kmeans(
 
     np.random.seed(random_state)
     seeds = np.random.randint(np.iinfo(np.int32).max, size=n_init)
-    results = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(run_one_instance_of_kmeans)(n_clusters, X, seed) for seed in seeds
-    )  # Note that if n_jobs == 1, joblib will not fork a new process.
+    with SharedArrays(temp_folder, nbytes=X.nbytes) as shared:
+        X_handle = shared.publish(rep_key, X)
+        results = Parallel(n_jobs=n_jobs, max_nbytes=None)(
+            delayed(run_one_instance_of_kmeans)(n_clusters, X_handle, seed)
+            for seed in seeds
+        )  # Note that if n_jobs == 1, joblib will not fork a new process.
 
     labels = list(zip(*results))
     uniqs = np.unique(labels, axis=0)
@@ -294,7 +298,7 @@ def spectral_louvain(
         Random seed for reproducing results.
 
     temp_folder: ``str``, optional, default: ``None``
-        Temporary folder name for joblib to use during the computation.
+        Temporary folder in which the KMeans input is published once for all parallel workers. If ``None``, use ``/dev/shm`` if available.
 
     class_label: ``str``, optional, default: ``"spectral_louvain_labels"``
         Key name for storing cluster labels in ``data.obs``.
@@ -390,7 +394,7 @@ def spectral_leiden(
         Random seed for reproducing results.
 
     temp_folder: ``str``, optional, default: ``None``
-        Temporary folder name for joblib to use during the computation.
+        Temporary folder in which the KMeans input is published once for all parallel workers. If ``None``, use ``/dev/shm`` if available.
 
     class_label: ``str``, optional, default: ``"spectral_leiden_labels"``
         Key name for storing cluster labels in ``data.obs``.
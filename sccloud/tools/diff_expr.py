@@ -1,4 +1,6 @@
+import os
 import time
+import tempfile
 import numpy as np
 import pandas as pd
 from anndata import AnnData
@@ -6,75 +8,143 @@ from scipy.sparse import csr_matrix, csc_matrix
 from joblib import Parallel, delayed, effective_n_jobs
 from statsmodels.stats.multitest import fdrcorrection as fdr
 from collections import defaultdict
+from numba import njit
 
-from typing import List, Tuple, Dict
+from sccloud.tools import calc_group_sums, calc_fingerprint
+
+from typing import List, Tuple, Dict, Iterator
 import logging
 
 logger = logging.getLogger("sccloud")
 
 
-def calc_basic_stat(
-    clust_id: str,
-    data: List[float],
-    indices: List[int],
-    indptr: List[int],
-    shape: Tuple[int, int],
-    cluster_labels: List[str],
-    cond_labels: List[str],
-    gene_names: List[str],
-    sum_vec: List[float],
-    cnt_vec: List[int],
-    verbose: bool,
-) -> pd.DataFrame:
-    """ Calcualte basic statistics for one cluster
+def get_group_codes(cluster_labels: List[str], cond_labels: List[str]) -> List[int]:
+    """ Combine cluster and condition labels into integer group codes. Without condition, group i is cluster i; with condition, group 2i + j is cluster i under condition j. Cells without a label get code -1.
     """
-    zero_vec = np.zeros(shape[1], dtype=np.float32)
+    codes = cluster_labels.codes.astype(np.int64)
+    if cond_labels is not None:
+        cond_codes = cond_labels.codes.astype(np.int64)
+        codes = np.where((codes >= 0) & (cond_codes >= 0), codes * 2 + cond_codes, -1)
+    return codes
 
-    # recover sparse matrix
-    mat = csr_matrix((data, indices, indptr), shape=shape)
-    mask = cluster_labels == clust_id
-    mat_clust = mat[mask]
 
-    if cond_labels is None:
-        n1 = mat_clust.shape[0]
-        n2 = shape[0] - n1
+class GroupStatistics:
+    """ Sufficient statistics (cell counts, sums, sums of squares and nonzero counts) of each DE group, from which all t-test, Fisher's test and basic statistics are derived.
+    """
 
-        sum_clu = mat_clust.sum(axis=0).A1
-        mean1 = sum_clu / n1 if n1 > 0 else zero_vec
-        mean2 = (sum_vec - sum_clu) / n2 if n2 > 0 else zero_vec
-        mean2[mean2 < 0.0] = 0.0
+    def __init__(self, cluster_labels: List[str], cond_labels: List[str], nfeatures: int):
+        self.nclusters = cluster_labels.categories.size
+        self.has_cond = cond_labels is not None
+        self.ngroups = self.nclusters * (2 if self.has_cond else 1)
+
+        # The last row keeps cells that belong to no group.
+        self.ncells = np.zeros(self.ngroups + 1, dtype=np.int64)
+        self.sums = np.zeros((self.ngroups + 1, nfeatures))
+        self.sum2s = np.zeros((self.ngroups + 1, nfeatures))
+        self.nnzs = np.zeros((self.ngroups + 1, nfeatures), dtype=np.int64)
+        self.totals = None
 
-        nonzeros = mat_clust.getnnz(axis=0)
-        percents = (nonzeros / n1 * 100.0).astype(np.float32) if n1 > 0 else zero_vec
-        percents_other = (
-            ((cnt_vec - nonzeros) / n2 * 100.0).astype(np.float32)
-            if n2 > 0
-            else zero_vec
+    def update(self, X: csr_matrix, codes: List[int]) -> None:
+        """ Add the rows of X, labelled by group codes, into the statistics
+        """
+        self.ncells += np.bincount(
+            np.where(codes >= 0, codes, self.ngroups), minlength=self.ngroups + 1
         )
-    else:
-        cond1 = cond_labels.categories[0]
-        cond_labs = cond_labels[mask]
-        mask2 = cond_labs == cond1
-
-        mat_cond1 = mat_clust[mask2]
-        mat_cond2 = mat_clust[~mask2]
-        n1 = mat_cond1.shape[0]
-        n2 = mat_cond2.shape[0]
-
-        mean1 = mat_cond1.mean(axis=0).A1
-        mean2 = mat_cond2.mean(axis=0).A1
-
-        percents = (
-            (mat_cond1.getnnz(axis=0) / n1 * 100.0).astype(np.float32)
-            if n1 > 0
-            else zero_vec
+        sums, sum2s, nnzs = calc_group_sums(
+            X.data, X.indices, X.indptr, codes, self.ngroups, X.shape[1]
         )
-        percents_other = (
-            (mat_cond2.getnnz(axis=0) / n2 * 100.0).astype(np.float32)
-            if n2 > 0
-            else zero_vec
+        self.sums += sums
+        self.sum2s += sum2s
+        self.nnzs += nnzs
+        self.totals = None
+
+    def get_group(self, gid: int) -> Tuple[int, List[float], List[float], List[int]]:
+        return self.ncells[gid], self.sums[gid], self.sum2s[gid], self.nnzs[gid]
+
+    def get_total(self) -> Tuple[int, List[float], List[float], List[int]]:
+        """ Statistics of all cells
+        """
+        if self.totals is None:
+            self.totals = (
+                self.ncells.sum(),
+                self.sums.sum(axis=0),
+                self.sum2s.sum(axis=0),
+                self.nnzs.sum(axis=0),
+            )
+        return self.totals
+
+    def get_complement(self, gid: int) -> Tuple[int, List[float], List[float], List[int]]:
+        """ Statistics of all cells outside group gid
+        """
+        return tuple(x - y for x, y in zip(self.get_total(), self.get_group(gid)))
+
+    def to_dict(self) -> dict:
+        """ Export the per-group statistics, e.g. to be cached in data.uns
+        """
+        return {
+            "ncells": self.ncells,
+            "sums": self.sums,
+            "sum2s": self.sum2s,
+            "nnzs": self.nnzs,
+        }
+
+    def load(self, stats_dict: dict) -> None:
+        """ Load per-group statistics exported by to_dict
+        """
+        self.ncells = np.asarray(stats_dict["ncells"], dtype=np.int64)
+        self.sums = np.asarray(stats_dict["sums"], dtype=np.float64)
+        self.sum2s = np.asarray(stats_dict["sum2s"], dtype=np.float64)
+        self.nnzs = np.asarray(stats_dict["nnzs"], dtype=np.int64)
+        self.totals = None
+
+    def get_pair(self, clust_idx: int) -> Tuple[tuple, tuple]:
+        """ Return statistics of the two sides compared for cluster clust_idx: cluster vs. rest, or condition 1 vs. condition 2 within the cluster
+        """
+        if self.has_cond:
+            return self.get_group(clust_idx * 2), self.get_group(clust_idx * 2 + 1)
+        return self.get_group(clust_idx), self.get_complement(clust_idx)
+
+
+def collect_group_statistics(
+    X: csr_matrix, cluster_labels: List[str], cond_labels: List[str], verbose: bool
+) -> GroupStatistics:
+    """ Collect sufficient statistics of all DE groups in a single pass over X
+    """
+    start = time.time()
+
+    stats = GroupStatistics(cluster_labels, cond_labels, X.shape[1])
+    stats.update(X, get_group_codes(cluster_labels, cond_labels))
+
+    end = time.time()
+    if verbose:
+        logger.info(
+            "Collecting group statistics is done. Time spent = {:.2f}s.".format(
+                end - start
+            )
         )
 
+    return stats
+
+
+def calc_basic_stat(
+    clust_id: str,
+    stat1: Tuple[int, List[float], List[float], List[int]],
+    stat2: Tuple[int, List[float], List[float], List[int]],
+    gene_names: List[str],
+) -> pd.DataFrame:
+    """ Calcualte basic statistics for one cluster
+    """
+    n1, sum1, _, nnz1 = stat1
+    n2, sum2, _, nnz2 = stat2
+    zero_vec = np.zeros(gene_names.size, dtype=np.float32)
+
+    mean1 = (sum1 / n1).astype(np.float32) if n1 > 0 else zero_vec
+    mean2 = (sum2 / n2).astype(np.float32) if n2 > 0 else zero_vec
+    mean2[mean2 < 0.0] = 0.0
+
+    percents = (nnz1 / n1 * 100.0).astype(np.float32) if n1 > 0 else zero_vec
+    percents_other = (nnz2 / n2 * 100.0).astype(np.float32) if n2 > 0 else zero_vec
+
     # calculate log_fold_change and WAD, Weighted Average Difference, https://almob.biomedcentral.com/articles/10.1186/1748-7188-3-8
     log_fold_change = mean1 - mean2
     x_avg = (mean1 + mean2) / 2
@@ -85,7 +155,7 @@ def calc_basic_stat(
     # calculate percent fold change
     idx = percents > 0.0
     idx_other = percents_other > 0.0
-    percent_fold_change = np.zeros(shape[1], dtype=np.float32)
+    percent_fold_change = np.zeros(gene_names.size, dtype=np.float32)
     percent_fold_change[(~idx) & (~idx_other)] = np.nan
     percent_fold_change[idx & (~idx_other)] = np.inf
     percent_fold_change[idx_other] = percents[idx_other] / percents_other[idx_other]
@@ -103,149 +173,412 @@ def calc_basic_stat(
         index=gene_names,
     )
 
-    if verbose:
-        logger.info("calc_basic_stat finished for cluster {0}.".format(clust_id))
-
     return df
 
 
 def collect_basic_statistics(
-    X: csr_matrix,
+    stats: GroupStatistics,
     cluster_labels: List[str],
-    cond_labels: List[str],
     gene_names: List[str],
-    n_jobs: int,
-    temp_folder: str,
     verbose: bool,
 ) -> List[pd.DataFrame]:
-    """ Collect basic statistics, triggering calc_basic_stat in parallel
+    """ Collect basic statistics for every cluster from the group statistics
     """
     start = time.time()
 
-    sum_vec = cnt_vec = None
+    result_list = [
+        calc_basic_stat(clust_id, *stats.get_pair(i), gene_names)
+        for i, clust_id in enumerate(cluster_labels.categories)
+    ]
+
+    end = time.time()
+    if verbose:
+        logger.info(
+            "Collecting basic statistics is done. Time spent = {:.2f}s.".format(
+                end - start
+            )
+        )
+
+    return result_list
+
+
+@njit(nogil=True)
+def rank_column(data, indices, fr, to, codes, ngroups, nsample, rank_sums, j):
+    """ Rank the stored values data[fr:to] of column j among nsample cells, treating all implicit zeros as one tied block. Add midranks of the nonzeros to rank_sums[:, j] by group code; rows with negative codes go to the last group.
+    Return the rank of the zero block and the tie term sum(t^3 - t).
+    """
+    nnz = to - fr
+    nzero = nsample - nnz
+
+    values = data[fr:to]
+    order = np.argsort(values)
+
+    nneg = 0
+    while nneg < nnz and values[order[nneg]] < 0.0:
+        nneg += 1
+
+    zero_rank = nneg + (nzero + 1) / 2.0
+    tie_sum = float(nzero) ** 3 - nzero
+
+    k = 0
+    while k < nnz:
+        l = k
+        while l + 1 < nnz and values[order[l + 1]] == values[order[k]]:
+            l += 1
+        rank = (k + l) / 2.0 + 1.0 + (nzero if k >= nneg else 0)
+        t = l - k + 1
+        tie_sum += float(t) ** 3 - t
+        for m in range(k, l + 1):
+            code = codes[indices[fr + order[m]]]
+            rank_sums[code if code >= 0 else ngroups, j] += rank
+        k = l + 1
+
+    return zero_rank, tie_sum
+
+
+@njit(nogil=True)
+def calc_rank_sums(data, indices, indptr, codes, ngroups, starts):
+    """ Rank every CSC column once within each block of rows [starts[b], starts[b + 1]). Row indices must be sorted within columns.
+    Return per-group rank sums of the nonzeros, and the rank of the zero block and the tie term of every (block, column).
+    """
+    nblocks = starts.size - 1
+    nfeatures = indptr.size - 1
+    rank_sums = np.zeros((ngroups + 1, nfeatures))
+    zero_ranks = np.zeros((nblocks, nfeatures))
+    tie_sums = np.zeros((nblocks, nfeatures))
+
+    for j in range(nfeatures):
+        fr = indptr[j]
+        for b in range(nblocks):
+            to = fr
+            while to < indptr[j + 1] and indices[to] < starts[b + 1]:
+                to += 1
+            zero_ranks[b, j], tie_sums[b, j] = rank_column(
+                data, indices, fr, to, codes, ngroups, starts[b + 1] - starts[b], rank_sums, j
+            )
+            fr = to
+
+    return rank_sums, zero_ranks, tie_sums
+
+
+def partition_cells(
+    cluster_labels: List[str], cond_labels: List[str]
+) -> Tuple[List[int], List[int], List[int]]:
+    """ Decide which cells are ranked together. Without condition, all cells form one block. With condition, each cluster is a block: cells are reordered so that cluster c occupies rows [starts[c], starts[c + 1]), and cells without a group are dropped.
+    Return group codes of the reordered rows, the row order (None if rows are kept as is) and the block boundaries.
+    """
+    codes = get_group_codes(cluster_labels, cond_labels)
     if cond_labels is None:
-        sum_vec = X.sum(axis=0).A1
-        cnt_vec = X.getnnz(axis=0)
-
-    result_list = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(calc_basic_stat)(
-            clust_id,
-            X.data,
-            X.indices,
-            X.indptr,
-            X.shape,
-            cluster_labels,
-            cond_labels,
-            gene_names,
-            sum_vec,
-            cnt_vec,
-            verbose,
+        return codes, None, np.array([0, codes.size], dtype=np.int64)
+
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    codes = codes[order]
+    starts = np.searchsorted(
+        codes // 2, np.arange(cluster_labels.categories.size + 1)
+    ).astype(np.int64)
+    return codes, order, starts
+
+
+def remap_rows(Xc: csc_matrix, order: List[int]) -> csc_matrix:
+    """ Reorder (and subset) rows of Xc by order, keeping row indices sorted within columns
+    """
+    if order is None:
+        return Xc
+    Xc = Xc[order]
+    Xc.sort_indices()
+    return Xc
+
+
+def split_genes_for_workers(nnzs: List[int], ntasks: int, n_jobs: int) -> List[int]:
+    """ Split genes into nnz-balanced blocks such that ntasks x blocks tiles keep about 4 tiles per worker. Return block boundaries.
+    """
+    nblocks = min(max(-(-4 * n_jobs // max(ntasks, 1)), 1), max(nnzs.size, 1))
+    if nblocks == 1:
+        return [0, nnzs.size]
+    return get_gene_chunks(nnzs, max(int(np.ceil(nnzs.sum() / nblocks)), 1))
+
+
+def calc_rank_sums_by_tiles(
+    Xc: csc_matrix, codes: List[int], ngroups: int, starts: List[int], n_jobs: int
+) -> Tuple[List[float], List[float], List[float]]:
+    """ Run calc_rank_sums on nnz-balanced gene blocks of Xc in parallel threads and concatenate the results
+    """
+    bounds = split_genes_for_workers(np.diff(Xc.indptr), 1, n_jobs)
+    res_arr = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(calc_rank_sums)(
+            Xc.data, Xc.indices, Xc.indptr[fr : to + 1], codes, ngroups, starts
         )
-        for clust_id in cluster_labels.categories
+        for fr, to in zip(bounds[:-1], bounds[1:])
+    )
+    return tuple(np.concatenate(arrs, axis=-1) for arrs in zip(*res_arr))
+
+
+def collect_rank_statistics(
+    Xc: csc_matrix,
+    stats: GroupStatistics,
+    cluster_labels: List[str],
+    cond_labels: List[str],
+    n_jobs: int,
+    verbose: bool,
+) -> Tuple[List[float], List[float], List[float]]:
+    """ Rank every gene once, over all cells or within each cluster if condition is given, and collect per-group rank sums for the rank-based tests
+    """
+    start = time.time()
+
+    codes, order, starts = partition_cells(cluster_labels, cond_labels)
+    rank_sums, zero_ranks, tie_sums = calc_rank_sums_by_tiles(
+        remap_rows(Xc, order), codes, stats.ngroups, starts, n_jobs
     )
 
     end = time.time()
     if verbose:
         logger.info(
-            "Collecting basic statistics is done. Time spent = {:.2f}s.".format(
+            "Collecting rank statistics is done. Time spent = {:.2f}s.".format(
                 end - start
             )
         )
 
-    return result_list
+    return rank_sums, zero_ranks, tie_sums
 
 
-def calc_auc(
-    clust_id: str,
-    data: List[float],
-    indices: List[int],
-    indptr: List[int],
-    shape: Tuple[int, int],
+def iter_row_blocks(X: "backed matrix", idx: List[bool], block_size: int) -> csr_matrix:
+    """ Read a (backed) matrix block_size rows at a time and yield each block as a csr_matrix, keeping only rows selected by idx
+    """
+    for start in range(0, X.shape[0], block_size):
+        end = min(start + block_size, X.shape[0])
+        block = csr_matrix(X[start:end])
+        if idx is not None:
+            block = block[idx[start:end]]
+        block.eliminate_zeros()  # In case there is any extra zeros
+        yield block
+
+
+def collect_group_statistics_by_blocks(
+    X: "backed matrix",
+    idx: List[bool],
+    block_size: int,
     cluster_labels: List[str],
     cond_labels: List[str],
-    gene_names: List[str],
     verbose: bool,
-) -> pd.DataFrame:
-    """ Calculate AUROC for one cluster
+) -> GroupStatistics:
+    """ Collect sufficient statistics of all DE groups by streaming row blocks of a backed matrix
     """
-    import sklearn.metrics as sm
+    start = time.time()
 
-    csc_mat = csc_matrix((data, indices, indptr), shape=shape)
-    mask = cluster_labels == clust_id
+    stats = GroupStatistics(cluster_labels, cond_labels, X.shape[1])
+    codes = get_group_codes(cluster_labels, cond_labels)
+    offset = 0
+    for block in iter_row_blocks(X, idx, block_size):
+        stats.update(block, codes[offset : offset + block.shape[0]])
+        offset += block.shape[0]
 
-    auroc = np.zeros(shape[1], dtype=np.float32)
-    # aupr = np.zeros(shape[1], dtype = np.float32)
+    end = time.time()
+    if verbose:
+        logger.info(
+            "Collecting group statistics by blocks is done. Time spent = {:.2f}s.".format(
+                end - start
+            )
+        )
 
-    if cond_labels is None:
-        exprs = np.zeros(shape[0])
-        y_true = mask
-        n1 = mask.sum()
-        n2 = shape[0] - n1
+    return stats
+
+
+def calc_labels_fingerprint(data: AnnData, cluster_labels: List[str]) -> str:
+    """ Fingerprint the cluster label of every cell, and the expression matrix unless it is backed (a backed matrix cannot be fingerprinted without reading it)
+    """
+    import hashlib
+
+    h = hashlib.sha1(str(list(cluster_labels.categories.values.astype(str))).encode())
+    h.update(np.ascontiguousarray(cluster_labels.codes, dtype=np.int64).tobytes())
+    h.update(str(data.shape).encode())
+    if not data.isbacked:
+        h.update(calc_fingerprint(data.X).encode())
+    return h.hexdigest()
+
+
+def cache_cluster_statistics(
+    data: AnnData,
+    cluster: str,
+    cluster_labels: List[str],
+    stats: GroupStatistics,
+    stats_key: str,
+) -> None:
+    """ Store per-cluster statistics of all cells into data.uns[stats_key], with a fingerprint of the labels and matrix they were computed from
+    """
+    stats_dict = stats.to_dict()
+    stats_dict["cluster"] = cluster
+    stats_dict["categories"] = cluster_labels.categories.values.astype(str)
+    stats_dict["fingerprint"] = calc_labels_fingerprint(data, cluster_labels)
+    data.uns[stats_key] = stats_dict
+
+
+def get_cluster_statistics(
+    data: AnnData, cluster: str, stats_key: str, block_size: int, verbose: bool
+) -> GroupStatistics:
+    """ Return per-cluster statistics of all cells, using data.uns[stats_key] if it was computed for the same cluster label of every cell (and the same matrix). Otherwise, scan the matrix once and cache the result.
+    """
+    cluster_labels = data.obs[cluster].values
+    stats = GroupStatistics(cluster_labels, None, data.shape[1])
+
+    cached = data.uns.get(stats_key, None) if stats_key is not None else None
+    if (
+        cached is not None
+        and "fingerprint" in cached
+        and cached["cluster"] == cluster
+        and str(cached["fingerprint"]) == calc_labels_fingerprint(data, cluster_labels)
+    ):
+        stats.load(cached)
+        if verbose:
+            logger.info("Loaded cached cluster statistics from uns/{}.".format(stats_key))
+        return stats
+
+    if data.isbacked:
+        stats = collect_group_statistics_by_blocks(
+            data.X, None, block_size, cluster_labels, None, verbose
+        )
     else:
-        exprs = None
-        cond1 = cond_labels.categories[0]
-        cond_labs = cond_labels[mask]
-        y_true = cond_labs == cond1
-        n1 = y_true.sum()
-        n2 = mask.sum() - n1
+        X = data.X if isinstance(data.X, csr_matrix) else data.X[:]
+        X.eliminate_zeros()  # In case there is any extra zeros
+        stats = collect_group_statistics(X, cluster_labels, None, verbose)
+    if stats_key is not None:
+        cache_cluster_statistics(data, cluster, cluster_labels, stats, stats_key)
+
+    return stats
 
-    if n1 > 0 and n2 > 0:
-        for i in range(shape[1]):
-            if cond_labels is None:
-                exprs[:] = 0.0
-                exprs[
-                    csc_mat.indices[csc_mat.indptr[i] : csc_mat.indptr[i + 1]]
-                ] = csc_mat.data[csc_mat.indptr[i] : csc_mat.indptr[i + 1]]
-            else:
-                exprs = csc_mat[mask, i].toarray()[:, 0]
 
-            fpr, tpr, thresholds = sm.roc_curve(y_true, exprs)
-            auroc[i] = sm.auc(fpr, tpr)
+def get_gene_chunks(nnzs: List[int], budget: int) -> List[int]:
+    """ Split genes into consecutive chunks with at most budget nonzeros each (every chunk has at least one gene). Return chunk boundaries.
+    """
+    bounds = [0]
+    chunk_nnz = 0
+    for j in range(nnzs.size):
+        if chunk_nnz + nnzs[j] > budget and j > bounds[-1]:
+            bounds.append(j)
+            chunk_nnz = 0
+        chunk_nnz += nnzs[j]
+    bounds.append(nnzs.size)
+    return bounds
+
+
+def iter_csc_chunks(
+    X: "backed matrix", idx: List[bool], block_size: int, bounds: List[int], folder: str
+) -> Iterator[csc_matrix]:
+    """ Read the row blocks of a backed matrix once, appending the entries of each gene chunk [bounds[k], bounds[k + 1]) to its own file in folder. Then load and yield the chunks one at a time as csc_matrix with sorted row indices, removing each file after loading
+    """
+    dtype = np.dtype([("row", np.int64), ("col", np.int32), ("data", np.float64)])
+    files = [os.path.join(folder, "chunk_{}.bin".format(k)) for k in range(len(bounds) - 1)]
+    for fname in files:
+        open(fname, "wb").close()
+
+    nrows = 0
+    for block in iter_row_blocks(X, idx, block_size):
+        coo = block.tocoo()
+        entries = np.empty(coo.nnz, dtype=dtype)
+        entries["row"] = coo.row.astype(np.int64) + nrows
+        entries["col"] = coo.col
+        entries["data"] = coo.data
+        chunk_ids = np.searchsorted(bounds, entries["col"], side="right") - 1
+        order = np.argsort(chunk_ids, kind="stable")
+        splits = np.searchsorted(chunk_ids[order], np.arange(1, len(files)))
+        for fname, part in zip(files, np.split(entries[order], splits)):
+            if part.size > 0:
+                with open(fname, "ab") as fout:
+                    part.tofile(fout)
+        nrows += block.shape[0]
+
+    for k, fname in enumerate(files):
+        entries = np.fromfile(fname, dtype=dtype)
+        os.remove(fname)
+        Xc = csc_matrix(
+            (entries["data"], (entries["row"], entries["col"] - bounds[k])),
+            shape=(nrows, bounds[k + 1] - bounds[k]),
+        )
+        Xc.sort_indices()
+        yield Xc
 
-            # precision, recall, thresholds = sm.precision_recall_curve(y_true, exprs)
-            # aupr[i] = sm.auc(recall, precision)
 
-    df = pd.DataFrame(
-        {
-            "auroc:{0}".format(clust_id): auroc,
-            # "aupr:{0}".format(clust_id): aupr,
-        },
-        index=gene_names,
-    )
+def collect_rank_statistics_by_blocks(
+    X: "backed matrix",
+    idx: List[bool],
+    block_size: int,
+    stats: GroupStatistics,
+    cluster_labels: List[str],
+    cond_labels: List[str],
+    n_jobs: int,
+    verbose: bool,
+) -> Tuple[List[float], List[float], List[float]]:
+    """ Collect the same rank statistics as collect_rank_statistics without loading the whole matrix. Genes are ranked chunk by chunk, and each chunk holds about as many nonzeros as one row block.
+    The backed matrix is read only once: its entries are spilled into one temporary file per gene chunk (about 20 bytes per nonzero in total on disk), which are then loaded one at a time.
+    """
+    start = time.time()
 
+    ncells, _, _, nnzs = stats.get_total()
+    budget = max(int(nnzs.sum() * min(block_size, ncells) / max(ncells, 1)), 1)
+    bounds = get_gene_chunks(nnzs, budget)
+
+    codes, order, starts = partition_cells(cluster_labels, cond_labels)
+    nfeatures = X.shape[1]
+    rank_sums = np.zeros((stats.ngroups + 1, nfeatures))
+    zero_ranks = np.zeros((starts.size - 1, nfeatures))
+    tie_sums = np.zeros((starts.size - 1, nfeatures))
+
+    with tempfile.TemporaryDirectory(prefix="sccloud_de_") as folder:
+        chunks = iter_csc_chunks(X, idx, block_size, bounds, folder)
+        for fr, to, Xc in zip(bounds[:-1], bounds[1:], chunks):
+            Xc = remap_rows(Xc, order)
+            rank_sums[:, fr:to], zero_ranks[:, fr:to], tie_sums[:, fr:to] = calc_rank_sums_by_tiles(
+                Xc, codes, stats.ngroups, starts, n_jobs
+            )
+
+    end = time.time()
     if verbose:
-        logger.info("calc_auc finished for cluster {0}.".format(clust_id))
+        logger.info(
+            "Collecting rank statistics over {} gene chunks is done. Time spent = {:.2f}s.".format(
+                len(bounds) - 1, end - start
+            )
+        )
 
-    return df
+    return rank_sums, zero_ranks, tie_sums
+
+
+def calc_U_stats(
+    stats: GroupStatistics,
+    ranks: Tuple[List[float], List[float], List[float]],
+    clust_idx: int,
+) -> Tuple[int, int, List[float], List[float], List[bool]]:
+    """ Calculate Mann-Whitney U statistics of the two sides compared for cluster clust_idx (see GroupStatistics.get_pair) for all genes from the rank sums.
+    Also return the tie terms and whether each gene is expressed on either side.
+    """
+    rank_sums, zero_ranks, tie_sums = ranks
+    gid, block = (clust_idx * 2, clust_idx) if stats.has_cond else (clust_idx, 0)
+    (n1, _, _, nnz1), (n2, _, _, nnz2) = stats.get_pair(clust_idx)
+    R1 = rank_sums[gid] + (n1 - nnz1) * zero_ranks[block]
+    return n1, n2, R1 - n1 * (n1 + 1) / 2.0, tie_sums[block], (nnz1 + nnz2) > 0
 
 
 def calculate_auc_values(
-    Xc: csc_matrix,
+    stats: GroupStatistics,
+    ranks: Tuple[List[float], List[float], List[float]],
     cluster_labels: List[str],
-    cond_labels: List[str],
     gene_names: List[str],
-    n_jobs: int,
-    temp_folder: str,
     verbose: bool,
 ) -> List[pd.DataFrame]:
-    """ Calculate AUROC values, triggering calc_auc in parallel
+    """ Calculate AUROC values from the rank sums, using the Mann-Whitney identity AUROC = U / (n1 * n2)
     """
     start = time.time()
 
-    result_list = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(calc_auc)(
-            clust_id,
-            Xc.data,
-            Xc.indices,
-            Xc.indptr,
-            Xc.shape,
-            cluster_labels,
-            cond_labels,
-            gene_names,
-            verbose,
+    result_list = []
+    for i, clust_id in enumerate(cluster_labels.categories):
+        n1, n2, U1, _, _ = calc_U_stats(stats, ranks, i)
+        auroc = (
+            (U1 / (n1 * n2)).astype(np.float32)
+            if n1 > 0 and n2 > 0
+            else np.zeros(gene_names.size, dtype=np.float32)
+        )
+        result_list.append(
+            pd.DataFrame({"auroc:{0}".format(clust_id): auroc}, index=gene_names)
         )
-        for clust_id in cluster_labels.categories
-    )
 
     end = time.time()
     if verbose:
@@ -258,62 +591,28 @@ def calculate_auc_values(
 
 def calc_t(
     clust_id: str,
-    data: List[float],
-    indices: List[int],
-    indptr: List[int],
-    shape: Tuple[int, int],
-    cluster_labels: List[str],
-    cond_labels: List[str],
+    stat1: Tuple[int, List[float], List[float], List[int]],
+    stat2: Tuple[int, List[float], List[float], List[int]],
     gene_names: List[str],
-    sum_vec: List[float],
-    sum2_vec: List[float],
-    verbose: bool,
 ) -> pd.DataFrame:
     """ Calcualte Welch's t-test for one cluster
     """
-
-    # recover sparse matrix
-    mat = csr_matrix((data, indices, indptr), shape=shape)
-    pvals = np.full(shape[1], 1.0)
-    mask = cluster_labels == clust_id
-    mat_clust = mat[mask]
-
-    if cond_labels is None:
-        n1 = mat_clust.shape[0]
-        n2 = shape[0] - n1
-
-        if n1 > 1 and n2 > 1:
-            sum_clu = mat_clust.sum(axis=0).A1
-            mean1 = sum_clu / n1
-            mean2 = (sum_vec - sum_clu) / n2
-            mean2[mean2 < 0.0] = 0.0
-
-            sum2_clu = mat_clust.power(2).sum(axis=0).A1
-            s1sqr = (sum2_clu - n1 * (mean1 ** 2)) / (n1 - 1)
-            s2sqr = ((sum2_vec - sum2_clu) - n2 * (mean2 ** 2)) / (n2 - 1)
-            s2sqr[s2sqr < 0.0] = 0.0
-    else:
-        cond1 = cond_labels.categories[0]
-        cond_labs = cond_labels[mask]
-        mask2 = cond_labs == cond1
-
-        mat_cond1 = mat_clust[mask2]
-        mat_cond2 = mat_clust[~mask2]
-        n1 = mat_cond1.shape[0]
-        n2 = mat_cond2.shape[0]
-
-        if n1 > 1 and n2 > 1:
-            mean1 = mat_cond1.mean(axis=0).A1
-            psum1 = mat_cond1.power(2).sum(axis=0).A1
-            s1sqr = (psum1 - n1 * (mean1 ** 2)) / (n1 - 1)
-
-            mean2 = mat_cond2.mean(axis=0).A1
-            psum2 = mat_cond2.power(2).sum(axis=0).A1
-            s2sqr = (psum2 - n2 * (mean2 ** 2)) / (n2 - 1)
+    n1, sum1, psum1, _ = stat1
+    n2, sum2, psum2, _ = stat2
+    pvals = np.full(gene_names.size, 1.0)
 
     if n1 > 1 and n2 > 1:
         import scipy.stats as ss
 
+        mean1 = sum1 / n1
+        mean2 = sum2 / n2
+        mean2[mean2 < 0.0] = 0.0
+
+        s1sqr = (psum1 - n1 * (mean1 ** 2)) / (n1 - 1)
+        s2sqr = (psum2 - n2 * (mean2 ** 2)) / (n2 - 1)
+        s1sqr[s1sqr < 0.0] = 0.0
+        s2sqr[s2sqr < 0.0] = 0.0
+
         var_est = s1sqr / n1 + s2sqr / n2
         idx = var_est > 0.0
         if idx.sum() > 0:
@@ -333,46 +632,23 @@ def calc_t(
         index=gene_names,
     )
 
-    if verbose:
-        logger.info("calc_t finished for cluster {0}.".format(clust_id))
-
     return df
 
 
 def t_test(
-    X: csr_matrix,
+    stats: GroupStatistics,
     cluster_labels: List[str],
-    cond_labels: List[str],
     gene_names: List[str],
-    n_jobs: int,
-    temp_folder: str,
     verbose: bool,
 ) -> List[pd.DataFrame]:
-    """ Run Welch's t-test, triggering calc_t in parallel
+    """ Run Welch's t-test for every cluster from the group statistics
     """
     start = time.time()
 
-    sum_vec = sum2_vec = None
-    if cond_labels is None:
-        sum_vec = X.sum(axis=0).A1
-        sum2_vec = X.power(2).sum(axis=0).A1
-
-    result_list = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(calc_t)(
-            clust_id,
-            X.data,
-            X.indices,
-            X.indptr,
-            X.shape,
-            cluster_labels,
-            cond_labels,
-            gene_names,
-            sum_vec,
-            sum2_vec,
-            verbose,
-        )
-        for clust_id in cluster_labels.categories
-    )
+    result_list = [
+        calc_t(clust_id, *stats.get_pair(i), gene_names)
+        for i, clust_id in enumerate(cluster_labels.categories)
+    ]
 
     end = time.time()
     if verbose:
@@ -383,47 +659,21 @@ def t_test(
 
 def calc_fisher(
     clust_id: str,
-    data: List[float],
-    indices: List[int],
-    indptr: List[int],
-    shape: Tuple[int, int],
-    cluster_labels: List[str],
-    cond_labels: List[str],
+    stat1: Tuple[int, List[float], List[float], List[int]],
+    stat2: Tuple[int, List[float], List[float], List[int]],
     gene_names: List[str],
-    cnt_vec: List[int],
-    verbose: bool,
 ) -> pd.DataFrame:
     """ Calcualte Fisher's exact test for one cluster
     """
     import fisher
 
-    # recover sparse matrix
-    mat = csr_matrix((data, indices, indptr), shape=shape)
-    mask = cluster_labels == clust_id
-    mat_clust = mat[mask]
-
-    if cond_labels is None:
-        n1 = mat_clust.shape[0]
-        n2 = shape[0] - n1
-
-        a_true = mat_clust.getnnz(axis=0).astype(np.uint)
-        a_false = n1 - a_true
-        b_true = cnt_vec.astype(np.uint) - a_true
-        b_false = n2 - b_true
-    else:
-        cond1 = cond_labels.categories[0]
-        cond_labs = cond_labels[mask]
-        mask2 = cond_labs == cond1
-
-        mat_cond1 = mat_clust[mask2]
-        mat_cond2 = mat_clust[~mask2]
-        n1 = mat_cond1.shape[0]
-        n2 = mat_cond2.shape[0]
+    n1, _, _, nnz1 = stat1
+    n2, _, _, nnz2 = stat2
 
-        a_true = mat_cond1.getnnz(axis=0).astype(np.uint)
-        a_false = n1 - a_true
-        b_true = mat_cond2.getnnz(axis=0).astype(np.uint)
-        b_false = n2 - b_true
+    a_true = nnz1.astype(np.uint)
+    a_false = n1 - a_true
+    b_true = nnz2.astype(np.uint)
+    b_false = n2 - b_true
 
     pvals = fisher.pvalue_npy(a_true, a_false, b_true, b_false)[2]
     passed, qvals = fdr(pvals)
@@ -436,44 +686,23 @@ def calc_fisher(
         index=gene_names,
     )
 
-    if verbose:
-        logger.info("calc_fisher finished for cluster {0}.".format(clust_id))
-
     return df
 
 
 def fisher_test(
-    X: csr_matrix,
+    stats: GroupStatistics,
     cluster_labels: List[str],
-    cond_labels: List[str],
     gene_names: List[str],
-    n_jobs: int,
-    temp_folder: str,
     verbose: bool,
 ) -> List[pd.DataFrame]:
-    """ Run Fisher's exact test, triggering calc_fisher in parallel
+    """ Run Fisher's exact test for every cluster from the group statistics
     """
     start = time.time()
 
-    cnt_vec = None
-    if cond_labels is None:
-        cnt_vec = X.getnnz(axis=0)
-
-    result_list = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(calc_fisher)(
-            clust_id,
-            X.data,
-            X.indices,
-            X.indptr,
-            X.shape,
-            cluster_labels,
-            cond_labels,
-            gene_names,
-            cnt_vec,
-            verbose,
-        )
-        for clust_id in cluster_labels.categories
-    )
+    result_list = [
+        calc_fisher(clust_id, *stats.get_pair(i), gene_names)
+        for i, clust_id in enumerate(cluster_labels.categories)
+    ]
 
     end = time.time()
     if verbose:
@@ -484,59 +713,33 @@ def fisher_test(
     return result_list
 
 
-def calc_mwu(
+def calc_mwu_from_ranks(
     clust_id: str,
-    data: List[float],
-    indices: List[int],
-    indptr: List[int],
-    shape: Tuple[int, int],
-    cluster_labels: List[str],
-    cond_labels: List[str],
+    stats: GroupStatistics,
+    ranks: Tuple[List[float], List[float], List[float]],
+    clust_idx: int,
     gene_names: List[str],
-    verbose: bool,
 ) -> pd.DataFrame:
-    """ Run Mann-Whitney U test for one cluster
+    """ Run tie-corrected Mann-Whitney U test with normal approximation for one cluster, using the rank sums
     """
+    import scipy.stats as ss
 
-    csc_mat = csc_matrix((data, indices, indptr), shape=shape)
-    U_stats = np.zeros(shape[1], dtype=np.float32)
-    pvals = np.full(shape[1], 1.0)
-    mask = cluster_labels == clust_id
-
-    if cond_labels is None:
-        exprs = np.zeros(shape[0])
-        idx_x = mask
-        idx_y = ~idx_x
-    else:
-        exprs = None
-        cond1 = cond_labels.categories[0]
-        cond_labs = cond_labels[mask]
-        idx_x = cond_labs == cond1
-        idx_y = ~idx_x
-
-    n1 = idx_x.sum()
-    n2 = idx_y.sum()
+    U_stats = np.zeros(gene_names.size, dtype=np.float32)
+    pvals = np.full(gene_names.size, 1.0)
 
+    n1, n2, U1, tie_sums, expressed = calc_U_stats(stats, ranks, clust_idx)
     if n1 > 0 and n2 > 0:
-        import scipy.stats as ss
-
-        for i in range(shape[1]):
-            if cond_labels is None:
-                if csc_mat.indptr[i + 1] - csc_mat.indptr[i] > 0:
-                    exprs[:] = 0.0
-                    exprs[
-                        csc_mat.indices[csc_mat.indptr[i] : csc_mat.indptr[i + 1]]
-                    ] = csc_mat.data[csc_mat.indptr[i] : csc_mat.indptr[i + 1]]
-                    U_stats[i], pvals[i] = ss.mannwhitneyu(
-                        exprs[idx_x], exprs[idx_y], alternative="two-sided"
-                    )
-            else:
-                tmp_mat = csc_mat[mask, i]
-                if tmp_mat.data.size > 0:
-                    exprs = tmp_mat.toarray()[:, 0]
-                    U_stats[i], pvals[i] = ss.mannwhitneyu(
-                        exprs[idx_x], exprs[idx_y], alternative="two-sided"
-                    )
+        n = n1 + n2
+        tie_correct = 1.0 - tie_sums / (float(n) ** 3 - n)
+        sd = np.sqrt(tie_correct * n1 * n2 * (n + 1) / 12.0)
+        # Genes not expressed in any cell are not tested
+        idx = expressed & (sd > 0.0)
+        if idx.sum() > 0:
+            bigu = np.maximum(U1[idx], n1 * n2 - U1[idx])
+            # continuity correction toward zero; bigu >= n1 * n2 / 2, so z < 0 only if bigu is within 0.5 of the mean
+            z = (bigu - (n1 * n2 / 2.0 + 0.5)) / sd[idx]
+            U_stats[idx] = U1[idx]
+            pvals[idx] = np.minimum(2.0 * ss.norm.sf(z), 1.0)  # as scipy.stats.mannwhitneyu
 
     passed, qvals = fdr(pvals)
 
@@ -549,39 +752,24 @@ def calc_mwu(
         index=gene_names,
     )
 
-    if verbose:
-        logger.info("calc_mwu finished for cluster {0}.".format(clust_id))
-
     return df
 
 
 def mwu_test(
-    Xc: csc_matrix,
+    stats: GroupStatistics,
+    ranks: Tuple[List[float], List[float], List[float]],
     cluster_labels: List[str],
-    cond_labels: List[str],
     gene_names: List[str],
-    n_jobs: int,
-    temp_folder: str,
     verbose: bool,
 ) -> List[pd.DataFrame]:
-    """ Run Mann-Whitney U test, triggering calc_mwu in parallel
+    """ Run Mann-Whitney U test for every cluster from the rank sums
     """
     start = time.time()
 
-    result_list = Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-        delayed(calc_mwu)(
-            clust_id,
-            Xc.data,
-            Xc.indices,
-            Xc.indptr,
-            Xc.shape,
-            cluster_labels,
-            cond_labels,
-            gene_names,
-            verbose,
-        )
-        for clust_id in cluster_labels.categories
-    )
+    result_list = [
+        calc_mwu_from_ranks(clust_id, stats, ranks, i, gene_names)
+        for i, clust_id in enumerate(cluster_labels.categories)
+    ]
 
     end = time.time()
     if verbose:
@@ -592,19 +780,141 @@ def mwu_test(
     return result_list
 
 
-def organize_results(results: List[List[pd.DataFrame]]) -> pd.DataFrame:
-    """ Concatenate resulting dataframes into one big dataframe
+class DEResults:
+    """ Columnar store of DE results. values[s, c, g] is statistic s of cluster c for gene g in float32, and stats/clusters index the first two axes.
+    Per-cluster, per-statistic and per-gene lookups are slices of values.
     """
-    m = len(results)
-    n = len(results[0])
-    reslist = []
 
-    for i in range(n):
-        for j in range(m):
-            reslist.append(results[j][i])
+    def __init__(self, values: np.ndarray, stats: List[str], clusters: List[str]):
+        self.values = values
+        self.stats = [str(x) for x in stats]
+        self.clusters = [str(x) for x in clusters]
+        self.stat2idx = {x: i for i, x in enumerate(self.stats)}
+        self.clust2idx = {x: i for i, x in enumerate(self.clusters)}
 
-    df = pd.concat(reslist, axis=1)
-    return df
+    def has_stat(self, stat: str) -> bool:
+        return stat in self.stat2idx
+
+    def get_cluster(self, clust_id: str, gene_names: List[str]) -> pd.DataFrame:
+        """ All statistics of one cluster, with genes as rows
+        """
+        return pd.DataFrame(
+            data=self.values[:, self.clust2idx[clust_id], :].T,
+            index=gene_names,
+            columns=self.stats,
+        )
+
+    def get_stat(self, stat: str, gene_names: List[str]) -> pd.DataFrame:
+        """ One statistic of all clusters, with genes as rows
+        """
+        return pd.DataFrame(
+            data=self.values[self.stat2idx[stat]].T,
+            index=gene_names,
+            columns=self.clusters,
+        )
+
+    def get_gene(self, gene_idx: int) -> pd.DataFrame:
+        """ All statistics of one gene, with statistics as rows and clusters as columns
+        """
+        return pd.DataFrame(
+            data=self.values[:, :, gene_idx], index=self.stats, columns=self.clusters
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "values": self.values,
+            "stats": np.array(self.stats, dtype=object),
+            "clusters": np.array(self.clusters, dtype=object),
+        }
+
+    def to_records(self) -> np.recarray:
+        """ Record array view with fields named "stat:cluster", as stored by earlier versions in data.varm
+        """
+        names = [
+            "{0}:{1}".format(stat, clust_id)
+            for clust_id in self.clusters
+            for stat in self.stats
+        ]
+        arrays = [
+            self.values[i, j]
+            for j in range(len(self.clusters))
+            for i in range(len(self.stats))
+        ]
+        return np.rec.fromarrays(arrays, names=names)
+
+
+def get_de_results(data: AnnData, de_key: str = "de_res") -> DEResults:
+    """Load DE analysis results stored by ``de_analysis``.
+
+    Parameters
+    ----------
+    data: ``anndata.AnnData``
+        Annotated data matrix with DE analysis results.
+
+    de_key: ``str``, optional, default: ``"de_res"``
+        Keyword of DE result stored in ``data.uns``. Record arrays stored in ``data.varm`` by earlier versions are also accepted.
+
+    Returns
+    -------
+    ``DEResults``
+        Columnar DE results. Use ``get_cluster``, ``get_stat`` and ``get_gene`` for lookups, and ``to_records`` for the old record array layout.
+
+    Examples
+    --------
+    >>> df = scc.get_de_results(adata).get_cluster('1', adata.var_names)
+    """
+    if de_key in data.uns and "values" in data.uns[de_key]:
+        de_dict = data.uns[de_key]
+        de_res = DEResults(np.asarray(de_dict["values"]), de_dict["stats"], de_dict["clusters"])
+    elif de_key in data.varm.keys():
+        rec_array = np.asarray(data.varm[de_key]).ravel()  # newer anndata stores it as a column
+        clust2cols = defaultdict(list)
+        for name in rec_array.dtype.names:
+            col_name, sep, clust_id = name.partition(":")
+            clust2cols[clust_id].append(col_name)
+        clusters = list(clust2cols)
+        stats = clust2cols[clusters[0]]
+        values = np.full((len(stats), len(clusters), data.shape[1]), np.nan, dtype=np.float32)
+        for j, clust_id in enumerate(clusters):
+            for col_name in clust2cols[clust_id]:
+                values[stats.index(col_name), j] = rec_array[col_name + ":" + clust_id]
+        de_res = DEResults(values, stats, clusters)
+    else:
+        raise ValueError("Please run de_analysis first!")
+
+    if de_res.values.shape[2] != data.shape[1]:
+        raise ValueError(
+            "DE results do not match the genes in data. Please run de_analysis again!"
+        )
+
+    return de_res
+
+
+def organize_results(
+    results: List[List[pd.DataFrame]], clusters: List[str]
+) -> DEResults:
+    """ Collect resulting dataframes, results[test][cluster], into one (stat x cluster x gene) store
+    """
+    stats = [name.partition(":")[0] for res in results for name in res[0].columns]
+    values = np.empty(
+        (len(stats), len(clusters), results[0][0].shape[0]), dtype=np.float32
+    )
+
+    for i in range(len(clusters)):
+        s = 0
+        for res in results:
+            df = res[i]
+            values[s : s + df.shape[1], i] = df.values.T
+            s += df.shape[1]
+
+    return DEResults(values, stats, clusters)
+
+
+def store_de_results(data: AnnData, result_key: str, de_res: DEResults) -> None:
+    """ Store DE results in data.uns[result_key], and their record array view in data.varm[result_key] for tools that read the layout of earlier versions. The varm copy is deprecated and will be removed in a future release.
+    """
+    data.uns[result_key] = de_res.to_dict()
+    data.varm[result_key] = de_res.to_records()
 
 
 def de_analysis(
@@ -620,6 +930,8 @@ def de_analysis(
     mwu: bool = False,
     temp_folder: str = None,
     verbose: bool = True,
+    block_size: int = 100000,
+    stats_key: str = None,
 ) -> None:
     """Perform Differential Expression (DE) Analysis on data.
 
@@ -656,17 +968,28 @@ def de_analysis(
         If ``True``, calculate Mann-Whitney U test.
 
     temp_folder: ``str``, optional, default: ``None``
-        Joblib temporary folder for memmapping numpy arrays.
+        Deprecated and ignored. Parallel workers no longer memmap numpy arrays through joblib.
 
     verbose: ``bool``, optional, default: ``True``
         If ``True``, show detailed intermediate output.
 
+    block_size: ``int``, optional, default: ``100000``
+        If ``data`` is in backed mode, read ``data.X`` ``block_size`` cells at a time instead of loading the whole matrix. Results are identical; peak memory is bounded by the block size.
+
+    stats_key: ``str``, optional, default: ``None``
+        If not ``None``, cache per-cluster statistics in ``data.uns[stats_key]``, e.g. ``"de_stats"``, so that a later ``pairwise_de_analysis`` with the same ``stats_key`` reuses them. Only cached if neither ``condition`` nor ``subset`` is set.
+
     Returns
     -------
     ``None``
 
+    Update ``data.uns``:
+        ``data.uns[result_key]``: DE analysis result, see ``get_de_results``.
+
+        ``data.uns[stats_key]``: Per-cluster statistics, only if ``stats_key`` is set.
+
     Update ``data.varm``:
-        ``data.varm[result_key]``: DE analysis result.
+        ``data.varm[result_key]``: The same DE results as a record array with fields named ``"stat:cluster"``, as stored by earlier versions. Deprecated; use ``get_de_results`` instead.
 
     Examples
     --------
@@ -676,6 +999,9 @@ def de_analysis(
     """
     start = time.time()
 
+    if temp_folder is not None:
+        logger.warning("temp_folder is deprecated and ignored.")
+
     if cluster not in data.obs:
         raise ValueError("Cannot find cluster label!")
     cluster_labels = data.obs[cluster].values
@@ -694,9 +1020,15 @@ def de_analysis(
                 "Number of distinct values in Condition is not equal to 2!"
             )
 
-    X = data.X if isinstance(data.X, csr_matrix) else data.X[:]
-    X.eliminate_zeros()  # In case there is any extra zeros
+    # In backed mode, stream row blocks of data.X instead of loading it into memory
+    streaming = data.isbacked
+    if streaming:
+        X = data.X
+    else:
+        X = data.X if isinstance(data.X, csr_matrix) else data.X[:]
+        X.eliminate_zeros()  # In case there is any extra zeros
 
+    idx = None
     if subset is not None:
         # subset data for de analysis
         subset = np.array(subset.split(","))
@@ -710,71 +1042,61 @@ def de_analysis(
         cluster_labels = cluster_labels[idx]
         if cond_labels is not None:
             cond_labels = cond_labels[idx]
-        X = X[idx]
+        if not streaming:
+            X = X[idx]
 
     n_jobs = effective_n_jobs(n_jobs)
     gene_names = data.var_names
 
-    results = []
-    results.append(
-        collect_basic_statistics(
-            X, cluster_labels, cond_labels, gene_names, n_jobs, temp_folder, verbose
+    if streaming:
+        stats = collect_group_statistics_by_blocks(
+            X, idx, block_size, cluster_labels, cond_labels, verbose
         )
-    )
+    else:
+        stats = collect_group_statistics(X, cluster_labels, cond_labels, verbose)
+
+    if stats_key is not None and cond_labels is None and idx is None:
+        cache_cluster_statistics(data, cluster, cluster_labels, stats, stats_key)
 
-    Xc = None
+    results = []
+    results.append(collect_basic_statistics(stats, cluster_labels, gene_names, verbose))
+
+    ranks = None
     if auc or mwu:
-        t1 = time.time()
-        Xc = X.tocsc()
-        if verbose:
-            logger.info(
-                "Converting X to csc_matrix is done. Time spent = {:.2f}s.".format(
-                    time.time() - t1
+        if streaming:
+            ranks = collect_rank_statistics_by_blocks(
+                X, idx, block_size, stats, cluster_labels, cond_labels, n_jobs, verbose
+            )
+        else:
+            t1 = time.time()
+            Xc = X.tocsc()
+            if verbose:
+                logger.info(
+                    "Converting X to csc_matrix is done. Time spent = {:.2f}s.".format(
+                        time.time() - t1
+                    )
                 )
+            ranks = collect_rank_statistics(
+                Xc, stats, cluster_labels, cond_labels, n_jobs, verbose
             )
 
     if auc:
         results.append(
-            calculate_auc_values(
-                Xc,
-                cluster_labels,
-                cond_labels,
-                gene_names,
-                n_jobs,
-                temp_folder,
-                verbose,
-            )
+            calculate_auc_values(stats, ranks, cluster_labels, gene_names, verbose)
         )
 
     if t:
-        results.append(
-            t_test(
-                X, cluster_labels, cond_labels, gene_names, n_jobs, temp_folder, verbose
-            )
-        )
+        results.append(t_test(stats, cluster_labels, gene_names, verbose))
 
     if fisher:
-        results.append(
-            fisher_test(
-                X, cluster_labels, cond_labels, gene_names, n_jobs, temp_folder, verbose
-            )
-        )
+        results.append(fisher_test(stats, cluster_labels, gene_names, verbose))
 
     if mwu:
-        results.append(
-            mwu_test(
-                Xc,
-                cluster_labels,
-                cond_labels,
-                gene_names,
-                n_jobs,
-                temp_folder,
-                verbose,
-            )
-        )
+        results.append(mwu_test(stats, ranks, cluster_labels, gene_names, verbose))
 
-    df = organize_results(results)
-    data.varm[result_key] = df.to_records(index=False)
+    store_de_results(
+        data, result_key, organize_results(results, cluster_labels.categories)
+    )
 
     end = time.time()
     logger.info(
@@ -784,6 +1106,111 @@ def de_analysis(
     )
 
 
+def pairwise_de_analysis(
+    data: AnnData,
+    cluster: str,
+    pairs: List[Tuple[str, str]] = None,
+    result_key: str = "de_pairwise",
+    t: bool = True,
+    fisher: bool = False,
+    stats_key: str = "de_stats",
+    block_size: int = 100000,
+    verbose: bool = True,
+) -> None:
+    """Perform one-vs-one Differential Expression (DE) Analysis between pairs of clusters.
+
+    Per-cluster sums, sums of squares and nonzero counts are computed once and cached in ``data.uns[stats_key]`` (``de_analysis`` caches them too if given the same ``stats_key``). The cache is only reused if the cluster label of every cell, and the expression matrix unless it is backed, are unchanged. Every comparison is then derived from the cache in O(#genes) time without touching the expression matrix.
+
+    Parameters
+    ----------
+    data: ``anndata.AnnData``
+        Annotated data matrix with rows for cells and columns for genes.
+
+    cluster: ``str``
+        Cluster labels used in DE analysis. Must exist in ``data.obs``.
+
+    pairs: ``List[Tuple[str, str]]``, optional, default: ``None``
+        Pairs of cluster IDs ``(A, B)`` to compare, where ``A`` is treated as the cluster and ``B`` as the other. If ``None``, compare all pairs of clusters.
+
+    result_key: ``str``, optional, default: ``"de_pairwise"``
+        Key name of DE analysis result stored. Comparison ``A`` vs. ``B`` is stored under cluster ID ``"A_vs_B"``, so ``markers(data, de_key = result_key)`` works as usual.
+
+    t: ``bool``, optional, default: ``True``
+        If ``True``, calculate Welch's t test.
+
+    fisher: ``bool``, optional, default: ``False``
+        If ``True``, calculate Fisher's exact test.
+
+    stats_key: ``str``, optional, default: ``"de_stats"``
+        Key name in ``data.uns`` of cached per-cluster statistics. If ``None``, do not cache.
+
+    block_size: ``int``, optional, default: ``100000``
+        If ``data`` is in backed mode and statistics are not cached, read ``data.X`` ``block_size`` cells at a time.
+
+    verbose: ``bool``, optional, default: ``True``
+        If ``True``, show detailed intermediate output.
+
+    Returns
+    -------
+    ``None``
+
+    Update ``data.uns``:
+        ``data.uns[result_key]``: DE analysis result, see ``get_de_results``.
+
+    Update ``data.varm``:
+        ``data.varm[result_key]``: Deprecated record array view of the same result, see ``de_analysis``.
+
+    Examples
+    --------
+    >>> scc.pairwise_de_analysis(adata, cluster = 'louvain_labels', pairs = [('1', '3')])
+    """
+    start = time.time()
+
+    if cluster not in data.obs:
+        raise ValueError("Cannot find cluster label!")
+    if not isinstance(data.obs[cluster].values, pd.Categorical):
+        data.obs[cluster] = pd.Categorical(data.obs[cluster])
+
+    stats = get_cluster_statistics(data, cluster, stats_key, block_size, verbose)
+    categories = data.obs[cluster].cat.categories.values.astype(str)
+
+    if pairs is None:
+        pairs = [
+            (categories[i], categories[j])
+            for i in range(categories.size)
+            for j in range(i + 1, categories.size)
+        ]
+
+    cat2idx = {clust_id: i for i, clust_id in enumerate(categories)}
+    gene_names = data.var_names
+    results = [[], [], []]
+    for clust_a, clust_b in pairs:
+        if clust_a not in cat2idx or clust_b not in cat2idx:
+            raise ValueError(
+                "Cluster pair ({0}, {1}) does not exist!".format(clust_a, clust_b)
+            )
+        pair_id = "{0}_vs_{1}".format(clust_a, clust_b)
+        stat1 = stats.get_group(cat2idx[clust_a])
+        stat2 = stats.get_group(cat2idx[clust_b])
+        results[0].append(calc_basic_stat(pair_id, stat1, stat2, gene_names))
+        if t:
+            results[1].append(calc_t(pair_id, stat1, stat2, gene_names))
+        if fisher:
+            results[2].append(calc_fisher(pair_id, stat1, stat2, gene_names))
+
+    pair_ids = ["{0}_vs_{1}".format(clust_a, clust_b) for clust_a, clust_b in pairs]
+    store_de_results(
+        data, result_key, organize_results([x for x in results if len(x) > 0], pair_ids)
+    )
+
+    end = time.time()
+    logger.info(
+        "Pairwise differential expression analysis is finished. Time spent = {:.2f}s.".format(
+            end - start
+        )
+    )
+
+
 def get_valid_gene_index(n: int, df: pd.DataFrame, alpha: float) -> List[bool]:
     """ get genes that are DE for at least one test. If no DE tests, all genes are valid.
     """
@@ -809,6 +1236,42 @@ def get_sort_key(sort_by: List[str], col_names: List[str], direction: str):
     raise ValueError("No valid key!")
 
 
+def iter_markers(
+    data: AnnData,
+    head: int = None,
+    de_key: str = "de_res",
+    sort_by: str = "auroc,WAD_score",
+    alpha: float = 0.05,
+) -> Iterator[Tuple[str, str, pd.DataFrame]]:
+    """ Generate (cluster ID, 'up' or 'down', marker table) one table at a time, with clusters in natural order, directly from the DE result store. See markers for the parameters.
+    """
+    from natsort import natsorted
+
+    de_res = get_de_results(data, de_key)
+    sort_by = sort_by.split(",")
+    col_names = de_res.stats
+
+    for clust_id in natsorted(de_res.clusters):
+        df = de_res.get_cluster(clust_id, data.var_names)
+        df.index.name = "feature"
+
+        idx = get_valid_gene_index(data.shape[1], df, alpha)
+
+        idx_up = idx & (df["log_fold_change"].values > 0)
+        df_up = df.loc[idx_up].sort_values(
+            by=get_sort_key(sort_by, col_names, "up"), ascending=False, inplace=False
+        )
+        yield clust_id, "up", pd.DataFrame(df_up if head is None else df_up.iloc[0:head])
+
+        idx_down = idx & (df["log_fold_change"].values < 0)
+        df_down = df.loc[idx_down].sort_values(
+            by=get_sort_key(sort_by, col_names, "down"), ascending=True, inplace=False
+        )
+        yield clust_id, "down", pd.DataFrame(
+            df_down if head is None else df_down.iloc[0:head]
+        )
+
+
 def markers(
     data: AnnData,
     head: int = None,
@@ -827,7 +1290,7 @@ def markers(
         List only top ``head`` genes for each cluster. If ``None``, show any DE genes.
 
     de_key: ``str``, optional, default, ``de_res``
-        Keyword of DE result stored in ``data.varm``.
+        Keyword of DE result stored in ``data.uns``.
 
     sort_by: ``str``, optional, default: ``"auroc,WAD_score"``
         Sort the resulting marker dictionary by ``auroc`` and ``WAD_score``.
@@ -844,43 +1307,120 @@ def markers(
     --------
     >>> marker_dict = scc.markers(adata)
     """
-    if de_key not in data.varm.keys():
-        raise ValueError("Please run de_analysis first!")
+    results = defaultdict(dict)
+    for clust_id, direction, df in iter_markers(data, head, de_key, sort_by, alpha):
+        results[clust_id][direction] = df
 
-    sort_by = sort_by.split(",")
+    return results
 
-    clust2cols = defaultdict(list)
-    rec_array = data.varm[de_key]
-    for name in rec_array.dtype.names:
-        col_name, sep, clust_id = name.partition(":")
-        clust2cols[clust_id].append(col_name)
 
-    results = defaultdict(dict)
-    for clust_id, col_names in clust2cols.items():
-        rec_names = [x + ":" + clust_id for x in col_names]
-        df = pd.DataFrame(data=rec_array[rec_names], index=data.var_names)
-        df.columns = col_names
-        df.index.name = "feature"
+def round_marker_table(df: pd.DataFrame, ndigits: int) -> np.ndarray:
+    """ Return values of a marker table as float64, with all columns except p-values and q-values rounded to ndigits decimal points
+    """
+    values = df.values.astype(np.float64)
+    cols = [
+        i
+        for i, name in enumerate(df.columns)
+        if (not name.endswith("pval")) and (not name.endswith("qval"))
+    ]
+    values[:, cols] = values[:, cols].round(ndigits)
+    return values
+
+
+def write_markers_to_excel(
+    tables: Iterator[Tuple[str, str, pd.DataFrame]], output_file: str, ndigits: int
+) -> None:
+    """ Write marker tables row by row into an Excel workbook in constant memory mode, one worksheet per cluster and direction
+    """
+    import xlsxwriter
 
-        idx = get_valid_gene_index(data.shape[1], df, alpha)
+    workbook = xlsxwriter.Workbook(
+        output_file, {"constant_memory": True, "nan_inf_to_errors": True}
+    )
+    workbook.formats[0].set_font_size(9)
+    header_format = workbook.add_format({"bold": True, "font_size": 9})
+
+    for clust_id, direction, df in tables:
+        worksheet = workbook.add_worksheet(name=direction + " " + clust_id)
+        worksheet.write_row(0, 0, ["feature"] + list(df.columns), header_format)
+        values = round_marker_table(df, ndigits)
+        for i, (feature, row) in enumerate(zip(df.index, values.tolist())):
+            worksheet.write_string(i + 1, 0, feature)
+            worksheet.write_row(i + 1, 1, row)
+        worksheet.autofilter(0, 0, df.shape[0], df.shape[1])
+        worksheet.freeze_panes(1, 1)
 
-        idx_up = idx & (df["log_fold_change"].values > 0)
-        df_up = df.loc[idx_up].sort_values(
-            by=get_sort_key(sort_by, col_names, "up"), ascending=False, inplace=False
-        )
-        results[clust_id]["up"] = pd.DataFrame(
-            df_up if head is None else df_up.iloc[0:head]
-        )
+    workbook.close()
 
-        idx_down = idx & (df["log_fold_change"].values < 0)
-        df_down = df.loc[idx_down].sort_values(
-            by=get_sort_key(sort_by, col_names, "down"), ascending=True, inplace=False
+
+def iter_marker_frames(
+    tables: Iterator[Tuple[str, str, pd.DataFrame]], ndigits: int
+) -> Iterator[pd.DataFrame]:
+    """ Turn each marker table into a flat frame keyed by cluster and direction
+    """
+    for clust_id, direction, df in tables:
+        df_out = pd.DataFrame(
+            round_marker_table(df, ndigits), index=df.index, columns=df.columns
         )
-        results[clust_id]["down"] = pd.DataFrame(
-            df_down if head is None else df_down.iloc[0:head]
+        df_out.reset_index(inplace=True)
+        df_out.insert(0, "direction", direction)
+        df_out.insert(0, "cluster", clust_id)
+        yield df_out
+
+
+def write_markers_to_csv(
+    tables: Iterator[Tuple[str, str, pd.DataFrame]], output_file: str, ndigits: int
+) -> None:
+    """ Append marker tables one by one to a single CSV file with cluster and direction key columns
+    """
+    with open(output_file, "w") as fout:
+        header = True
+        for df in iter_marker_frames(tables, ndigits):
+            df.to_csv(fout, header=header, index=False)
+            header = False
+
+
+def write_markers_to_parquet(
+    tables: Iterator[Tuple[str, str, pd.DataFrame]], output_file: str, ndigits: int
+) -> None:
+    """ Write marker tables into a single Parquet file with cluster and direction key columns, one row group per cluster and direction
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    for df in iter_marker_frames(tables, ndigits):
+        if writer is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            writer = pq.ParquetWriter(output_file, schema)
+        writer.write_table(
+            pa.Table.from_pandas(df, schema=schema, preserve_index=False)
         )
+    if writer is not None:
+        writer.close()
 
-    return results
+
+def write_marker_tables(
+    tables: Iterator[Tuple[str, str, pd.DataFrame]], output_file: str, ndigits: int
+) -> None:
+    """ Stream marker tables to output_file. The format is chosen by suffix: .csv, .parquet, or an Excel workbook otherwise.
+    """
+    start = time.time()
+
+    suffix = output_file.rpartition(".")[2].lower()
+    if suffix == "csv":
+        write_markers_to_csv(tables, output_file, ndigits)
+    elif suffix == "parquet":
+        write_markers_to_parquet(tables, output_file, ndigits)
+    else:
+        write_markers_to_excel(tables, output_file, ndigits)
+
+    end = time.time()
+    logger.info(
+        "Marker file {} is written. Time spent = {:.2f}s.".format(
+            output_file, end - start
+        )
+    )
 
 
 def write_results_to_excel(
@@ -909,64 +1449,63 @@ def write_results_to_excel(
     --------
     >>> scc.write_results_to_excel(marker_dict, "result.de.xlsx")
     """
-    start = time.time()
-
-    import xlsxwriter
     from natsort import natsorted
 
-    def format_short_output_cols(
-        df_orig: pd.DataFrame, ndigits: int = 3
-    ) -> pd.DataFrame:
-        """ Round related float columns to ndigits decimal points.
-        """
-        df = pd.DataFrame(df_orig)
+    write_markers_to_excel(
+        (
+            (clust_id, direction, results[clust_id][direction])
+            for clust_id in natsorted(results.keys())
+            for direction in ["up", "down"]
+        ),
+        output_file,
+        ndigits,
+    )
 
-        cols = []
-        for name in df.columns:
-            if (not name.endswith("pval")) and (not name.endswith("qval")):
-                cols.append(name)
 
-        df.loc[:, cols] = df.loc[:, cols].round(ndigits)
-        return df
+def write_markers(
+    data: AnnData,
+    output_file: str,
+    de_key: str = "de_res",
+    head: int = None,
+    sort_by: str = "auroc,WAD_score",
+    alpha: float = 0.05,
+    ndigits: int = 3,
+) -> None:
+    """ Stream DE markers of every cluster from the DE results to a file, without building the marker tables of all clusters at once.
 
-    def add_worksheet(
-        workbook: "workbook", df_orig: pd.DataFrame, sheet_name: str
-    ) -> None:
-        """ Add one worksheet with content as df
-        """
-        df = format_short_output_cols(df_orig)
-        df.reset_index(inplace=True)
-        worksheet = workbook.add_worksheet(name=sheet_name)
-
-        worksheet.add_table(
-            0,
-            0,
-            df.index.size,
-            df.columns.size - 1,
-            {
-                "data": df.to_numpy(),
-                "style": "Table Style Light 1",
-                "first_column": True,
-                "header_row": True,
-                "columns": [{"header": x} for x in df.columns.values],
-            },
-        )
-        # if df.shape[0] > 0:
-        # else:
-        #     worksheet.write_row(0, 0, df.columns.values)
+    Parameters
+    ----------
+    data: ``anndata.AnnData``
+        Annotated data matrix with DE analysis results.
 
-    workbook = xlsxwriter.Workbook(output_file, {"nan_inf_to_errors": True})
-    workbook.formats[0].set_font_size(9)
+    output_file: ``str``
+        Output file name. If it ends with ``.csv`` or ``.parquet``, write one CSV or Parquet file with ``cluster`` and ``direction`` key columns (in Parquet, every cluster and direction is one row group). Otherwise, write an Excel workbook with one worksheet per cluster and direction.
 
-    for clust_id in natsorted(results.keys()):
-        add_worksheet(workbook, results[clust_id]["up"], "up " + clust_id)
-        add_worksheet(workbook, results[clust_id]["down"], "down " + clust_id)
+    de_key: ``str``, optional, default: ``"de_res"``
+        Keyword of DE result stored in ``data.uns``.
 
-    workbook.close()
+    head: ``int``, optional, default: ``None``
+        List only top ``head`` genes for each cluster. If ``None``, show any DE genes.
 
-    end = time.time()
-    logger.info(
-        "Excel spreadsheet is written. Time spent = {:.2f}s.".format(end - start)
+    sort_by: ``str``, optional, default: ``"auroc,WAD_score"``
+        Sort markers by ``auroc`` and ``WAD_score``.
+
+    alpha: ``float``, optional, default: ``0.05``
+        q-value threshold for getting valid DE genes.
+
+    ndigits: ``int``, optional, default: ``3``
+        Round non p-values and q-values to ``ndigits`` after decimal point.
+
+    Returns
+    -------
+    ``None``
+
+    Examples
+    --------
+    >>> scc.write_markers(adata, "result.de.parquet")
+    """
+    write_marker_tables(
+        iter_markers(data, head, de_key, sort_by, alpha), output_file, ndigits
     )
 
 
@@ -984,6 +1523,7 @@ def run_de_analysis(
     verbose: bool = True,
     alpha: float = 0.05,
     ndigits: int = 3,
+    block_size: int = 100000,
 ) -> None:
     """ For command line only
     """
@@ -1004,18 +1544,23 @@ def run_de_analysis(
         mwu=mwu,
         temp_folder=temp_folder,
         verbose=verbose,
+        block_size=block_size,
     )
 
-    write_output(data, input_file, whitelist=["varm/{}".format(result_key)])
+    write_output(
+        data,
+        input_file,
+        whitelist=["uns/{}".format(result_key), "varm/{}".format(result_key)],
+    )
     logger.info(
-        "Differential expression results are written to varm/{} in h5ad file.".format(
+        "Differential expression results are written to uns/{0} and varm/{0} in h5ad file.".format(
             result_key
         )
     )
 
-    results = markers(data, de_key=result_key, alpha=alpha)
-
-    write_results_to_excel(results, output_excel_file, ndigits=ndigits)
+    write_markers(
+        data, output_excel_file, de_key=result_key, alpha=alpha, ndigits=ndigits
+    )
 
     end = time.time()
     logger.info("run_de_analysis is finished in {:.2f}s.".format(end - start))
@@ -19,9 +19,9 @@ logger = logging.getLogger("sccloud")
 def calculate_normalized_affinity(
     W: "csr_matrix"
 ) -> Tuple["csr_matrix", "np.array", "np.array"]:
-    diag = W.sum(axis=1).A1
+    W_norm = W.tocoo().astype(np.float64)  # eigen decomposition needs double precision
+    diag = W_norm.sum(axis=1).A1
     diag_half = np.sqrt(diag)
-    W_norm = W.tocoo(copy=True)
     W_norm.data /= diag_half[W_norm.row]
     W_norm.data /= diag_half[W_norm.col]
     W_norm = W_norm.tocsr()
@@ -14,6 +14,7 @@ from sklearn.cluster import KMeans
 from lightgbm import LGBMClassifier
 
 from sccloud.io import read_input
+from sccloud.tools import get_de_results
 
 import logging
 
@@ -40,7 +41,7 @@ def find_markers(
         Cluster labels used for finding markers. Must exist in ``data.obs``.
 
     de_key: ``str``, optional, default: ``"de_res"``
-        Keyword of DE analysis result stored in ``data.varm``.
+        Keyword of DE analysis result stored in ``data.uns``.
 
     n_jobs: ``int``, optional, default: ``-1``
         Number of threads to used. If ``-1``, use all available threads.
@@ -104,10 +105,8 @@ def find_markers(
     ntot = (lgb.feature_importances_ >= min_gain).sum()
     ords = np.argsort(lgb.feature_importances_)[::-1][:ntot]
 
-    log_exprs = [
-        x for x in data.varm[de_key].dtype.names if x.startswith("mean_logExpr:")
-    ]
-    labels = [x.rpartition(":")[2] for x in log_exprs]
+    log_exprs = get_de_results(data, de_key).get_stat("mean_logExpr", data.var_names)
+    labels = log_exprs.columns
 
     titles = [("down", "down_gain"), ("weak", "weak_gain"), ("strong", "strong_gain")]
     markers = defaultdict(lambda: defaultdict(list))
@@ -115,7 +114,7 @@ def find_markers(
     kmeans = KMeans(n_clusters=3, random_state=random_state)
     for gene_id in ords:
         gene_symbol = data.var_names[gene_id]
-        mydat = [[x] for x in data.varm[de_key][log_exprs][gene_id]]
+        mydat = [[x] for x in log_exprs.values[gene_id]]
         kmeans.fit(mydat)
         kmeans_label_mode = pd.Series(kmeans.labels_).mode()[0]
         for i, kmeans_label in enumerate(np.argsort(kmeans.cluster_centers_[:, 0])):
@@ -2,7 +2,7 @@ import time
 import numpy as np
 import pandas as pd
 
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from collections import defaultdict
 from joblib import Parallel, delayed
 import skmisc.loess as sl
@@ -10,6 +10,8 @@ from typing import List
 from anndata import AnnData
 import logging
 
+from sccloud.tools import calc_group_sums
+
 logger = logging.getLogger("sccloud")
 
 
@@ -32,28 +34,29 @@ def estimate_feature_statistics(data: AnnData, consider_batch: bool) -> None:
         channels = data.uns["Channels"]
         groups = data.uns["Groups"]
 
-        ncells = np.zeros(channels.size)
-        means = np.zeros((data.shape[1], channels.size))
-        partial_sum = np.zeros((data.shape[1], channels.size))
-
-        group_dict = defaultdict(list)
-        for i, channel in enumerate(channels):
-            idx = np.isin(data.obs["Channel"], channel)
-            mat = data.X[idx].astype(np.float64)
-            ncells[i] = mat.shape[0]
-
-            if ncells[i] == 0:
-                continue
+        # One sweep over the matrix accumulates sums and sums of squares of all channels
+        X = csr_matrix(data.X)
+        codes = pd.Categorical(
+            data.obs["Channel"], categories=np.asarray(channels)
+        ).codes.astype(np.int64)
+        sums, sum2s, _ = calc_group_sums(
+            X.data, X.indices, X.indptr, codes, channels.size, data.shape[1]
+        )
+        ncells = np.bincount(codes[codes >= 0], minlength=channels.size).astype(
+            np.float64
+        )
 
-            if ncells[i] == 1:
-                means[:, i] = mat.toarray()[0]
-            else:
-                means[:, i] = mat.mean(axis=0).A1
-                m2 = mat.power(2).sum(axis=0).A1
-                partial_sum[:, i] = m2 - ncells[i] * (means[:, i] ** 2)
+        means = (sums[:-1] / np.maximum(ncells, 1.0)[:, np.newaxis]).T
+        partial_sum = (sum2s[:-1] - ncells[:, np.newaxis] * (means.T ** 2)).T
+        partial_sum[:, ncells < 2] = 0.0
 
-            group = data.obs["Group"][idx.nonzero()[0][0]]
-            group_dict[group].append(i)
+        group_dict = defaultdict(list)
+        cell_groups = data.obs["Group"].values
+        _, first_cells = np.unique(codes, return_index=True)
+        first_cells = dict(zip(codes[first_cells], first_cells))
+        for i in range(channels.size):
+            if ncells[i] > 0:
+                group_dict[cell_groups[first_cells[i]]].append(i)
 
         partial_sum[partial_sum < 1e-6] = 0.0
 
@@ -98,9 +101,12 @@ def estimate_feature_statistics(data: AnnData, consider_batch: bool) -> None:
             )
         )
     else:
-        mean = data.X.mean(axis=0).A1
-        m2 = data.X.power(2).sum(axis=0).A1
-        var = (m2 - data.X.shape[0] * (mean ** 2)) / (data.X.shape[0] - 1)
+        X = csr_matrix(data.X)
+        sums, sum2s, _ = calc_group_sums(
+            X.data, X.indices, X.indptr, np.zeros(X.shape[0], dtype=np.int64), 1, X.shape[1]
+        )
+        mean = sums[0] / X.shape[0]
+        var = (sum2s[0] - X.shape[0] * (mean ** 2)) / (X.shape[0] - 1)
 
         data.var["mean"] = mean
         data.var["var"] = var
@@ -1,20 +1,60 @@
+import os
 import time
 import numpy as np
 import pandas as pd
 import logging
 
+from numba import njit
 from scipy.sparse import issparse, csr_matrix
 from scipy.stats import chi2
 from sklearn.neighbors import NearestNeighbors
 from anndata import AnnData
 from joblib import effective_n_jobs
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Union
 
-from sccloud.tools import update_rep, X_from_rep, knn_is_cached
+from sccloud.tools import (
+    update_rep,
+    X_from_rep,
+    W_from_rep,
+    calc_fingerprint,
+    knn_cache,
+)
 
 logger = logging.getLogger("sccloud")
 
 
+def build_hnsw_index(
+    X: np.array,
+    M: int = 20,
+    efC: int = 200,
+    random_state: int = 0,
+    n_jobs: int = 1,
+    full_speed: bool = False,
+) -> "hnswlib.Index":
+    """Build an hnsw index on rows of X. Only one thread is used unless full_speed, so that the index is reproducible."""
+    import hnswlib
+
+    assert not issparse(X)
+    knn_index = hnswlib.Index(space="l2", dim=X.shape[1])
+    knn_index.init_index(
+        max_elements=X.shape[0], ef_construction=efC, M=M, random_seed=random_state
+    )
+    knn_index.set_num_threads(n_jobs if full_speed else 1)
+    knn_index.add_items(X)
+    return knn_index
+
+
+def query_hnsw_index(
+    knn_index: "hnswlib.Index", X: np.array, K: int, efS: int = 200, n_jobs: int = 1
+) -> Tuple[np.array, np.array]:
+    """Return indices and L2 distances of the K nearest indexed points for each row of X."""
+    knn_index.set_ef(max(efS, K))  # hnswlib requires ef >= K
+    knn_index.set_num_threads(n_jobs)
+    indices, distances = knn_index.knn_query(X, k=K)
+    np.sqrt(distances, out=distances)
+    return indices, distances
+
+
 def calculate_nearest_neighbors(
     X: np.array,
     K: int = 100,
@@ -25,11 +65,17 @@ def calculate_nearest_neighbors(
     efS: int = 200,
     random_state: int = 0,
     full_speed: int = False,
+    return_index: bool = False,
+    shard_size: int = None,
+    output_folder: str = None,
 ):
     """Calculate nearest neighbors
-    X is the sample by feature matrix
-    Return K -1 neighbors, the first one is the point itself and thus omitted.
-    TODO: Documentation
+    X is the sample by feature matrix, dense or sparse (e.g. data.X when rep is None).
+    Return K -1 neighbors, the first one is the point itself and thus omitted: an int32 indices matrix and a float32 L2 distances matrix, both of shape (nsample, K - 1) with rows sorted from nearest to farthest, whatever the search method and the dtype of X.
+    Data sets of at most 1000 points, and sparse X, are searched exactly with sklearn. A sparse X is converted to float32 CSR and searched by brute force without being densified, so hnsw parameters and shard_size do not apply to it.
+    If return_index, also return the hnsw index (None if sklearn is used or the search is sharded).
+    If shard_size is set (non-zero) and X has more rows, build one hnsw index per shard of at most shard_size rows instead of a single index; see calculate_nearest_neighbors_by_shards. If shard_size is 0, a single index is built.
+    If shard_size is None, it defaults to get_reproducible_shard_size(nsample) unless full_speed, and to 0 otherwise. Sharded results depend on shard_size and random_state but not on the number of threads, so large indices are built in parallel without giving up reproducibility.
     """
 
     nsample = X.shape[0]
@@ -37,6 +83,11 @@ def calculate_nearest_neighbors(
     if nsample <= 1000:
         method = "sklearn"
 
+    if issparse(X):
+        # hnsw needs dense vectors; search CSR input exactly in chunks of sparse-dense distance blocks instead of densifying it
+        method = "sklearn"
+        X = csr_matrix(X, dtype=np.float32)
+
     if nsample < K:
         logger.warning(
             "Warning: in calculate_nearest_neighbors, number of samples = {} < K = {}!\n Set K to {}.".format(
@@ -47,40 +98,289 @@ def calculate_nearest_neighbors(
 
     n_jobs = effective_n_jobs(n_jobs)
 
-    if method == "hnsw":
-        import hnswlib
+    if shard_size is None:
+        shard_size = get_default_shard_size(nsample, full_speed)
 
-        assert not issparse(X)
-        # Build hnsw index
-        knn_index = hnswlib.Index(space="l2", dim=X.shape[1])
-        knn_index.init_index(
-            max_elements=nsample, ef_construction=efC, M=M, random_seed=random_state
+    knn_index = None
+    if method == "hnsw" and shard_size and nsample > shard_size:
+        indices, distances = calculate_nearest_neighbors_by_shards(
+            X,
+            K=K,
+            shard_size=shard_size,
+            n_jobs=n_jobs,
+            M=M,
+            efC=efC,
+            efS=efS,
+            random_state=random_state,
+            full_speed=full_speed,
+            output_folder=output_folder,
         )
-        knn_index.set_num_threads(n_jobs if full_speed else 1)
-        knn_index.add_items(X)
-
-        # KNN query
-        knn_index.set_ef(efS)
-        knn_index.set_num_threads(n_jobs)
-        indices, distances = knn_index.knn_query(X, k=K)
-        # eliminate the first neighbor, which is the node itself
-        for i in range(nsample):
-            if indices[i, 0] != i:
-                indices[i, 1:] = indices[i, 0:-1]
-                distances[i, 1:] = distances[i, 0:-1]
-        indices = indices[:, 1:].astype(int)
-        distances = np.sqrt(distances[:, 1:])
+    elif method == "hnsw":
+        knn_index = build_hnsw_index(
+            X,
+            M=M,
+            efC=efC,
+            random_state=random_state,
+            n_jobs=n_jobs,
+            full_speed=full_speed,
+        )
+        indices, distances = query_hnsw_index(knn_index, X, K, efS=efS, n_jobs=n_jobs)
+        indices, distances = remove_self_neighbors(indices, distances)
     else:
         assert method == "sklearn"
         knn = NearestNeighbors(
-            n_neighbors=K - 1, n_jobs=n_jobs
+            n_neighbors=K - 1,
+            algorithm="brute" if issparse(X) else "auto",
+            n_jobs=n_jobs,
         )  # eliminate the first neighbor, which is the node itself
         knn.fit(X)
         distances, indices = knn.kneighbors()
 
+    indices = indices.astype(np.int32, copy=False)
+    distances = distances.astype(np.float32, copy=False)
+
+    if return_index:
+        return indices, distances, knn_index
+    return indices, distances
+
+
+def get_reproducible_shard_size(nsample: int, min_shard_size: int = 100000) -> int:
+    """Suggest a shard size for building the indices of nsample points in parallel without giving up reproducibility, or None if one single-threaded index is preferable. It is the default shard_size unless full_speed.
+    Every shard adds one query per point, so the number of shards grows with the square root of nsample: 1 below 4 x min_shard_size, 3 at 1M points and 14 at 20M points. It does not depend on the number of threads, so results do not either.
+    """
+    n_shards = int(np.sqrt(nsample / min_shard_size))
+    if n_shards <= 1:
+        return None
+    return (nsample + n_shards - 1) // n_shards
+
+
+def get_default_shard_size(nsample: int, full_speed: bool) -> int:
+    """Shard size used if none is given: a reproducible one unless full_speed, which builds one multi-threaded index instead; 0 means a single index."""
+    shard_size = None if full_speed else get_reproducible_shard_size(nsample)
+    return 0 if shard_size is None else shard_size
+
+
+def build_shard_index(
+    X_shard: np.array,
+    index_file: str,
+    M: int,
+    efC: int,
+    random_state: int,
+    n_threads: int,
+) -> None:
+    """Build the hnsw index of one shard and save it to index_file."""
+    knn_index = build_hnsw_index(
+        X_shard,
+        M=M,
+        efC=efC,
+        random_state=random_state,
+        n_jobs=n_threads,
+        full_speed=n_threads > 1,
+    )
+    knn_index.save_index(index_file)
+
+
+def merge_top_neighbors(
+    indices: np.array, distances: np.array, K: int
+) -> Tuple[np.array, np.array]:
+    """Keep the K closest of the candidate neighbors in each row. Ties are broken by column order, which keeps the merge deterministic."""
+    order = np.argsort(distances, axis=1, kind="stable")[:, 0:K]
+    return (
+        np.take_along_axis(indices, order, axis=1),
+        np.take_along_axis(distances, order, axis=1),
+    )
+
+
+def calculate_nearest_neighbors_by_shards(
+    X: np.array,
+    K: int = 100,
+    shard_size: int = 1000000,
+    n_jobs: int = -1,
+    M: int = 20,
+    efC: int = 200,
+    efS: int = 200,
+    random_state: int = 0,
+    full_speed: bool = False,
+    block_size: int = 100000,
+    output_folder: str = None,
+    temp_folder: str = None,
+) -> Tuple[np.array, np.array]:
+    """Calculate K - 1 nearest neighbors of each row of X with one hnsw index per shard of at most shard_size rows, so that no index over all rows is ever held in memory.
+    Shard indices are built in parallel worker processes and saved to disk. Each shard index is then loaded in turn and queried by every row, block_size rows at a time; the running top K of each row is merged with the shard's top K and kept in memory-mapped files.
+    X can itself be a memory-mapped array. If output_folder is set, return memory-mapped knn_indices.npy and knn_distances.npy files written there; otherwise load the results into memory and remove all intermediate files.
+    """
+    import shutil
+    import tempfile
+    from joblib import Parallel, delayed
+
+    nsample = X.shape[0]
+    n_jobs = effective_n_jobs(n_jobs)
+    n_shards = (nsample + shard_size - 1) // shard_size
+    starts = np.linspace(0, nsample, n_shards + 1).astype(int)
+    work_folder = tempfile.mkdtemp(prefix="sccloud_knn_", dir=temp_folder)
+
+    try:
+        # Build shard indices in parallel, each single-threaded unless full_speed
+        start = time.time()
+        index_files = [
+            os.path.join(work_folder, "shard_{}.hnsw".format(i)) for i in range(n_shards)
+        ]
+        n_workers = min(n_jobs, n_shards)
+        n_threads = max(n_jobs // n_workers, 1) if full_speed else 1
+        Parallel(n_jobs=n_workers, temp_folder=work_folder)(
+            delayed(build_shard_index)(
+                X[starts[i] : starts[i + 1]],
+                index_files[i],
+                M,
+                efC,
+                random_state,
+                n_threads,
+            )
+            for i in range(n_shards)
+        )
+        logger.info(
+            "{} shard indices are built. Time spent = {:.2f}s.".format(
+                n_shards, time.time() - start
+            )
+        )
+
+        # Query every shard and merge the per-shard top K into the running top K
+        start = time.time()
+        import hnswlib
+
+        best_indices = np.lib.format.open_memmap(
+            os.path.join(work_folder, "best_indices.npy"),
+            mode="w+",
+            dtype=np.int32,
+            shape=(nsample, K),
+        )
+        best_distances = np.lib.format.open_memmap(
+            os.path.join(work_folder, "best_distances.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(nsample, K),
+        )
+        best_indices[:] = -1
+        best_distances[:] = np.inf
+
+        for i in range(n_shards):
+            knn_index = hnswlib.Index(space="l2", dim=X.shape[1])
+            knn_index.load_index(index_files[i])
+            k = min(K, starts[i + 1] - starts[i])
+            for fr in range(0, nsample, block_size):
+                to = min(fr + block_size, nsample)
+                shard_indices, shard_distances = query_hnsw_index(
+                    knn_index, X[fr:to], k, efS=efS, n_jobs=n_jobs
+                )
+                (
+                    best_indices[fr:to],
+                    best_distances[fr:to],
+                ) = merge_top_neighbors(
+                    np.concatenate(
+                        (
+                            best_indices[fr:to],
+                            shard_indices.astype(np.int32) + starts[i],
+                        ),
+                        axis=1,
+                    ),
+                    np.concatenate((best_distances[fr:to], shard_distances), axis=1),
+                    K,
+                )
+            del knn_index
+        logger.info(
+            "Shard queries are merged. Time spent = {:.2f}s.".format(
+                time.time() - start
+            )
+        )
+
+        # Eliminate each point from its own neighbors
+        if output_folder is not None:
+            os.makedirs(output_folder, exist_ok=True)
+            indices = np.lib.format.open_memmap(
+                os.path.join(output_folder, "knn_indices.npy"),
+                mode="w+",
+                dtype=np.int32,
+                shape=(nsample, K - 1),
+            )
+            distances = np.lib.format.open_memmap(
+                os.path.join(output_folder, "knn_distances.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(nsample, K - 1),
+            )
+        else:
+            indices = np.empty((nsample, K - 1), dtype=np.int32)
+            distances = np.empty((nsample, K - 1), dtype=np.float32)
+
+        for fr in range(0, nsample, block_size):
+            to = min(fr + block_size, nsample)
+            block_indices, block_distances = remove_self_neighbors(
+                best_indices[fr:to] - np.int32(fr), best_distances[fr:to]
+            )
+            indices[fr:to] = block_indices + np.int32(fr)
+            distances[fr:to] = block_distances
+        del best_indices, best_distances
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
     return indices, distances
 
 
+def remove_self_neighbors(
+    indices: np.array, distances: np.array
+) -> Tuple[np.array, np.array]:
+    """Remove each point from its own neighbor list; if the point is missing, drop the farthest neighbor instead."""
+    nsample, K = indices.shape
+    is_self = indices == np.arange(nsample, dtype=indices.dtype).reshape(-1, 1)
+    is_self[~is_self.any(axis=1), K - 1] = True
+    keep = ~is_self
+    return (
+        indices[keep].reshape(nsample, K - 1),
+        distances[keep].reshape(nsample, K - 1),
+    )
+
+
+def save_knn_index(
+    data: AnnData, rep: str, knn_index: "hnswlib.Index", index_file: str, params: dict
+) -> None:
+    """Serialize knn_index into index_file and record the file, its M/efC/efS/random_state parameters and the fingerprint of rep in data.uns[rep + '_knn_index']."""
+    knn_index.save_index(index_file)
+    record = dict(params)
+    record["file"] = index_file
+    record["fingerprint"] = calc_fingerprint(X_from_rep(data, rep, dense=False))
+    data.uns[rep + "_knn_index"] = record
+    logger.info("hnsw index is saved to {}.".format(index_file))
+
+
+def load_knn_index(data: AnnData, rep: str) -> Tuple["hnswlib.Index", dict]:
+    """Load the hnsw index recorded for rep. Return (None, None) if there is none or it no longer matches the representation."""
+    key = rep + "_knn_index"
+    if key not in data.uns:
+        return None, None
+
+    params = data.uns[key]
+    index_file = str(params["file"])
+    if not os.path.isfile(index_file):
+        logger.warning("Warning: cannot find saved hnsw index {}!".format(index_file))
+        return None, None
+
+    X = X_from_rep(data, rep, dense=False)
+    if str(params["fingerprint"]) != calc_fingerprint(X):
+        logger.warning(
+            "Warning: saved hnsw index {} does not match {} and is ignored!".format(
+                index_file, rep
+            )
+        )
+        return None, None
+
+    import hnswlib
+
+    knn_index = hnswlib.Index(space="l2", dim=X.shape[1])
+    knn_index.load_index(index_file, max_elements=X.shape[0])
+
+    return knn_index, params
+
+
 def get_neighbors(
     data: AnnData,
     K: int = 100,
@@ -88,6 +388,12 @@ def get_neighbors(
     n_jobs: int = -1,
     random_state: int = 0,
     full_speed: bool = False,
+    index_file: str = None,
+    M: int = 20,
+    efC: int = 200,
+    efS: int = 200,
+    shard_size: int = None,
+    output_folder: str = None,
 ) -> Tuple[List[int], List[float]]:
     """Find K nearest neighbors for each data point and return the indices and distances arrays.
 
@@ -106,6 +412,14 @@ def get_neighbors(
         Random seed for random number generator.
     full_speed: `bool`, optional (default: False)
         If full_speed, use multiple threads in constructing hnsw index. However, the kNN results are not reproducible. If not full_speed, use only one thread to make sure results are reproducible.
+    index_file: `str`, optional (default: None)
+        If not None and a new hnsw index is built, save it to this file and record it in data.uns[rep + '_knn_index']. A recorded index is reused instead of rebuilt when more neighbors than cached are requested.
+    M, efC, efS: `int`, optional (default: 20, 200, 200)
+        hnsw parameters: number of links per node, and search depth used at construction and at query time.
+    shard_size: `int`, optional (default: None)
+        If non-zero and there are more data points, build one hnsw index per shard of at most shard_size points and merge the per-shard neighbors, so that no single index over all points is held in memory. If 0, build a single index. If None, use get_reproducible_shard_size unless full_speed, and build a single index otherwise.
+    output_folder: `str`, optional (default: None)
+        Only used with shard_size. If not None, stream the kNN arrays to memory-mapped files in this folder instead of loading them into memory.
 
     Returns
     -------
@@ -118,38 +432,416 @@ def get_neighbors(
     """
 
     rep = update_rep(rep)
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
+    if shard_size is None:
+        shard_size = get_default_shard_size(data.shape[0], full_speed)
+    params = {"M": M, "efC": efC, "efS": efS, "random_state": random_state}
 
-    if knn_is_cached(data, indices_key, distances_key, K):
-        indices = data.uns[indices_key]
-        distances = data.uns[distances_key]
+    indices, distances = knn_cache.lookup(data, rep, K, params)
+    if indices is not None:
         logger.info("Found cached kNN results, no calculation is required.")
+        return indices, distances
+
+    n_jobs = effective_n_jobs(n_jobs)
+    knn_index, index_params = load_knn_index(data, rep)
+    if knn_index is not None and all(
+        index_params[key] == params[key] for key in ["M", "efC", "random_state"]
+    ) and shard_size == 0:
+        K = min(K, data.shape[0])
+        indices, distances = query_hnsw_index(
+            knn_index, X_from_rep(data, rep), K, efS=efS, n_jobs=n_jobs
+        )
+        indices, distances = remove_self_neighbors(indices, distances)
+        indices = indices.astype(np.int32, copy=False)
+        logger.info("Found saved hnsw index, no index construction is required.")
     else:
-        indices, distances = calculate_nearest_neighbors(
-            X_from_rep(data, rep),
+        indices, distances, knn_index = calculate_nearest_neighbors(
+            X_from_rep(data, rep, dense=False),
             K=K,
-            n_jobs=effective_n_jobs(n_jobs),
+            n_jobs=n_jobs,
+            M=M,
+            efC=efC,
+            efS=efS,
             random_state=random_state,
             full_speed=full_speed,
+            return_index=True,
+            shard_size=shard_size,
+            output_folder=output_folder,
         )
-        data.uns[indices_key] = indices
-        data.uns[distances_key] = distances
+        if index_file is not None:
+            if knn_index is not None:
+                save_knn_index(data, rep, knn_index, index_file, params)
+            else:
+                logger.warning(
+                    "Warning: kNN were not calculated from a single hnsw index, {} is not saved!".format(
+                        index_file
+                    )
+                )
+
+    knn_cache.store(data, rep, indices, distances, params)
 
     return indices, distances
 
 
-def get_symmetric_matrix(csr_mat: "csr_matrix") -> "csr_matrix":
-    tp_mat = csr_mat.transpose().tocsr()
-    sym_mat = csr_mat + tp_mat
-    sym_mat.sort_indices()
+def query_neighbors(
+    data: AnnData, X: np.array, K: int = 100, rep: str = "pca", n_jobs: int = -1
+) -> Tuple[np.array, np.array]:
+    """Find the K nearest cells of ``data`` for each external point, reusing the hnsw index saved by ``neighbors``.
+
+    Parameters
+    ----------
+
+    data: ``anndata.AnnData``
+        Annotated data matrix with an hnsw index saved by ``neighbors(..., index_file = ...)``.
+
+    X: ``numpy.ndarray``
+        Query points, in the same coordinates as ``data.obsm['X_' + rep]``.
+
+    K: ``int``, optional, default: ``100``
+        Number of neighbors to return for each query point.
+
+    rep: ``str``, optional, default: ``"pca"``
+        Embedding representation the index was built on.
+
+    n_jobs: ``int``, optional, default: ``-1``
+        Number of threads to use. If ``-1``, use all available threads.
+
+    Returns
+    -------
+    indices: ``numpy.ndarray``
+        ``int32`` matrix. Row i is the indices of the K cells in ``data`` nearest to query point i, sorted from nearest to farthest.
+
+    distances: ``numpy.ndarray``
+        ``float32`` matrix of the corresponding L2 distances.
+
+    Examples
+    --------
+    >>> indices, distances = scc.query_neighbors(adata, new_cells.obsm['X_pca'], K = 30)
+    """
+    rep = update_rep(rep)
+    knn_index, params = load_knn_index(data, rep)
+    if knn_index is None:
+        raise ValueError(
+            "Cannot find a saved hnsw index for {}. Please run neighbors with index_file first!".format(
+                rep
+            )
+        )
+    indices, distances = query_hnsw_index(
+        knn_index, X, K, efS=int(params["efS"]), n_jobs=effective_n_jobs(n_jobs)
+    )
+    return indices.astype(np.int32), distances
+
+
+def benchmark_nearest_neighbors(
+    X: np.array,
+    K: int = 100,
+    M: List[int] = [20],
+    efC: List[int] = [200],
+    efS: List[int] = [200],
+    n_jobs: List[int] = [1],
+    n_queries: int = 1000,
+    check_reproducibility: bool = False,
+    random_state: int = 0,
+) -> pd.DataFrame:
+    """Measure recall and cost of hnsw kNN search over a grid of parameters.
+
+    Exact neighbors of ``n_queries`` randomly sampled points are computed with sklearn, the same fallback ``calculate_nearest_neighbors`` uses on small data. Then one hnsw index is built and queried for every combination of ``M``, ``efC``, ``efS`` and ``n_jobs``.
+
+    Parameters
+    ----------
+
+    X: ``numpy.ndarray``
+        Sample by feature matrix, e.g. ``data.obsm['X_pca']``.
+
+    K: ``int``, optional, default: ``100``
+        Number of neighbors, including the data point itself.
+
+    M, efC, efS: ``List[int]``, optional, default: ``[20]``, ``[200]``, ``[200]``
+        hnsw parameters to try: number of links per node, and search depth used at construction and at query time.
+
+    n_jobs: ``List[int]``, optional, default: ``[1]``
+        Thread counts to try. More than one thread builds the index at full speed, i.e. not reproducibly.
 
-    idx_mat = (csr_mat != 0).astype(int) + (tp_mat != 0).astype(int)
-    idx_mat.sort_indices()
-    idx = idx_mat.data == 2
+    n_queries: ``int``, optional, default: ``1000``
+        Number of sampled query points.
 
-    sym_mat.data[idx] /= 2.0
-    return sym_mat
+    check_reproducibility: ``bool``, optional, default: ``False``
+        If ``True``, build every index twice and report the fraction of query points with identical neighbor lists.
+
+    random_state: ``int``, optional, default: ``0``
+        Random seed used for sampling query points and building indices.
+
+    Returns
+    -------
+    ``pandas.DataFrame``
+        One row per parameter combination with columns ``n_cells``, ``n_dims``, ``K``, ``M``, ``efC``, ``efS``, ``n_jobs``, ``build_time``, ``query_time`` (seconds for all sampled queries), ``queries_per_sec``, ``recall`` (mean recall@K), ``index_size_mb`` and, if requested, ``reproducibility``.
+
+    Examples
+    --------
+    >>> df = scc.benchmark_nearest_neighbors(adata.obsm['X_pca'], M = [10, 20, 40], efS = [50, 100, 200], n_jobs = [1, 8])
+    """
+    import tempfile
+
+    nsample = X.shape[0]
+    K = min(K, nsample)
+    np.random.seed(random_state)
+    queries = np.sort(
+        np.random.choice(nsample, size=min(n_queries, nsample), replace=False)
+    )
+    X_query = X[queries]
+
+    start = time.time()
+    exact = NearestNeighbors(n_neighbors=K, n_jobs=effective_n_jobs(max(n_jobs)))
+    exact.fit(X)
+    exact_indices = exact.kneighbors(X_query, return_distance=False)
+    logger.info(
+        "Exact kNN for {} query points is calculated. Time spent = {:.2f}s.".format(
+            queries.size, time.time() - start
+        )
+    )
+
+    results = []
+    for M_value in M:
+        for efC_value in efC:
+            for threads in n_jobs:
+                start = time.time()
+                knn_index = build_hnsw_index(
+                    X,
+                    M=M_value,
+                    efC=efC_value,
+                    random_state=random_state,
+                    n_jobs=threads,
+                    full_speed=threads > 1,
+                )
+                build_time = time.time() - start
+
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    index_file = os.path.join(temp_dir, "index.hnsw")
+                    knn_index.save_index(index_file)
+                    index_size = os.path.getsize(index_file) / 1024.0 ** 2
+
+                other_index = None
+                if check_reproducibility:
+                    other_index = build_hnsw_index(
+                        X,
+                        M=M_value,
+                        efC=efC_value,
+                        random_state=random_state,
+                        n_jobs=threads,
+                        full_speed=threads > 1,
+                    )
+
+                for efS_value in efS:
+                    start = time.time()
+                    indices, _ = query_hnsw_index(
+                        knn_index, X_query, K, efS=efS_value, n_jobs=threads
+                    )
+                    query_time = time.time() - start
+
+                    hits = (
+                        indices[:, :, np.newaxis] == exact_indices[:, np.newaxis, :]
+                    ).any(axis=2)
+                    row = {
+                        "n_cells": nsample,
+                        "n_dims": X.shape[1],
+                        "K": K,
+                        "M": M_value,
+                        "efC": efC_value,
+                        "efS": efS_value,
+                        "n_jobs": threads,
+                        "build_time": build_time,
+                        "query_time": query_time,
+                        "queries_per_sec": queries.size / query_time,
+                        "recall": hits.sum(axis=1).mean() / K,
+                        "index_size_mb": index_size,
+                    }
+                    if other_index is not None:
+                        other_indices, _ = query_hnsw_index(
+                            other_index, X_query, K, efS=efS_value, n_jobs=threads
+                        )
+                        row["reproducibility"] = (
+                            (indices == other_indices).all(axis=1).mean()
+                        )
+                    results.append(row)
+                    logger.info(
+                        "M = {}, efC = {}, efS = {}, n_jobs = {}: recall = {:.4f}, build = {:.2f}s, query = {:.2f}s.".format(
+                            M_value,
+                            efC_value,
+                            efS_value,
+                            threads,
+                            row["recall"],
+                            build_time,
+                            query_time,
+                        )
+                    )
+
+    return pd.DataFrame(results)
+
+
+def run_knn_benchmark(
+    input_file: str,
+    output_file: str,
+    rep: str = "pca",
+    n_cells: int = 100000,
+    n_dims: int = 50,
+    K: int = 100,
+    M: List[int] = [20],
+    efC: List[int] = [200],
+    efS: List[int] = [200],
+    n_jobs: List[int] = [1],
+    n_queries: int = 1000,
+    check_reproducibility: bool = False,
+    random_state: int = 0,
+) -> None:
+    """ For command line only. If input_file is None, benchmark on n_cells synthetic points drawn from a Gaussian mixture in n_dims dimensions.
+    """
+    from sccloud import __version__
+
+    if input_file is not None:
+        from sccloud.io import read_input
+
+        data = read_input(input_file, h5ad_mode="r")
+        X = np.ascontiguousarray(X_from_rep(data, update_rep(rep)), dtype=np.float32)
+        source = input_file
+    else:
+        from sklearn.datasets import make_blobs
+
+        X, _ = make_blobs(
+            n_samples=n_cells,
+            n_features=n_dims,
+            centers=20,
+            random_state=random_state,
+        )
+        X = X.astype(np.float32)
+        source = "synthetic"
+
+    df = benchmark_nearest_neighbors(
+        X,
+        K=K,
+        M=M,
+        efC=efC,
+        efS=efS,
+        n_jobs=n_jobs,
+        n_queries=n_queries,
+        check_reproducibility=check_reproducibility,
+        random_state=random_state,
+    )
+    df.insert(0, "source", source)
+    df.insert(0, "version", __version__)
+    df.to_csv(output_file, index=False)
+    logger.info("kNN benchmark results are written to {}.".format(output_file))
+
+
+@njit
+def calc_kernel_rows(
+    indices: np.array, distances: np.array, sigmas: np.array
+) -> Tuple[np.array, np.array, np.array]:
+    """Compute local-scaled kernel weights and return them as CSR (indptr, indices, data) rows sorted by column. Zero weights are dropped."""
+    nsample, K = indices.shape
+    indptr = np.zeros(nsample + 1, dtype=np.int64)
+    cols = np.empty(nsample * K, dtype=np.int32)
+    weights = np.empty(nsample * K, dtype=np.float32)
+
+    pos = 0
+    for i in range(nsample):
+        for k in np.argsort(indices[i]):
+            j = indices[i, k]
+            denom = sigmas[i] * sigmas[i] + sigmas[j] * sigmas[j]
+            dist = np.float64(distances[i, k])
+            w = np.float32(
+                np.sqrt(2.0 * sigmas[i] * sigmas[j] / denom)
+                * np.exp(-dist * dist / denom)
+            )
+            if w != 0.0:
+                cols[pos] = j
+                weights[pos] = w
+                pos += 1
+        indptr[i + 1] = pos
+
+    return indptr, cols[:pos], weights[:pos]
+
+
+@njit
+def transpose_rows(
+    indptr: np.array, cols: np.array, weights: np.array, nsample: int
+) -> Tuple[np.array, np.array, np.array]:
+    """Counting-sort transpose of a square CSR matrix. Rows of the result come out sorted by column."""
+    t_indptr = np.zeros(nsample + 1, dtype=np.int64)
+    for j in cols:
+        t_indptr[j + 1] += 1
+    for i in range(nsample):
+        t_indptr[i + 1] += t_indptr[i]
+
+    fill = t_indptr[:-1].copy()
+    t_cols = np.empty(cols.size, dtype=np.int32)
+    t_weights = np.empty(cols.size, dtype=np.float32)
+    for i in range(nsample):
+        for pos in range(indptr[i], indptr[i + 1]):
+            j = cols[pos]
+            t_cols[fill[j]] = i
+            t_weights[fill[j]] = weights[pos]
+            fill[j] += 1
+
+    return t_indptr, t_cols, t_weights
+
+
+@njit
+def symmetrize_and_normalize(
+    indptr: np.array,
+    cols: np.array,
+    weights: np.array,
+    t_indptr: np.array,
+    t_cols: np.array,
+    t_weights: np.array,
+    nsample: int,
+) -> Tuple[np.array, np.array, np.array]:
+    """Merge a CSR matrix with its transpose, averaging edges present in both directions, then apply density normalization in place."""
+    # first pass: count merged entries per row
+    W_indptr = np.zeros(nsample + 1, dtype=np.int64)
+    for i in range(nsample):
+        p, p_end = indptr[i], indptr[i + 1]
+        q, q_end = t_indptr[i], t_indptr[i + 1]
+        n = 0
+        while p < p_end and q < q_end:
+            if cols[p] <= t_cols[q]:
+                if cols[p] == t_cols[q]:
+                    q += 1
+                p += 1
+            else:
+                q += 1
+            n += 1
+        W_indptr[i + 1] = W_indptr[i] + n + (p_end - p) + (q_end - q)
+
+    # second pass: merge sorted rows
+    W_indices = np.empty(W_indptr[nsample], dtype=np.int32)
+    W_data = np.empty(W_indptr[nsample], dtype=np.float32)
+    z = np.zeros(nsample, dtype=np.float64)
+    for i in range(nsample):
+        p, p_end = indptr[i], indptr[i + 1]
+        q, q_end = t_indptr[i], t_indptr[i + 1]
+        pos = W_indptr[i]
+        while p < p_end or q < q_end:
+            if q == q_end or (p < p_end and cols[p] < t_cols[q]):
+                W_indices[pos] = cols[p]
+                W_data[pos] = weights[p]
+                p += 1
+            elif p == p_end or t_cols[q] < cols[p]:
+                W_indices[pos] = t_cols[q]
+                W_data[pos] = t_weights[q]
+                q += 1
+            else:
+                W_indices[pos] = cols[p]
+                W_data[pos] = (np.float64(weights[p]) + t_weights[q]) / 2.0
+                p += 1
+                q += 1
+            z[i] += W_data[pos]
+            pos += 1
+
+    # density normalization
+    for i in range(nsample):
+        for pos in range(W_indptr[i], W_indptr[i + 1]):
+            W_data[pos] = W_data[pos] / (z[i] * z[W_indices[pos]])
+
+    return W_indptr, W_indices, W_data
 
 
 # We should not modify distances array!
@@ -159,32 +851,22 @@ def calculate_affinity_matrix(
     start = time.time()
 
     nsample = indices.shape[0]
-    K = indices.shape[1]
     # calculate sigma, important to use median here!
-    sigmas = np.median(distances, axis=1)
-    sigmas_sq = np.square(sigmas)
-
-    # calculate local-scaled kernel
-    normed_dist = np.zeros((nsample, K), dtype=float)
-    for i in range(nsample):
-        numers = 2.0 * sigmas[i] * sigmas[indices[i, :]]
-        denoms = sigmas_sq[i] + sigmas_sq[indices[i, :]]
-        normed_dist[i, :] = np.sqrt(numers / denoms) * np.exp(
-            -np.square(distances[i, :]) / denoms
-        )
+    sigmas = np.median(distances, axis=1).astype(np.float64)
 
-    W = csr_matrix(
-        (normed_dist.ravel(), (np.repeat(range(nsample), K), indices.ravel())),
-        shape=(nsample, nsample),
+    # calculate local-scaled kernel, symmetrize and normalize it without building intermediate sparse matrices
+    indptr, cols, weights = calc_kernel_rows(
+        np.ascontiguousarray(indices, dtype=np.int32), distances, sigmas
     )
-    W = get_symmetric_matrix(W)
+    t_indptr, t_cols, t_weights = transpose_rows(indptr, cols, weights, nsample)
+    W_indptr, W_indices, W_data = symmetrize_and_normalize(
+        indptr, cols, weights, t_indptr, t_cols, t_weights, nsample
+    )
+    del indptr, cols, weights, t_indptr, t_cols, t_weights
 
-    # density normalization
-    z = W.sum(axis=1).A1
-    W = W.tocoo()
-    W.data /= z[W.row]
-    W.data /= z[W.col]
-    W = W.tocsr()
+    if W_indptr[-1] <= np.iinfo(np.int32).max:
+        W_indptr = W_indptr.astype(np.int32)
+    W = csr_matrix((W_data, W_indices, W_indptr), shape=(nsample, nsample))
     W.eliminate_zeros()
 
     end = time.time()
@@ -204,6 +886,8 @@ def neighbors(
     n_jobs: int = -1,
     random_state: int = 0,
     full_speed: bool = False,
+    index_file: str = None,
+    shard_size: int = None,
 ) -> None:
     """Compute k nearest neighbors and affinity matrix, which will be used for diffmap and graph-based community detection algorithms.
 
@@ -231,14 +915,22 @@ def neighbors(
         * If ``True``, use multiple threads in constructing ``hnsw`` index. However, the kNN results are not reproducible. 
         * Otherwise, use only one thread to make sure results are reproducible.
 
+    index_file: ``str``, optional, default: ``None``
+        If not ``None``, save the hnsw index to this file, e.g. next to the output h5ad file. Later calls asking for more neighbors, and ``query_neighbors`` for external points, load and reuse the index instead of rebuilding it.
+
+    shard_size: ``int``, optional, default: ``None``
+        If not ``None`` and there are more cells, split cells into shards of at most ``shard_size`` cells, build one hnsw index per shard in parallel processes and merge the per-shard neighbors of every cell. Use it when a single index over all cells does not fit in memory, or to build a large index in parallel: sharded results do not depend on the number of threads. If ``0``, build a single index. If ``None``, use ``get_reproducible_shard_size``, which shards data sets of 400,000 cells or more, unless ``full_speed``; with ``full_speed``, build a single multi-threaded index.
+
     Returns
     -------
     ``None``
 
     Update ``data.uns``:
-        * ``data.uns[rep + "_knn_indices"]``: kNN index matrix. Row i is the index list of kNN of cell i (excluding itself), sorted from nearest to farthest.
-        * ``data.uns[rep + "_knn_distances"]``: kNN distance matrix. Row i is the distance list of kNN of cell i (excluding itselt), sorted from smallest to largest.
+        * ``data.uns[rep + "_knn_indices"]``: kNN index matrix (``int32``). Row i is the index list of kNN of cell i (excluding itself), sorted from nearest to farthest.
+        * ``data.uns[rep + "_knn_distances"]``: kNN distance matrix (``float32``). Row i is the distance list of kNN of cell i (excluding itselt), sorted from smallest to largest.
+        * ``data.uns[rep + "_knn_params"]``: Fingerprint of the representation and hnsw parameters (``M``, ``efC``, ``efS``, ``random_state``) the kNN results were computed with. Cached results, or their first ``K - 1`` columns for a smaller ``K``, are only reused if the representation and all these parameters still match; otherwise kNN are recomputed and the cache is replaced.
         * ``data.uns["W_" + rep]``: kNN graph of the data in terms of affinity matrix.
+        * ``data.uns[rep + "_knn_index"]``: Only if ``index_file`` is set. The index file and its ``M``, ``efC``, ``efS`` and ``random_state`` parameters.
 
     Examples
     --------
@@ -255,6 +947,8 @@ def neighbors(
         n_jobs=n_jobs,
         random_state=random_state,
         full_speed=full_speed,
+        index_file=index_file,
+        shard_size=shard_size,
     )
     end = time.time()
     logger.info("Nearest neighbor search is finished in {:.2f}s.".format(end - start))
@@ -269,39 +963,196 @@ def neighbors(
     )
 
 
-def calc_kBET_for_one_chunk(knn_indices, attr_values, ideal_dist, K):
-    dof = ideal_dist.size - 1
+@njit
+def calc_edges_to_keep(
+    indptr: np.array,
+    indices: np.array,
+    data: np.array,
+    knn: np.array,
+    method: int,
+    cutoff: float,
+    k: int,
+) -> np.array:
+    """Mark edges of W kept by mutual-kNN (method 0), shared-neighbor Jaccard >= cutoff (method 1) or top k weights per row (method 2). knn holds sorted neighbor lists including each point itself. Every row keeps at least its strongest edge."""
+    nsample, K = knn.shape
+    keep = np.zeros(indices.size, dtype=np.bool_)
+    for i in range(nsample):
+        fr, to = indptr[i], indptr[i + 1]
+        if to == fr:
+            continue
+        if method == 2:
+            for pos in np.argsort(-data[fr:to])[0:k]:
+                keep[fr + pos] = True
+        else:
+            for pos in range(fr, to):
+                j = indices[pos]
+                if method == 0:
+                    p = np.searchsorted(knn[i], j)
+                    q = np.searchsorted(knn[j], i)
+                    keep[pos] = (
+                        p < K and knn[i, p] == j and q < K and knn[j, q] == i
+                    )
+                else:
+                    p = q = n_shared = 0
+                    while p < K and q < K:
+                        if knn[i, p] == knn[j, q]:
+                            n_shared += 1
+                            p += 1
+                            q += 1
+                        elif knn[i, p] < knn[j, q]:
+                            p += 1
+                        else:
+                            q += 1
+                    keep[pos] = n_shared >= cutoff * (2 * K - n_shared)
+        if not keep[fr:to].any():
+            keep[fr + np.argmax(data[fr:to])] = True
+    return keep
+
+
+def prune_graph(
+    data: AnnData,
+    rep: str = "pca",
+    K: int = 100,
+    method: str = "jaccard",
+    jaccard_cutoff: float = 1.0 / 15.0,
+    top_k: int = 15,
+) -> None:
+    """Prune edges of the affinity matrix calculated by ``neighbors`` to speed up clustering, diffusion maps and force-directed layouts.
+
+    Parameters
+    ----------
+
+    data: ``anndata.AnnData``
+        Annotated data matrix with rows for cells and columns for genes.
+
+    rep: ``str``, optional, default: ``"pca"``
+        Embedding representation used by ``neighbors``.
 
-    ns = knn_indices.shape[0]
-    results = np.zeros((ns, 2))
-    for i in range(ns):
-        observed_counts = (
-            pd.Series(attr_values[knn_indices[i, :]]).value_counts(sort=False).values
-        )
-        expected_counts = ideal_dist * K
-        stat = np.sum(
-            np.divide(
-                np.square(np.subtract(observed_counts, expected_counts)),
-                expected_counts,
+    K: ``int``, optional, default: ``100``
+        Number of neighbors, including the data point itself, used by ``neighbors``.
+
+    method: ``str``, optional, default: ``"jaccard"``
+        * ``"mutual"``: Keep an edge only if each cell is among the kNN of the other.
+        * ``"jaccard"``: Keep an edge only if the Jaccard index of the two cells' kNN sets (shared nearest neighbors) is at least ``jaccard_cutoff``.
+        * ``"topk"``: Keep an edge if it is among the ``top_k`` highest weighted edges of either cell.
+
+        Every cell keeps at least its strongest edge and the pruned matrix stays symmetric.
+
+    jaccard_cutoff: ``float``, optional, default: ``1/15``
+        Minimum Jaccard index if ``method`` is ``"jaccard"``.
+
+    top_k: ``int``, optional, default: ``15``
+        Number of edges kept per cell if ``method`` is ``"topk"``.
+
+    Returns
+    -------
+    ``None``
+
+    Update ``data.uns``:
+        * ``data.uns["W_" + rep]``: Pruned affinity matrix.
+
+    Examples
+    --------
+    >>> scc.prune_graph(adata, method = "mutual")
+    """
+    start = time.time()
+
+    rep = update_rep(rep)
+    W = W_from_rep(data, rep)
+    methods = {"mutual": 0, "jaccard": 1, "topk": 2}
+    if method not in methods:
+        raise ValueError(
+            "Unknown pruning method {}! Choose from {}.".format(
+                method, ", ".join(methods)
             )
         )
-        p_value = 1 - chi2.cdf(stat, dof)
-        results[i, 0] = stat
-        results[i, 1] = p_value
+
+    knn = None
+    if method != "topk":
+        indices, distances = knn_cache.lookup(data, rep, K)
+        if indices is None:
+            raise ValueError("Please run neighbors first!")
+        nsample = indices.shape[0]
+        knn = np.sort(
+            np.concatenate(
+                (
+                    np.arange(nsample, dtype=np.int32).reshape(-1, 1),
+                    indices[:, 0 : K - 1].astype(np.int32),
+                ),
+                axis=1,
+            ),
+            axis=1,
+        )
+    else:
+        knn = np.zeros((W.shape[0], 1), dtype=np.int32)
+
+    W.sort_indices()
+    keep = calc_edges_to_keep(
+        W.indptr, W.indices, W.data, knn, methods[method], jaccard_cutoff, top_k
+    )
+    mask = csr_matrix(
+        (keep.astype(np.float32), W.indices, W.indptr), shape=W.shape
+    )
+    mask = mask.maximum(mask.T)  # keep an edge if either of its cells keeps it
+    W_pruned = W.multiply(mask).tocsr()
+    W_pruned.eliminate_zeros()
+
+    data.uns["W_" + rep] = W_pruned
+
+    end = time.time()
+    logger.info(
+        "Graph is pruned by {}: {} of {} edges ({:.2%}) are kept. Time spent = {:.2f}s.".format(
+            method, W_pruned.nnz, W.nnz, W_pruned.nnz / max(W.nnz, 1), end - start
+        )
+    )
+
+
+def calc_kBET_for_all_cells(
+    knn_indices: np.array,
+    attr_codes: np.array,
+    ideal_dist: np.array,
+    Ks: List[int],
+    block_size: int = 100000,
+) -> Dict[int, np.array]:
+    """Return {K: (nsample, 2) array of kBET statistics and p-values}. Neighbor labels are counted for a block of cells at once with an offset bincount, and counts for larger K extend those of smaller K."""
+    nsample = knn_indices.shape[0]
+    nbatch = ideal_dist.size
+    dof = nbatch - 1
+
+    results = {K: np.zeros((nsample, 2)) for K in Ks}
+    for start in range(0, nsample, block_size):
+        end = min(start + block_size, nsample)
+        offsets = np.arange(end - start).reshape(-1, 1) * nbatch
+        counts = np.zeros((end - start) * nbatch, dtype=np.int64)
+        prev_K = 0
+        for K in sorted(Ks):
+            labels = attr_codes[knn_indices[start:end, prev_K:K]] + offsets
+            counts += np.bincount(labels.ravel(), minlength=counts.size)
+            prev_K = K
+
+            expected_counts = ideal_dist * K
+            stats = np.sum(
+                np.square(counts.reshape(-1, nbatch) - expected_counts)
+                / expected_counts,
+                axis=1,
+            )
+            results[K][start:end, 0] = stats
+            results[K][start:end, 1] = chi2.sf(stats, dof)
 
     return results
 
 
 def calc_kBET(
     data: AnnData,
-    attr: str,
+    attr: Union[str, List[str]],
     rep: str = "pca",
-    K: int = 25,
+    K: Union[int, List[int]] = 25,
     alpha: float = 0.05,
     n_jobs: int = -1,
     random_state: int = 0,
     temp_folder: str = None,
-) -> Tuple[float, float, float]:
+    full_speed: bool = False,
+) -> Union[Tuple[float, float, float], pd.DataFrame]:
     """Calculate the kBET metric of the data w.r.t. a specific sample attribute and embedding.
 
     This kBET metric is based on paper "A test metric for assessing single-cell RNA-seq batch correction" [Büttner18]_ in Nature Methods, 2018.
@@ -311,14 +1162,14 @@ def calc_kBET(
     data: ``anndata.AnnData``
         Annotated data matrix with rows for cells and columns for genes.
 
-    attr: ``str``
-        The sample attribute to consider. Must exist in ``data.obs``.
+    attr: ``str`` or ``List[str]``
+        The sample attribute to consider. Must exist in ``data.obs``. If a list, evaluate every attribute in it.
 
     rep: ``str``, optional, default: ``"pca"``
         The embedding representation to be used. The key ``'X_' + rep`` must exist in ``data.obsm``. By default, use PCA coordinates.
 
-    K: ``int``, optional, default: ``25``
-        Number of nearest neighbors, using L2 metric.
+    K: ``int`` or ``List[int]``, optional, default: ``25``
+        Number of nearest neighbors, using L2 metric. If a list, evaluate every K in it from a single kNN search at the largest K.
 
     alpha: ``float``, optional, default: ``0.05``
         Acceptance rate threshold. A cell is accepted if its kBET p-value is greater than or equal to ``alpha``.
@@ -330,7 +1181,10 @@ def calc_kBET(
         Random seed set for reproducing results.
 
     temp_folder: ``str``, optional, default: ``None``
-        Temporary folder for joblib execution.
+        Not used; kept for backward compatibility.
+
+    full_speed: ``bool``, optional, default: ``False``
+        If ``True``, build the hnsw index with multiple threads if the kNN graph has to be calculated; see ``neighbors``.
 
     Returns
     -------
@@ -343,58 +1197,66 @@ def calc_kBET(
     accept_rate: ``float``
         kBET Acceptance rate of the sample.
 
+    If ``attr`` or ``K`` is a list, return instead a ``pandas.DataFrame`` indexed by (attr, K) with columns ``stat_mean``, ``pvalue_mean`` and ``accept_rate``.
+
     Examples
     --------
     >>> scc.calc_kBET(adata, attr = 'Channel')
 
     >>> scc.calc_kBET(adata, attr = 'Channel', rep = 'umap')
-    """
-    assert attr in data.obs
-    if data.obs[attr].dtype.name != "category":
-        data.obs[attr] = pd.Categorical(data.obs[attr])
-
-    from joblib import Parallel, delayed
 
-    ideal_dist = (
-        data.obs[attr].value_counts(normalize=True, sort=False).values
-    )  # ideal no batch effect distribution
+    >>> scc.calc_kBET(adata, attr = ['Channel', 'Donor'], K = [10, 25, 50])
+    """
+    attrs = [attr] if isinstance(attr, str) else list(attr)
+    Ks = [K] if np.isscalar(K) else sorted(set(K))
     nsample = data.shape[0]
-    nbatch = ideal_dist.size
-
-    attr_values = data.obs[attr].values.copy()
-    attr_values.categories = range(nbatch)
+    max_K = Ks[-1]
 
     indices, distances = get_neighbors(
-        data, K=K, rep=rep, n_jobs=n_jobs, random_state=random_state
+        data,
+        K=max_K,
+        rep=rep,
+        n_jobs=n_jobs,
+        random_state=random_state,
+        full_speed=full_speed,
     )
     knn_indices = np.concatenate(
-        (np.arange(nsample).reshape(-1, 1), indices[:, 0 : K - 1]), axis=1
+        (
+            np.arange(nsample, dtype=indices.dtype).reshape(-1, 1),
+            indices[:, 0 : max_K - 1],
+        ),
+        axis=1,
     )  # add query as 1-nn
 
-    # partition into chunks
-    n_jobs = min(effective_n_jobs(n_jobs), nsample)
-    starts = np.zeros(n_jobs + 1, dtype=int)
-    quotient = nsample // n_jobs
-    remainder = nsample % n_jobs
-    for i in range(n_jobs):
-        starts[i + 1] = starts[i] + quotient + (1 if i < remainder else 0)
-
-    kBET_arr = np.concatenate(
-        Parallel(n_jobs=n_jobs, max_nbytes=1e7, temp_folder=temp_folder)(
-            delayed(calc_kBET_for_one_chunk)(
-                knn_indices[starts[i] : starts[i + 1], :], attr_values, ideal_dist, K
-            )
-            for i in range(n_jobs)
-        )
+    index = []
+    results = []
+    for attr_name in attrs:
+        assert attr_name in data.obs
+        if data.obs[attr_name].dtype.name != "category":
+            data.obs[attr_name] = pd.Categorical(data.obs[attr_name])
+
+        ideal_dist = (
+            data.obs[attr_name].value_counts(normalize=True, sort=False).values
+        )  # ideal no batch effect distribution
+        attr_codes = data.obs[attr_name].cat.codes.values
+
+        kBET_arrs = calc_kBET_for_all_cells(knn_indices, attr_codes, ideal_dist, Ks)
+        for K_value in Ks:
+            kBET_arr = kBET_arrs[K_value]
+            res = kBET_arr.mean(axis=0)
+            accept_rate = (kBET_arr[:, 1] >= alpha).sum() / nsample
+            index.append((attr_name, K_value))
+            results.append((res[0], res[1], accept_rate))
+
+    if isinstance(attr, str) and np.isscalar(K):
+        return results[0]
+
+    return pd.DataFrame(
+        results,
+        index=pd.MultiIndex.from_tuples(index, names=["attr", "K"]),
+        columns=["stat_mean", "pvalue_mean", "accept_rate"],
     )
 
-    res = kBET_arr.mean(axis=0)
-    stat_mean = res[0]
-    pvalue_mean = res[1]
-    accept_rate = (kBET_arr[:, 1] >= alpha).sum() / nsample
-
-    return (stat_mean, pvalue_mean, accept_rate)
-
 
 def calc_kSIM(
     data: AnnData,
@@ -404,6 +1266,7 @@ def calc_kSIM(
     min_rate: float = 0.9,
     n_jobs: int = -1,
     random_state: int = 0,
+    full_speed: bool = False,
 ) -> Tuple[float, float]:
     """Calculate the kSIM metric of the data w.r.t. a specific sample attribute and embedding.
 
@@ -432,6 +1295,9 @@ def calc_kSIM(
     random_state: ``int``, optional, default: ``0``
         Random seed set for reproducing results.
 
+    full_speed: ``bool``, optional, default: ``False``
+        If ``True``, build the hnsw index with multiple threads if the kNN graph has to be calculated; see ``neighbors``.
+
     Returns
     -------
     kSIM_mean: ``float``
@@ -450,10 +1316,19 @@ def calc_kSIM(
     nsample = data.shape[0]
 
     indices, distances = get_neighbors(
-        data, K=K, rep=rep, n_jobs=n_jobs, random_state=random_state
+        data,
+        K=K,
+        rep=rep,
+        n_jobs=n_jobs,
+        random_state=random_state,
+        full_speed=full_speed,
     )
     knn_indices = np.concatenate(
-        (np.arange(nsample).reshape(-1, 1), indices[:, 0 : K - 1]), axis=1
+        (
+            np.arange(nsample, dtype=indices.dtype).reshape(-1, 1),
+            indices[:, 0 : K - 1],
+        ),
+        axis=1,
     )  # add query as 1-nn
 
     labels = np.reshape(data.obs[attr].values[knn_indices.ravel()], (-1, K))
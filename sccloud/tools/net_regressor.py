@@ -4,8 +4,11 @@ import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils import check_array
 from sklearn.neural_network import MLPRegressor
+from scipy.sparse import issparse
 import logging
 
+from sccloud.tools import iter_dense_blocks
+
 logger = logging.getLogger("sccloud")
 
 
@@ -39,7 +42,9 @@ def net_train_and_predict(X_train, y_train, X_pred, alpha, random_state, verbose
     start_time = time.time()
 
     scaler_x = MaxStdScaler()
-    X_train = scaler_x.fit_transform(X_train)
+    X_train = scaler_x.fit_transform(
+        X_train.toarray() if issparse(X_train) else X_train
+    )
     scaler_y = MaxStdScaler(factor=15.0)
     y_train = scaler_y.fit_transform(y_train)
 
@@ -54,9 +59,14 @@ def net_train_and_predict(X_train, y_train, X_pred, alpha, random_state, verbose
     regressor.fit(X_train, y_train)
     logger.info(regressor.loss_)
 
-    y_pred = scaler_y.inverse_transform(
-        regressor.predict(scaler_x.transform(X_pred)), copy=False
+    # predict block by block so that a sparse X_pred is never densified as a whole
+    y_pred = np.concatenate(
+        [
+            regressor.predict(scaler_x.transform(X_block))
+            for _, _, X_block in iter_dense_blocks(X_pred)
+        ]
     )
+    y_pred = scaler_y.inverse_transform(y_pred, copy=False)
 
     end_time = time.time()
 
@@ -2,17 +2,54 @@ import time
 import numpy as np
 import pandas as pd
 
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
+from numba import njit
+from joblib import Parallel, delayed, effective_n_jobs
 
 from sklearn.decomposition import PCA
+from sklearn.utils.extmath import svd_flip
 
-from typing import Tuple
+from typing import Tuple, Callable
 from anndata import AnnData
 import logging
 
+from sccloud.tools import iter_dense_blocks
+
 logger = logging.getLogger("sccloud")
 
 
+@njit
+def calc_cell_qc_stats(
+    data: np.array, indices: np.array, indptr: np.array, mito_mask: np.array
+) -> Tuple[np.array, np.array, np.array]:
+    """ Calculate n_genes, n_counts and mito counts for each row of a csr matrix in one pass.
+    """
+    nrows = indptr.size - 1
+    n_genes = np.zeros(nrows, dtype=np.int64)
+    n_counts = np.zeros(nrows, dtype=np.float64)
+    n_mito = np.zeros(nrows, dtype=np.float64)
+    for i in range(nrows):
+        n_genes[i] = indptr[i + 1] - indptr[i]
+        for pos in range(indptr[i], indptr[i + 1]):
+            value = data[pos]
+            n_counts[i] += value
+            if mito_mask[indices[pos]]:
+                n_mito[i] += value
+    return n_genes, n_counts, n_mito
+
+
+@njit
+def count_cells_per_gene(
+    indices: np.array, indptr: np.array, passed: np.array, n_cells: np.array
+) -> None:
+    """ Add to n_cells the number of passed rows in which each gene is stored.
+    """
+    for i in range(indptr.size - 1):
+        if passed[i]:
+            for pos in range(indptr[i], indptr[i + 1]):
+                n_cells[indices[pos]] += 1
+
+
 def qc_metrics(
     data: AnnData,
     mito_prefix: str = "MT-",
@@ -22,6 +59,7 @@ def qc_metrics(
     max_umis: int = 600000,
     percent_mito: float = 10.0,
     percent_cells: float = 0.05,
+    block_size: int = 100000,
 ) -> None:
     """Generate Quality Control (QC) metrics on the dataset.
 
@@ -43,6 +81,8 @@ def qc_metrics(
        Only keep cells with percent mitochondrial genes less than ``percent_mito`` % of total counts.
     percent_cells: ``float``, optional, default: ``0.05``
        Only assign genes to be ``robust`` that are expressed in at least ``percent_cells`` % of cells.
+    block_size: ``int``, optional, default: ``100000``
+       If ``data`` is in backed mode, read ``data.X`` ``block_size`` cells at a time instead of loading the whole matrix.
 
     Returns
     -------
@@ -67,42 +107,48 @@ def qc_metrics(
     >>> scc.qcmetrics(adata)
     """
 
-    data.obs["passed_qc"] = False
-
-    data.obs["n_genes"] = data.X.getnnz(axis=1)
-    data.obs["n_counts"] = data.X.sum(axis=1).A1
-
     mito_prefixes = mito_prefix.split(",")
+    mito_mask = np.zeros(data.shape[1], dtype=np.bool_)
+    for prefix in mito_prefixes:
+        mito_mask |= data.var_names.str.startswith(prefix)
+
+    n_genes = np.zeros(data.shape[0], dtype=np.int64)
+    n_counts = np.zeros(data.shape[0], dtype=np.float64)
+    n_mito = np.zeros(data.shape[0], dtype=np.float64)
+    passed = np.zeros(data.shape[0], dtype=np.bool_)
+    n_cells = np.zeros(data.shape[1], dtype=np.int64)
+
+    # Cell metrics, the QC decision and gene counts over passed cells are computed in a single pass per block of rows
+    step = block_size if data.isbacked else data.shape[0]
+    for start in range(0, data.shape[0], max(step, 1)):
+        end = min(start + step, data.shape[0])
+        X = data.X[start:end] if data.isbacked else data.X
+        if not issparse(X):
+            X = csr_matrix(X)
+        n_genes[start:end], n_counts[start:end], n_mito[start:end] = calc_cell_qc_stats(
+            X.data, X.indices, X.indptr, mito_mask
+        )
+        percent = n_mito[start:end] / np.maximum(n_counts[start:end], 1.0) * 100
+        passed[start:end] = np.logical_and.reduce(
+            [
+                n_genes[start:end] >= min_genes,
+                n_genes[start:end] < max_genes,
+                n_counts[start:end] >= min_umis,
+                n_counts[start:end] < max_umis,
+                percent < percent_mito,
+            ]
+        )
+        count_cells_per_gene(X.indices, X.indptr, passed[start:end], n_cells)
 
-    def startswith(name):
-        for prefix in mito_prefixes:
-            if name.startswith(prefix):
-                return True
-        return False
-
-    mito_genes = data.var_names.map(startswith).values.nonzero()[0]
-    data.obs["percent_mito"] = (data.X[:, mito_genes].sum(axis=1).A1 / np.maximum(
-        data.obs["n_counts"].values, 1.0
-    )) * 100
-
-    # Assign passed_qc
-    filters = [
-        data.obs["n_genes"] >= min_genes,
-        data.obs["n_genes"] < max_genes,
-        data.obs["n_counts"] >= min_umis,
-        data.obs["n_counts"] < max_umis,
-        data.obs["percent_mito"] < percent_mito,
-    ]
-
-    data.obs.loc[np.logical_and.reduce(filters), "passed_qc"] = True
+    dtype = data.X.dtype if data.X.dtype.kind == "f" else np.float64
+    data.obs["n_genes"] = n_genes.astype(np.int32)
+    data.obs["n_counts"] = n_counts.astype(dtype)
+    data.obs["percent_mito"] = (n_mito / np.maximum(n_counts, 1.0) * 100).astype(dtype)
+    data.obs["passed_qc"] = passed
 
     var = data.var
-    data = data[
-        data.obs["passed_qc"]
-    ]  # compute gene stats in space of filtered cells only
-
-    var["n_cells"] = data.X.getnnz(axis=0)
-    var["percent_cells"] = (var["n_cells"] / data.shape[0]) * 100
+    var["n_cells"] = n_cells
+    var["percent_cells"] = (var["n_cells"] / max(passed.sum(), 1)) * 100
     var["robust"] = var["percent_cells"] >= percent_cells
     var["highly_variable_features"] = var[
         "robust"
@@ -327,7 +373,27 @@ def run_filter_data(
     logger.info("filter_data is finished. Time spent = {:.2f}s.".format(end - start))
 
 
-def log_norm(data: AnnData, norm_count: float = 1e5) -> None:
+@njit
+def normalize_rows(
+    data: np.array,
+    indices: np.array,
+    indptr: np.array,
+    robust_mask: np.array,
+    norm_count: float,
+) -> None:
+    """ Scale each row of a csr matrix in place to norm_count total counts over robust genes.
+    """
+    for i in range(indptr.size - 1):
+        total = 0.0
+        for pos in range(indptr[i], indptr[i + 1]):
+            if robust_mask[indices[pos]]:
+                total += data[pos]
+        scale = norm_count / total
+        for pos in range(indptr[i], indptr[i + 1]):
+            data[pos] *= scale
+
+
+def log_norm(data: AnnData, norm_count: float = 1e5, to_float32: bool = False) -> None:
     """Normalization, and then apply natural logarithm to the data.
 
     Parameters
@@ -338,6 +404,9 @@ def log_norm(data: AnnData, norm_count: float = 1e5) -> None:
     norm_count: ``int``, optional, default: ``1e5``.
         Total count of cells after normalization.
 
+    to_float32: ``bool``, optional, default: ``False``.
+        Store the normalized values as float32. If ``False``, floating point matrices keep their dtype and integer matrices become float64.
+
     Returns
     -------
     ``None``
@@ -352,10 +421,20 @@ def log_norm(data: AnnData, norm_count: float = 1e5) -> None:
     start = time.time()
 
     assert issparse(data.X)
-    mat = data.X[:, data.var["robust"].values]
-    scale = norm_count / mat.sum(axis=1).A1
-    data.X.data *= np.repeat(scale, np.diff(data.X.indptr))
-    data.X = data.X.log1p()
+    X = data.X
+    if to_float32:
+        X.data = X.data.astype(np.float32, copy=False)
+    elif X.data.dtype.kind != "f":
+        X.data = X.data.astype(np.float64)
+    normalize_rows(
+        X.data,
+        X.indices,
+        X.indptr,
+        data.var["robust"].values.astype(np.bool_),
+        float(norm_count),
+    )
+    np.log1p(X.data, out=X.data)
+    data.X = X
 
     end = time.time()
     logger.info("Normalization is finished. Time spent = {:.2f}s.".format(end - start))
@@ -402,6 +481,242 @@ def select_features(data: AnnData, features: str = None) -> str:
     return keyword
 
 
+@njit
+def calc_column_stats(
+    data: np.array, indices: np.array, nfeatures: int
+) -> Tuple[np.array, np.array]:
+    """ Calculate sums and sums of squares of each column of a csr matrix.
+    """
+    sums = np.zeros(nfeatures)
+    sqsums = np.zeros(nfeatures)
+    for pos in range(indices.size):
+        value = data[pos]
+        sums[indices[pos]] += value
+        sqsums[indices[pos]] += value * value
+    return sums, sqsums
+
+
+@njit
+def clip_stored_values(
+    data: np.array, indices: np.array, lower: np.array, upper: np.array
+) -> None:
+    """ Clip stored values of a csr matrix in place to [lower, upper] of their columns.
+    """
+    for pos in range(indices.size):
+        j = indices[pos]
+        if data[pos] > upper[j]:
+            data[pos] = upper[j]
+        elif data[pos] < lower[j]:
+            data[pos] = lower[j]
+
+
+@njit(nogil=True)
+def csr_dot_dense(
+    data: np.array,
+    indices: np.array,
+    indptr: np.array,
+    B: np.array,
+    out: np.array,
+    fr: int,
+    to: int,
+) -> None:
+    """ Compute rows [fr, to) of the product of a csr matrix and a dense matrix B into out.
+    """
+    for i in range(fr, to):
+        for pos in range(indptr[i], indptr[i + 1]):
+            value = data[pos]
+            j = indices[pos]
+            for k in range(B.shape[1]):
+                out[i, k] += value * B[j, k]
+
+
+@njit(nogil=True)
+def csr_t_dot_dense(
+    data: np.array,
+    indices: np.array,
+    indptr: np.array,
+    B: np.array,
+    out: np.array,
+    fr: int,
+    to: int,
+) -> None:
+    """ Add the contribution of rows [fr, to) of a csr matrix X to the product X.T @ B (rows of B match rows of X) into out.
+    """
+    for i in range(fr, to):
+        for pos in range(indptr[i], indptr[i + 1]):
+            value = data[pos]
+            j = indices[pos]
+            for k in range(B.shape[1]):
+                out[j, k] += value * B[i, k]
+
+
+def split_rows_by_nnz(X: csr_matrix, n_jobs: int) -> np.array:
+    """ Split rows of a csr matrix into n_jobs chunks of about equal nnz and return the chunk boundaries.
+    """
+    n_jobs = min(effective_n_jobs(n_jobs), max(X.shape[0], 1))
+    bounds = np.searchsorted(X.indptr, np.linspace(0, X.nnz, n_jobs + 1)).clip(0, X.shape[0])
+    bounds[0], bounds[-1] = 0, X.shape[0]
+    return bounds
+
+
+def sparse_dot(X: csr_matrix, B: np.array, n_jobs: int, transpose: bool = False) -> np.array:
+    """ Multiply a csr matrix X (or X.T if transpose) by a dense matrix B, with row chunks of X processed by threads. X.T is never materialized: each chunk accumulates its part of X.T @ B into its own buffer.
+    """
+    B = np.ascontiguousarray(B, dtype=np.float64)
+    bounds = split_rows_by_nnz(X, n_jobs)
+    n_chunks = bounds.size - 1
+    if not transpose:
+        out = np.zeros((X.shape[0], B.shape[1]))
+        Parallel(n_jobs=n_chunks, prefer="threads")(
+            delayed(csr_dot_dense)(X.data, X.indices, X.indptr, B, out, bounds[i], bounds[i + 1])
+            for i in range(n_chunks)
+        )
+        return out
+
+    outs = np.zeros((n_chunks, X.shape[1], B.shape[1]))
+    Parallel(n_jobs=n_chunks, prefer="threads")(
+        delayed(csr_t_dot_dense)(X.data, X.indices, X.indptr, B, outs[i], bounds[i], bounds[i + 1])
+        for i in range(n_chunks)
+    )
+    return outs.sum(axis=0)
+
+
+def randomized_svd(
+    matmat: Callable,
+    rmatmat: Callable,
+    shape: Tuple[int, int],
+    n_components: int,
+    random_state: int,
+    n_oversamples: int = 10,
+    n_iter: int = 7,
+) -> Tuple[np.array, np.array, np.array]:
+    """ Randomized SVD by block power iterations of a matrix A available only through matmat (B -> A @ B) and rmatmat (B -> A.T @ B).
+    Return U, S and Vt of the top n_components singular triplets, with the signs fixed as in scikit-learn's PCA.
+    """
+    k = min(n_components + n_oversamples, min(shape))
+    rng = np.random.RandomState(random_state)
+    Q, _ = np.linalg.qr(matmat(rng.normal(size=(shape[1], k))))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(rmatmat(Q))
+        Q, _ = np.linalg.qr(matmat(Q))
+    U, S, Vt = np.linalg.svd(rmatmat(Q).T, full_matrices=False)
+    U, Vt = svd_flip(Q @ U, Vt, u_based_decision=False)
+    return U[:, :n_components], S[:n_components], Vt[:n_components]
+
+
+def sparse_pca(
+    X: csr_matrix,
+    n_components: int,
+    standardize: bool,
+    max_value: float,
+    random_state: int,
+    n_jobs: int,
+) -> Tuple[np.array, np.array, np.array, np.array]:
+    """ PCA of a csr matrix without densifying it, modifying X.data in place. Centering and scaling are applied implicitly inside the matrix products.
+    Clipping at max_value is exact: stored values are clipped, and if the standardized zero of a column lies outside [-max_value, max_value], the value zeros are clipped to is subtracted from the column's stored values instead. That shifts the column by a constant, which centering removes.
+    Return the projection, the components and the explained variances and their ratios.
+    """
+    nsample, nfeatures = X.shape
+    sums, sqsums = calc_column_stats(X.data, X.indices, nfeatures)
+    if standardize:
+        shift = sums / nsample
+        scale = ((sqsums - nsample * (shift ** 2)) / (nsample - 1.0)) ** 0.5
+        scale[scale == 0] = 1
+    else:
+        shift = np.zeros(nfeatures)
+        scale = np.ones(nfeatures)
+
+    if max_value is not None:
+        lower = shift - max_value * scale
+        upper = shift + max_value * scale
+        clip_stored_values(X.data, X.indices, lower, upper)
+        zero_values = np.clip(0.0, lower, upper)  # what implicit zeros are clipped to
+        if (zero_values != 0.0).any():
+            X.data -= zero_values[X.indices].astype(X.data.dtype)
+        sums, sqsums = calc_column_stats(X.data, X.indices, nfeatures)
+
+    # A = (X - 1 * center') / scale, the centered and scaled matrix PCA decomposes
+    center = sums / nsample
+
+    def matmat(B):
+        return sparse_dot(X, B / scale[:, np.newaxis], n_jobs) - (center / scale) @ B
+
+    def rmatmat(B):
+        return (
+            sparse_dot(X, B, n_jobs, transpose=True) - np.outer(center, B.sum(axis=0))
+        ) / scale[:, np.newaxis]
+
+    U, S, Vt = randomized_svd(matmat, rmatmat, X.shape, n_components, random_state)
+
+    variance = S ** 2 / (nsample - 1.0)
+    total_variance = (
+        (sqsums - nsample * (center ** 2)) / (nsample - 1.0) / (scale ** 2)
+    ).sum()
+    return U * S, Vt, variance, variance / total_variance
+
+
+def streaming_pca(
+    X: "np.array or csr_matrix",
+    columns: np.array,
+    n_components: int,
+    standardize: bool,
+    max_value: float,
+    block_size: int,
+) -> Tuple[np.array, np.array, np.array, np.array]:
+    """ PCA of the selected columns of X (which can be backed) densifying at most block_size rows at a time. The first pass calculates column means and standard deviations, the second accumulates the covariance of the standardized and clipped matrix, and the projection is then calculated block by block.
+    Return the projection, the components and the explained variances and their ratios.
+    """
+    nsample = X.shape[0]
+    nfeatures = int(columns.sum()) if columns is not None else X.shape[1]
+
+    if standardize:
+        sums = np.zeros(nfeatures)
+        sqsums = np.zeros(nfeatures)
+        for start, end, block in iter_dense_blocks(X, block_size, columns):
+            block = block.astype(np.float64)
+            sums += block.sum(axis=0)
+            sqsums += (block * block).sum(axis=0)
+        shift = sums / nsample
+        scale = ((sqsums - nsample * (shift ** 2)) / (nsample - 1.0)) ** 0.5
+        scale[scale == 0] = 1
+    else:
+        shift = np.zeros(nfeatures)
+        scale = np.ones(nfeatures)
+
+    def scale_block(block):
+        Z = (block.astype(np.float64) - shift) / scale
+        if max_value is not None:
+            np.clip(Z, -max_value, max_value, out=Z)
+        return Z
+
+    zsums = np.zeros(nfeatures)
+    cov = np.zeros((nfeatures, nfeatures))
+    for start, end, block in iter_dense_blocks(X, block_size, columns):
+        Z = scale_block(block)
+        zsums += Z.sum(axis=0)
+        cov += Z.T @ Z
+    center = zsums / nsample
+    cov = (cov - nsample * np.outer(center, center)) / (nsample - 1.0)
+
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1][:n_components]
+    variance = eigvals[order]
+    components = eigvecs[:, order].T
+    # fix signs as in scikit-learn's PCA
+    components *= np.sign(
+        components[np.arange(components.shape[0]), np.abs(components).argmax(axis=1)]
+    )[:, np.newaxis]
+
+    X_pca = np.zeros(
+        (nsample, components.shape[0]),
+        dtype=np.float32 if X.dtype == np.float32 else np.float64,
+    )
+    for start, end, block in iter_dense_blocks(X, block_size, columns):
+        X_pca[start:end] = (scale_block(block) - center) @ components.T
+
+    return X_pca, components, variance, variance / np.trace(cov)
+
+
 def pca(
     data: AnnData,
     n_components: int = 50,
@@ -409,10 +724,13 @@ def pca(
     standardize: bool = True,
     max_value: float = 10,
     random_state: int = 0,
+    method: str = "dense",
+    n_jobs: int = 1,
+    block_size: int = 100000,
 ) -> None:
     """Perform Principle Component Analysis (PCA) to the data.
 
-    The calculation uses *scikit-learn* implementation.
+    The calculation uses *scikit-learn* implementation by default.
 
     Parameters
     ----------
@@ -434,6 +752,18 @@ def pca(
     random_state: ``int``, optional, default: ``0``.
         Random seed to be set for reproducing result.
 
+    method: ``str``, optional, default: ``"dense"``.
+        * ``"dense"``: Store the selected features as a dense matrix in ``data.uns["fmat_" + features]``, standardize it in place and run *scikit-learn* PCA.
+        * ``"sparse"``: Run randomized SVD on the sparse feature matrix, applying centering and scaling implicitly inside multithreaded sparse-dense products. The dense matrix is never built. Clipping at ``max_value`` gives the same results as the dense method.
+        * ``"streaming"``: Read ``data.X`` (which can be in backed mode) in blocks of ``block_size`` cells, calculating standardization parameters in a first pass and the covariance of the standardized and clipped features in a second, and project each block in turn. At most ``block_size`` cells are densified at a time; results match the dense method.
+
+        If the dense matrix already exists, e.g. after ``correct_batch``, the dense method is used.
+
+    n_jobs: ``int``, optional, default: ``1``.
+        Number of threads for sparse matrix products if ``method`` is ``"sparse"``. ``-1`` means using all physical CPU cores.
+
+    block_size: ``int``, optional, default: ``100000``.
+        Number of cells densified at a time if ``method`` is ``"streaming"``.
 
     Returns
     -------
@@ -456,36 +786,71 @@ def pca(
     >>> scc.pca(adata)
     """
 
-    keyword = select_features(data, features)
-
-    start = time.time()
-
-    X = data.uns[keyword]
-
-    if standardize:
-        # scaler = StandardScaler(copy=False)
-        # scaler.fit_transform(X)
-        m1 = X.mean(axis=0)
-        psum = np.multiply(X, X).sum(axis=0)
-        std = ((psum - X.shape[0] * (m1 ** 2)) / (X.shape[0] - 1.0)) ** 0.5
-        std[std == 0] = 1
-        X -= m1
-        X /= std
+    if method not in ["dense", "sparse", "streaming"]:
+        raise ValueError("Unknown PCA method {}!".format(method))
 
-    if max_value is not None:
-        X[X > max_value] = max_value
-        X[X < -max_value] = -max_value
-
-    pca = PCA(n_components=n_components, random_state=random_state)
-    X_pca = pca.fit_transform(X)
-
-    data.obsm["X_pca"] = X_pca
-    data.uns[
-        "PCs"
-    ] = pca.components_.T  # cannot be varm because numbers of features are not the same
-    data.uns["pca"] = {}
-    data.uns["pca"]["variance"] = pca.explained_variance_
-    data.uns["pca"]["variance_ratio"] = pca.explained_variance_ratio_
+    if method != "dense" and "fmat_" + str(features) in data.uns:
+        logger.info(
+            "Dense feature matrix fmat_{} exists, use dense PCA.".format(features)
+        )
+        method = "dense"
+
+    if method != "dense":
+        start = time.time()
+
+        if method == "sparse":
+            X = data.X[:, data.var[features].values] if features is not None else data.X
+            X = csr_matrix(X, copy=X is data.X)
+            X_pca, components, variance, variance_ratio = sparse_pca(
+                X, n_components, standardize, max_value, random_state, n_jobs
+            )
+            X_pca = X_pca.astype(X.dtype if X.dtype.kind == "f" else np.float64)
+        else:
+            X_pca, components, variance, variance_ratio = streaming_pca(
+                data.X,
+                data.var[features].values if features is not None else None,
+                n_components,
+                standardize,
+                max_value,
+                block_size,
+            )
+
+        data.obsm["X_pca"] = X_pca
+        data.uns["PCs"] = components.T
+        data.uns["pca"] = {}
+        data.uns["pca"]["variance"] = variance
+        data.uns["pca"]["variance_ratio"] = variance_ratio
+    else:
+        keyword = select_features(data, features)
+
+        start = time.time()
+
+        X = data.uns[keyword]
+
+        if standardize:
+            # scaler = StandardScaler(copy=False)
+            # scaler.fit_transform(X)
+            m1 = X.mean(axis=0)
+            psum = np.multiply(X, X).sum(axis=0)
+            std = ((psum - X.shape[0] * (m1 ** 2)) / (X.shape[0] - 1.0)) ** 0.5
+            std[std == 0] = 1
+            X -= m1
+            X /= std
+
+        if max_value is not None:
+            X[X > max_value] = max_value
+            X[X < -max_value] = -max_value
+
+        pca = PCA(n_components=n_components, random_state=random_state)
+        X_pca = pca.fit_transform(X)
+
+        data.obsm["X_pca"] = X_pca
+        data.uns[
+            "PCs"
+        ] = pca.components_.T  # cannot be varm because numbers of features are not the same
+        data.uns["pca"] = {}
+        data.uns["pca"]["variance"] = pca.explained_variance_
+        data.uns["pca"]["variance_ratio"] = pca.explained_variance_ratio_
 
     end = time.time()
     logger.info("PCA is done. Time spent = {:.2f}s.".format(end - start))
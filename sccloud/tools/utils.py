@@ -1,5 +1,9 @@
+import os
+import threading
 import numpy as np
 from scipy.sparse import issparse
+from numba import njit
+from typing import Tuple, Iterator
 
 
 def update_rep(rep: str) -> str:
@@ -8,10 +12,10 @@ def update_rep(rep: str) -> str:
     return rep if rep is not None else "mat"
 
 
-def X_from_rep(data: "AnnData", rep: str) -> np.array:
+def X_from_rep(data: "AnnData", rep: str, dense: bool = True) -> np.array:
     """
     If rep is not mat, first check if X_rep is in data.obsm. If not, raise an error. 
-    If rep is None, return data.X as a numpy array
+    If rep is None, return data.X as a numpy array, or as it is (possibly sparse) if not dense. Use iter_dense_blocks to densify a sparse data.X block by block.
     """
     if rep != "mat":
         rep_key = "X_" + rep
@@ -19,7 +23,40 @@ def X_from_rep(data: "AnnData", rep: str) -> np.array:
             raise ValueError("Cannot find {0} matrix. Please run {0} first".format(rep))
         return data.obsm[rep_key]
     else:
-        return data.X if not issparse(data.X) else data.X.toarray()
+        return data.X if not dense or not issparse(data.X) else data.X.toarray()
+
+
+def iter_dense_blocks(
+    X: "np.array or csr_matrix", block_size: int = 10000, columns: "np.array" = None
+) -> Iterator[Tuple[int, int, np.array]]:
+    """ Yield (start, end, X[start:end] as a numpy array) for consecutive row blocks of X, so that a sparse X is never densified as a whole. If columns is given, only the selected columns of each block are densified
+    """
+    for start in range(0, X.shape[0], block_size):
+        end = min(start + block_size, X.shape[0])
+        block = X[start:end]
+        if columns is not None:
+            block = block[:, columns]
+        yield start, end, block.toarray() if issparse(block) else np.asarray(block)
+
+
+@njit
+def calc_group_sums(data, indices, indptr, codes, ngroups, nfeatures):
+    """ Scan a CSR matrix once and accumulate per-group feature sums, sums of squares and counts of stored nonzeros, in float64 whatever the dtype of data. Rows with negative codes go to the last group.
+    """
+    sums = np.zeros((ngroups + 1, nfeatures))
+    sum2s = np.zeros((ngroups + 1, nfeatures))
+    nnzs = np.zeros((ngroups + 1, nfeatures), dtype=np.int64)
+
+    for i in range(indptr.size - 1):
+        gid = codes[i] if codes[i] >= 0 else ngroups
+        for j in range(indptr[i], indptr[i + 1]):
+            fid = indices[j]
+            value = np.float64(data[j])
+            sums[gid, fid] += value
+            sum2s[gid, fid] += value * value
+            nnzs[gid, fid] += 1
+
+    return sums, sum2s, nnzs
 
 
 def W_from_rep(data: "AnnData", rep: str) -> "csr_matrix":
@@ -32,12 +69,165 @@ def W_from_rep(data: "AnnData", rep: str) -> "csr_matrix":
     return data.uns[rep_key]
 
 
-def knn_is_cached(
-    data: "AnnData", indices_key: str, distances_key: str, K: int
-) -> bool:
-    return (
-        (indices_key in data.uns)
-        and (distances_key in data.uns)
-        and data.uns[indices_key].shape[0] == data.shape[0]
-        and (K <= data.uns[indices_key].shape[1] + 1)
+def calc_fingerprint(X: "np.array or csr_matrix") -> str:
+    """ Return a cheap fingerprint of X, combining its shape, dtype, column sums and a strided sample of its rows, which changes whenever X is recomputed
+    """
+    import hashlib
+
+    h = hashlib.sha1(str((X.shape, X.dtype.str)).encode())
+    h.update(np.ascontiguousarray(X.sum(axis=0, dtype=np.float64)).tobytes())
+    step = max(X.shape[0] // 1000, 1)
+    sample = X[::step]
+    h.update(
+        np.ascontiguousarray(sample.toarray() if issparse(sample) else sample).tobytes()
     )
+    return h.hexdigest()
+
+
+class KNNCache:
+    """
+    Keep kNN results in data.uns[rep + '_knn_indices'] and data.uns[rep + '_knn_distances'], together with a fingerprint of the representation and the search parameters in data.uns[rep + '_knn_params'].
+    A lookup is served by the first K - 1 columns of the cached results if they were computed on the current representation with the requested search parameters and at least K neighbors (K - 1 excluding the point itself). Results of a representation that has changed are dropped.
+    Results cached before fingerprints were recorded are accepted as is.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def lookup(
+        self, data: "AnnData", rep: str, K: int = None, params: dict = None
+    ) -> Tuple[np.array, np.array]:
+        """ Return the first K - 1 columns (all columns if K is None) of cached (indices, distances), or (None, None) on a miss; if params is not None, the cached results must have been computed with the same search parameters
+        """
+        indices_key = rep + "_knn_indices"
+        distances_key = rep + "_knn_distances"
+        params_key = rep + "_knn_params"
+
+        if (
+            indices_key not in data.uns
+            or distances_key not in data.uns
+            or data.uns[indices_key].shape[0] != data.shape[0]
+        ):
+            self.misses += 1
+            return None, None
+
+        if params_key in data.uns:
+            record = data.uns[params_key]
+            if str(record["fingerprint"]) != calc_fingerprint(
+                X_from_rep(data, rep, dense=False)
+            ):
+                self.invalidate(data, rep)
+                self.misses += 1
+                return None, None
+            if params is not None and any(
+                key not in record or record[key] != value
+                for key, value in params.items()
+            ):
+                self.misses += 1
+                return None, None
+
+        ncols = data.uns[indices_key].shape[1]
+        if K is None:
+            K = ncols + 1
+        if K > ncols + 1:
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        if K < ncols + 1:
+            self.prefix_hits += 1
+        return data.uns[indices_key][:, 0 : K - 1], data.uns[distances_key][:, 0 : K - 1]
+
+    def store(
+        self,
+        data: "AnnData",
+        rep: str,
+        indices: np.array,
+        distances: np.array,
+        params: dict,
+    ) -> None:
+        """ Cache kNN results together with the fingerprint of rep and the search parameters
+        """
+        data.uns[rep + "_knn_indices"] = indices
+        data.uns[rep + "_knn_distances"] = distances
+        record = dict(params)
+        record["fingerprint"] = calc_fingerprint(X_from_rep(data, rep, dense=False))
+        data.uns[rep + "_knn_params"] = record
+
+    def invalidate(self, data: "AnnData", rep: str) -> None:
+        """ Drop cached kNN results of rep
+        """
+        for suffix in ["_knn_indices", "_knn_distances", "_knn_params"]:
+            data.uns.pop(rep + suffix, None)
+        self.invalidations += 1
+
+    def reset_counters(self) -> None:
+        self.hits = self.prefix_hits = self.misses = self.invalidations = 0
+
+
+knn_cache = KNNCache()
+
+
+class SharedArrays:
+    """
+    Publish numpy arrays once into memory-mapped .npy files, so that parallel workers attach to them by file name instead of receiving a copy per task.
+    If temp_folder is None, use /dev/shm when it is writable and has room for nbytes, the total size of the arrays to publish; otherwise use the system temporary folder, as joblib does.
+    """
+
+    def __init__(self, temp_folder: str = None, nbytes: int = 0):
+        import shutil
+        import tempfile
+
+        if (
+            temp_folder is None
+            and os.path.isdir("/dev/shm")
+            and os.access("/dev/shm", os.W_OK)
+            and shutil.disk_usage("/dev/shm").free > nbytes
+        ):
+            temp_folder = "/dev/shm"
+        self.folder = tempfile.mkdtemp(prefix="sccloud_", dir=temp_folder)
+
+    def publish(self, name: str, array: np.array) -> str:
+        """ Write array once and return its handle
+        """
+        handle = os.path.join(self.folder, name + ".npy")
+        np.save(handle, np.ascontiguousarray(array))
+        return handle
+
+    def close(self) -> None:
+        import shutil
+
+        with _attached_lock:
+            for key in [x for x in _attached_arrays if os.path.dirname(x) == self.folder]:
+                del _attached_arrays[key]
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+_attached_arrays = {}
+_attached_lock = threading.Lock()
+
+
+def attach_array(handle: str) -> np.array:
+    """ Attach to an array published by SharedArrays. Mappings are reused by the same worker process until arrays from another SharedArrays are attached or their SharedArrays is closed.
+    Closing clears the mappings of the closing process; worker processes drop mappings of removed folders at their next attach.
+    """
+    folder = os.path.dirname(handle)
+    with _attached_lock:  # workers may be threads sharing this cache
+        for key in [
+            x
+            for x in _attached_arrays
+            if os.path.dirname(x) != folder or not os.path.isdir(os.path.dirname(x))
+        ]:
+            del _attached_arrays[key]
+        if handle not in _attached_arrays:
+            _attached_arrays[handle] = np.load(handle, mmap_mode="r")
+        return _attached_arrays[handle]
@@ -8,6 +8,7 @@ import uuid
 
 from anndata import AnnData
 from joblib import effective_n_jobs
+from typing import Tuple
 try:
     from MulticoreTSNE import MulticoreTSNE as TSNE
 except ImportError:
@@ -17,7 +18,7 @@ from sccloud.tools import (
     update_rep,
     X_from_rep,
     W_from_rep,
-    knn_is_cached,
+    knn_cache,
     neighbors,
     net_train_and_predict,
     calculate_nearest_neighbors,
@@ -102,6 +103,19 @@ def calc_fitsne(
     )
 
 
+def get_umap_knn(
+    indices: np.array, distances: np.array, n_neighbors: int
+) -> Tuple[np.array, np.array]:
+    """Prepend each point as its own nearest neighbor, the layout UMAP expects, keeping the input dtypes."""
+    nsample = indices.shape[0]
+    knn_indices = np.empty((nsample, n_neighbors), dtype=indices.dtype)
+    knn_indices[:, 0] = np.arange(nsample, dtype=indices.dtype)
+    knn_indices[:, 1:] = indices[:, 0 : n_neighbors - 1]
+    knn_dists = np.zeros((nsample, n_neighbors), dtype=distances.dtype)
+    knn_dists[:, 1:] = distances[:, 0 : n_neighbors - 1]
+    return knn_indices, knn_dists
+
+
 # Running umap using our own kNN indices
 def calc_umap(
     X,
@@ -443,19 +457,12 @@ def umap(
     start = time.time()
 
     rep = update_rep(rep)
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
-
-    X = X_from_rep(data, rep)
-    if not knn_is_cached(data, indices_key, distances_key, n_neighbors):
+    X = X_from_rep(data, rep, dense=False)
+    indices, distances = knn_cache.lookup(data, rep, n_neighbors)
+    if indices is None:
         raise ValueError("Please run neighbors first!")
 
-    knn_indices = np.insert(
-        data.uns[indices_key][:, 0 : n_neighbors - 1], 0, range(data.shape[0]), axis=1
-    )
-    knn_dists = np.insert(
-        data.uns[distances_key][:, 0 : n_neighbors - 1], 0, 0.0, axis=1
-    )
+    knn_indices, knn_dists = get_umap_knn(indices, distances, n_neighbors)
     data.obsm["X_" + out_basis] = calc_umap(
         X,
         n_components,
@@ -704,16 +711,14 @@ def net_tsne(
     start = time.time()
 
     rep = update_rep(rep)
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
-
-    if not knn_is_cached(data, indices_key, distances_key, select_K):
+    rep_indices, rep_distances = knn_cache.lookup(data, rep)
+    if rep_indices is None or select_K > rep_indices.shape[1] + 1:
         raise ValueError("Please run neighbors first!")
 
     n_jobs = effective_n_jobs(n_jobs)
 
     selected = select_cells(
-        data.uns[distances_key],
+        rep_distances,
         select_frac,
         K=select_K,
         alpha=select_alpha,
@@ -848,16 +853,14 @@ def net_fitsne(
     start = time.time()
 
     rep = update_rep(rep)
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
-
-    if not knn_is_cached(data, indices_key, distances_key, select_K):
+    rep_indices, rep_distances = knn_cache.lookup(data, rep)
+    if rep_indices is None or select_K > rep_indices.shape[1] + 1:
         raise ValueError("Please run neighbors first!")
 
     n_jobs = effective_n_jobs(n_jobs)
 
     selected = select_cells(
-        data.uns[distances_key],
+        rep_distances,
         select_frac,
         K=select_K,
         alpha=select_alpha,
@@ -994,22 +997,20 @@ def net_umap(
     start = time.time()
 
     rep = update_rep(rep)
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
-
-    if not knn_is_cached(data, indices_key, distances_key, select_K):
+    rep_indices, rep_distances = knn_cache.lookup(data, rep)
+    if rep_indices is None or max(select_K, n_neighbors) > rep_indices.shape[1] + 1:
         raise ValueError("Please run neighbors first!")
 
     n_jobs = effective_n_jobs(n_jobs)
 
     selected = select_cells(
-        data.uns[distances_key],
+        rep_distances,
         select_frac,
         K=select_K,
         alpha=select_alpha,
         random_state=random_state,
     )
-    X_full = X_from_rep(data, rep)
+    X_full = X_from_rep(data, rep, dense=False)
     X = X_full[selected, :]
 
     ds_indices_key = "ds_" + rep + "_knn_indices"  # ds refers to down-sampling
@@ -1024,11 +1025,8 @@ def net_umap(
     data.uns[ds_indices_key] = indices
     data.uns[ds_distances_key] = distances
 
-    knn_indices = np.insert(
-        data.uns[ds_indices_key][:, 0 : n_neighbors - 1], 0, range(X.shape[0]), axis=1
-    )
-    knn_dists = np.insert(
-        data.uns[ds_distances_key][:, 0 : n_neighbors - 1], 0, 0.0, axis=1
+    knn_indices, knn_dists = get_umap_knn(
+        data.uns[ds_indices_key], data.uns[ds_distances_key], n_neighbors
     )
 
     X_umap = calc_umap(
@@ -1053,11 +1051,8 @@ def net_umap(
 
     data.obsm["X_" + out_basis + "_pred"] = Y_init
 
-    knn_indices = np.insert(
-        data.uns[indices_key][:, 0 : n_neighbors - 1], 0, range(data.shape[0]), axis=1
-    )
-    knn_dists = np.insert(
-        data.uns[distances_key][:, 0 : n_neighbors - 1], 0, 0.0, axis=1
+    knn_indices, knn_dists = get_umap_knn(
+        rep_indices, rep_distances, n_neighbors
     )
 
     data.obsm["X_" + out_basis] = calc_umap(
@@ -1192,21 +1187,19 @@ def net_fle(
             full_speed=full_speed,
         )
 
-    indices_key = rep + "_knn_indices"
-    distances_key = rep + "_knn_distances"
-
-    if not knn_is_cached(data, indices_key, distances_key, select_K):
+    rep_indices, rep_distances = knn_cache.lookup(data, rep)
+    if rep_indices is None or select_K > rep_indices.shape[1] + 1:
         raise ValueError("Please run neighbors first!")
 
     selected = select_cells(
-        data.uns[distances_key],
+        rep_distances,
         select_frac,
         K=select_K,
         alpha=select_alpha,
         random_state=random_state,
     )
 
-    X_full = X_from_rep(data, rep)
+    X_full = X_from_rep(data, rep, dense=False)
     X = X_full[selected, :]
 
     ds_indices_key = "ds_" + rep + "_knn_indices"
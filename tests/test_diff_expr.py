@@ -0,0 +1,321 @@
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.stats as ss
+from scipy.sparse import csr_matrix, random as sparse_random
+from sklearn.metrics import roc_auc_score
+
+import sccloud as sc
+
+
+def make_de_data(ncells=600, ngenes=40, seed=0):
+    """ Random log-normalized counts with many ties and zeros, labelled with three clusters and two conditions
+    """
+    rng = np.random.RandomState(seed)
+    X = sparse_random(
+        ncells, ngenes, density=0.4, format="csr", random_state=seed, dtype=np.float32
+    )
+    X.data = np.log1p(np.round(X.data * 5.0)).astype(np.float32)
+    X.eliminate_zeros()
+    obs = pd.DataFrame(
+        {
+            "louvain_labels": pd.Categorical(rng.choice(["1", "2", "3"], ncells)),
+            "condition": pd.Categorical(rng.choice(["a", "b"], ncells)),
+        },
+        index=["cell{}".format(i) for i in range(ncells)],
+    )
+    var = pd.DataFrame(index=["gene{}".format(i) for i in range(ngenes)])
+    return anndata.AnnData(X, obs=obs, var=var)
+
+
+class TestDiffExpr(unittest.TestCase):
+    def setUp(self):
+        self.data = make_de_data()
+        self.X = self.data.X.toarray()
+        self.labels = self.data.obs["louvain_labels"].values
+
+    def run_de(self, data, **kwargs):
+        sc.tools.de_analysis(
+            data, "louvain_labels", n_jobs=1, verbose=False, **kwargs
+        )
+        return sc.tools.get_de_results(data)
+
+    def test_basic_statistics(self):
+        de_res = self.run_de(self.data, auc=False, t=False)
+        for clust_id in self.labels.categories:
+            idx = self.labels == clust_id
+            df = de_res.get_cluster(clust_id, self.data.var_names)
+            np.testing.assert_allclose(
+                df["mean_logExpr"], self.X[idx].mean(axis=0), rtol=1e-5, atol=1e-6
+            )
+            np.testing.assert_allclose(
+                df["mean_logExpr_other"], self.X[~idx].mean(axis=0), rtol=1e-5, atol=1e-6
+            )
+            np.testing.assert_allclose(
+                df["percentage"],
+                (self.X[idx] > 0).mean(axis=0) * 100.0,
+                rtol=1e-5,
+                atol=1e-4,
+            )
+
+    def test_record_array_view(self):
+        de_res = self.run_de(self.data, auc=True, t=True)
+        rec_array = self.data.varm["de_res"]
+        for clust_id in self.labels.categories:
+            df = de_res.get_cluster(clust_id, self.data.var_names)
+            for stat in df.columns:
+                np.testing.assert_array_equal(
+                    np.ravel(rec_array["{0}:{1}".format(stat, clust_id)]), df[stat].values
+                )
+
+        # results written by this version are readable from the varm view alone, as earlier versions stored them
+        temp_dir = tempfile.mkdtemp()
+        try:
+            h5ad_file = os.path.join(temp_dir, "de_varm.h5ad")
+            self.data.write(h5ad_file)
+            data = anndata.read_h5ad(h5ad_file)
+        finally:
+            shutil.rmtree(temp_dir)
+        del data.uns["de_res"]
+        result = sc.tools.get_de_results(data)
+        self.assertEqual(result.stats, de_res.stats)
+        np.testing.assert_array_equal(result.values, de_res.values)
+
+    def test_t_test(self):
+        de_res = self.run_de(self.data, auc=False, t=True)
+        for clust_id in self.labels.categories:
+            idx = self.labels == clust_id
+            expected = ss.ttest_ind(self.X[idx], self.X[~idx], equal_var=False).pvalue
+            np.testing.assert_allclose(
+                de_res.get_cluster(clust_id, self.data.var_names)["t_pval"],
+                expected,
+                rtol=1e-4,
+                atol=1e-10,
+            )
+
+    def test_auroc(self):
+        de_res = self.run_de(self.data, auc=True, t=False)
+        for clust_id in self.labels.categories:
+            idx = self.labels == clust_id
+            expected = [roc_auc_score(idx, self.X[:, j]) for j in range(self.X.shape[1])]
+            np.testing.assert_allclose(
+                de_res.get_cluster(clust_id, self.data.var_names)["auroc"],
+                expected,
+                rtol=1e-5,
+                atol=1e-6,
+            )
+
+    def test_mwu(self):
+        de_res = self.run_de(self.data, auc=False, t=False, mwu=True)
+        for clust_id in self.labels.categories:
+            idx = self.labels == clust_id
+            df = de_res.get_cluster(clust_id, self.data.var_names)
+            for j in range(self.X.shape[1]):
+                U, pval = ss.mannwhitneyu(
+                    self.X[idx, j],
+                    self.X[~idx, j],
+                    use_continuity=True,
+                    alternative="two-sided",
+                    method="asymptotic",
+                )
+                self.assertAlmostEqual(df["mwu_U"].iloc[j], U, delta=1e-6 * U)
+                self.assertAlmostEqual(df["mwu_pval"].iloc[j], pval, delta=1e-4 * pval + 1e-10)
+
+    def test_mwu_with_condition(self):
+        de_res = self.run_de(self.data, condition="condition", auc=False, t=False, mwu=True)
+        cond = self.data.obs["condition"].values
+        for clust_id in self.labels.categories:
+            idx = self.labels == clust_id
+            x1 = self.X[idx & (cond == "a")]
+            x2 = self.X[idx & (cond == "b")]
+            df = de_res.get_cluster(clust_id, self.data.var_names)
+            for j in range(self.X.shape[1]):
+                U, pval = ss.mannwhitneyu(
+                    x1[:, j],
+                    x2[:, j],
+                    use_continuity=True,
+                    alternative="two-sided",
+                    method="asymptotic",
+                )
+                self.assertAlmostEqual(df["mwu_U"].iloc[j], U, delta=1e-6 * U)
+                self.assertAlmostEqual(df["mwu_pval"].iloc[j], pval, delta=1e-4 * pval + 1e-10)
+
+
+class TestPairwiseDiffExpr(unittest.TestCase):
+    def check_pair(self, data, de_res, clust_a, clust_b):
+        """ Compare one comparison with a direct computation on the two clusters
+        """
+        X = data.X.toarray()
+        labels = data.obs["louvain_labels"].values
+        x1 = X[labels == clust_a]
+        x2 = X[labels == clust_b]
+        df = de_res.get_cluster("{0}_vs_{1}".format(clust_a, clust_b), data.var_names)
+        np.testing.assert_allclose(df["mean_logExpr"], x1.mean(axis=0), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(
+            df["mean_logExpr_other"], x2.mean(axis=0), rtol=1e-5, atol=1e-6
+        )
+        np.testing.assert_allclose(
+            df["t_pval"],
+            ss.ttest_ind(x1, x2, equal_var=False).pvalue,
+            rtol=1e-4,
+            atol=1e-10,
+        )
+
+    def test_pairwise(self):
+        data = make_de_data()
+        sc.tools.pairwise_de_analysis(
+            data, "louvain_labels", pairs=[("1", "3"), ("2", "1")], verbose=False
+        )
+        de_res = sc.tools.get_de_results(data, "de_pairwise")
+        self.assertEqual(de_res.clusters, ["1_vs_3", "2_vs_1"])
+        self.check_pair(data, de_res, "1", "3")
+        self.check_pair(data, de_res, "2", "1")
+
+    def test_cached_statistics_are_invalidated_by_relabelling(self):
+        data = make_de_data()
+        sc.tools.de_analysis(data, "louvain_labels", n_jobs=1, verbose=False)
+        self.assertNotIn("de_stats", data.uns)
+        sc.tools.de_analysis(
+            data, "louvain_labels", n_jobs=1, verbose=False, stats_key="de_stats"
+        )
+        self.assertIn("de_stats", data.uns)
+
+        # same categories and cluster sizes, different cells
+        order = np.random.RandomState(1).permutation(data.shape[0])
+        data.obs["louvain_labels"] = data.obs["louvain_labels"].values[order]
+        sc.tools.pairwise_de_analysis(
+            data, "louvain_labels", pairs=[("1", "3")], verbose=False
+        )
+        self.check_pair(data, sc.tools.get_de_results(data, "de_pairwise"), "1", "3")
+
+
+class TestMarkers(unittest.TestCase):
+    def setUp(self):
+        self.data = make_de_data()
+        labels = self.data.obs["louvain_labels"].values
+        X = self.data.X.toarray()
+        X[labels == "1", 0:4] += 1.0  # up in cluster 1
+        X[labels == "1", 4:8] = 0.0  # down in cluster 1
+        self.data.X = csr_matrix(X)
+        sc.tools.de_analysis(self.data, "louvain_labels", n_jobs=1, verbose=False)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_expected_tables(self, head):
+        """ Marker tables from markers(), in file order and rounded to 3 digits except p-values and q-values
+        """
+        marker_dict = sc.tools.markers(self.data, head=head)
+        self.assertGreater(marker_dict["1"]["up"].shape[0], 0)
+        self.assertGreater(marker_dict["1"]["down"].shape[0], 0)
+
+        tables = []
+        for clust_id in ["1", "2", "3"]:
+            for direction in ["up", "down"]:
+                df = marker_dict[clust_id][direction].astype(np.float64)
+                # thresholds: significant by some test, with the right direction
+                self.assertTrue((df[["t_qval"]].values <= 0.05).any(axis=1).all())
+                self.assertTrue(
+                    ((df["log_fold_change"] > 0) == (direction == "up")).all()
+                )
+                if head is not None:
+                    self.assertLessEqual(df.shape[0], head)
+                cols = [
+                    x for x in df.columns if not x.endswith("pval") and not x.endswith("qval")
+                ]
+                df[cols] = df[cols].round(3)
+                tables.append((clust_id, direction, df))
+        return tables
+
+    def get_expected_frame(self, head):
+        frames = []
+        for clust_id, direction, df in self.get_expected_tables(head):
+            df = df.reset_index()
+            df.insert(0, "direction", direction)
+            df.insert(0, "cluster", clust_id)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    def test_write_markers_to_csv(self):
+        output_file = os.path.join(self.temp_dir, "markers.csv")
+        for head in [None, 2]:
+            sc.tools.write_markers(self.data, output_file, head=head)
+            pd.testing.assert_frame_equal(
+                pd.read_csv(output_file, dtype={"cluster": str}),
+                self.get_expected_frame(head),
+                check_dtype=False,
+            )
+
+    def test_write_markers_to_parquet(self):
+        output_file = os.path.join(self.temp_dir, "markers.parquet")
+        sc.tools.write_markers(self.data, output_file)
+        pd.testing.assert_frame_equal(
+            pd.read_parquet(output_file), self.get_expected_frame(None), check_dtype=False
+        )
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("openpyxl") is not None, "openpyxl is not installed"
+    )
+    def test_write_markers_to_excel(self):
+        output_file = os.path.join(self.temp_dir, "markers.xlsx")
+        sc.tools.write_markers(self.data, output_file)
+        sheets = pd.read_excel(output_file, sheet_name=None, index_col=0)
+        expected = self.get_expected_tables(None)
+        self.assertEqual(
+            list(sheets.keys()),
+            ["{0} {1}".format(direction, clust_id) for clust_id, direction, _ in expected],
+        )
+        for clust_id, direction, df in expected:
+            pd.testing.assert_frame_equal(
+                sheets["{0} {1}".format(direction, clust_id)],
+                df,
+                check_dtype=False,
+                check_index_type=False,
+            )
+
+
+class TestDiffExprBacked(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = make_de_data()
+        self.h5ad_file = os.path.join(self.temp_dir, "de_backed.h5ad")
+        self.data.write(self.h5ad_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_backed(self, **kwargs):
+        kwargs.update(auc=True, t=True, mwu=True, n_jobs=1, verbose=False)
+        data = self.data.copy()
+        sc.tools.de_analysis(data, "louvain_labels", **kwargs)
+        expected = sc.tools.get_de_results(data)
+
+        backed = anndata.read_h5ad(self.h5ad_file, backed="r")
+        sc.tools.de_analysis(
+            backed, "louvain_labels", block_size=70, stats_key=None, **kwargs
+        )
+        result = sc.tools.get_de_results(backed)
+        backed.file.close()
+
+        self.assertEqual(result.stats, expected.stats)
+        self.assertEqual(result.clusters, expected.clusters)
+        np.testing.assert_allclose(
+            result.values, expected.values, rtol=1e-5, atol=1e-6, equal_nan=True
+        )
+
+    def test_backed(self):
+        self.check_backed()
+
+    def test_backed_with_condition_and_subset(self):
+        self.check_backed(condition="condition", subset="1,3")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+import anndata
+import numpy as np
+import pandas as pd
+from scipy.sparse import random as sparse_random
+
+import sccloud as sc
+
+
+class TestHvfSelection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        X = sparse_random(
+            900, 120, density=0.3, format="csr", random_state=0, dtype=np.float32
+        )
+        X.data = np.log1p(np.round(X.data * 20.0)).astype(np.float32)
+        X.eliminate_zeros()
+        obs = pd.DataFrame(
+            {"Channel": rng.choice(["c1", "c2", "c3", "c4"], 900)},
+            index=["cell{}".format(i) for i in range(900)],
+        )
+        obs["Group"] = np.where(obs["Channel"].isin(["c1", "c2"]), "g1", "g2")
+        self.data = anndata.AnnData(X, obs=obs)
+        self.X = X.toarray().astype(np.float64)
+
+    def test_feature_statistics(self):
+        sc.tools.estimate_feature_statistics(self.data, False)
+        np.testing.assert_allclose(self.data.var["mean"], self.X.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(
+            self.data.var["var"], self.X.var(axis=0, ddof=1), rtol=1e-5
+        )
+
+    def test_feature_statistics_by_channel(self):
+        sc.tools.estimate_feature_statistics(self.data, True)
+
+        channels = self.data.uns["Channels"]
+        groups = self.data.uns["Groups"]
+        channel_labels = self.data.obs["Channel"].values
+        group_labels = self.data.obs["Group"].values
+        means = np.stack(
+            [self.X[channel_labels == channel].mean(axis=0) for channel in channels],
+            axis=1,
+        )
+        partial_sum = np.stack(
+            [
+                np.square(self.X[channel_labels == channel] - means[:, i]).sum(axis=0)
+                for i, channel in enumerate(channels)
+            ],
+            axis=1,
+        )
+        np.testing.assert_allclose(self.data.varm["means"], means, rtol=1e-6)
+        np.testing.assert_allclose(
+            self.data.varm["partial_sum"], partial_sum, rtol=1e-5, atol=1e-6
+        )
+        np.testing.assert_allclose(
+            self.data.varm["gmeans"],
+            np.stack(
+                [self.X[group_labels == group].mean(axis=0) for group in groups], axis=1
+            ),
+            rtol=1e-6,
+        )
+
+        # within-channel variance plus the variance between group means
+        overall_mean = self.X.mean(axis=0)
+        between = sum(
+            (group_labels == group).sum()
+            * np.square(self.X[group_labels == group].mean(axis=0) - overall_mean)
+            for group in groups
+        )
+        np.testing.assert_allclose(self.data.var["mean"], overall_mean, rtol=1e-6)
+        np.testing.assert_allclose(
+            self.data.var["var"],
+            (between + partial_sum.sum(axis=1)) / (self.X.shape[0] - 1.0),
+            rtol=1e-5,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,262 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import anndata
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.stats import chi2
+from sklearn.neighbors import NearestNeighbors
+
+import sccloud as sc
+
+
+def make_knn_data(nsample=3000, ndim=10, seed=0):
+    """ Gaussian blobs embedded as X_pca, with a random batch attribute
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(scale=5.0, size=(5, ndim))
+    X = (centers[rng.randint(5, size=nsample)] + rng.normal(size=(nsample, ndim))).astype(
+        np.float32
+    )
+    data = anndata.AnnData(csr_matrix((nsample, 3), dtype=np.float32))
+    data.obsm["X_pca"] = X
+    data.obs["Channel"] = pd.Categorical(rng.choice(["a", "b", "c"], nsample))
+    return data
+
+
+def brute_force_neighbors(X, K):
+    return NearestNeighbors(n_neighbors=K - 1, algorithm="brute").fit(X).kneighbors()
+
+
+def affinity_matrix_reference(indices, distances):
+    """ Affinity matrix built with scipy sparse operations, as calculate_affinity_matrix did before the numba kernels
+    """
+    nsample, K = indices.shape
+    sigmas = np.median(distances, axis=1).astype(np.float64)
+    numers = 2.0 * sigmas.reshape(-1, 1) * sigmas[indices]
+    denoms = np.square(sigmas).reshape(-1, 1) + np.square(sigmas[indices])
+    weights = np.sqrt(numers / denoms) * np.exp(-np.square(distances) / denoms)
+    W = csr_matrix(
+        (weights.ravel(), (np.repeat(range(nsample), K), indices.ravel())),
+        shape=(nsample, nsample),
+    )
+    W_t = W.T.tocsr()
+    both = (W != 0).multiply(W_t != 0)
+    W = (W + W_t - W.multiply(both) / 2.0 - W_t.multiply(both) / 2.0).tocsr()
+    z = W.sum(axis=1).A1
+    W = W.tocoo()
+    W.data /= z[W.row] * z[W.col]
+    return W.tocsr()
+
+
+class TestNearestNeighbors(unittest.TestCase):
+    def setUp(self):
+        self.data = make_knn_data()
+        self.X = self.data.obsm["X_pca"]
+
+    def test_sharded_neighbors(self):
+        K = 15
+        indices, distances = sc.tools.calculate_nearest_neighbors(
+            self.X, K=K, n_jobs=1, shard_size=1000
+        )
+        bf_distances, bf_indices = brute_force_neighbors(self.X, K)
+        self.assertEqual(indices.shape, (self.X.shape[0], K - 1))
+        recall = np.mean(
+            [np.intersect1d(x, y).size for x, y in zip(indices, bf_indices)]
+        ) / (K - 1)
+        self.assertGreater(recall, 0.99)
+        np.testing.assert_allclose(distances, bf_distances, rtol=1e-3, atol=1e-3)
+
+    def test_sparse_neighbors(self):
+        K = 15
+        X = csr_matrix(np.where(self.X > 2.0, self.X, 0.0).astype(np.float64))
+        self.assertLess(X.nnz, 0.5 * X.shape[0] * X.shape[1])
+        indices, distances = sc.tools.get_neighbors(
+            anndata.AnnData(X), K=K, rep=None, n_jobs=1
+        )
+        self.assertEqual(indices.dtype, np.int32)
+        self.assertEqual(distances.dtype, np.float32)
+        self.assertEqual(indices.shape, (X.shape[0], K - 1))
+
+        bf_distances, bf_indices = brute_force_neighbors(X.toarray(), K)
+        recall = np.mean(
+            [np.intersect1d(x, y).size for x, y in zip(indices, bf_indices)]
+        ) / (K - 1)
+        self.assertGreater(recall, 0.99)
+        np.testing.assert_allclose(distances, bf_distances, rtol=1e-4, atol=1e-4)
+
+    def test_reproducible_shards(self):
+        from sccloud.tools.nearest_neighbors import (
+            calculate_nearest_neighbors_by_shards,
+            get_reproducible_shard_size,
+        )
+
+        shard_size = get_reproducible_shard_size(self.X.shape[0], min_shard_size=500)
+        self.assertEqual(shard_size, 1500)
+        sharded = sc.tools.calculate_nearest_neighbors(
+            self.X, K=15, n_jobs=1, shard_size=shard_size
+        )
+
+        # by default, graphs are sharded reproducibly and do not depend on the number of threads
+        with mock.patch(
+            "sccloud.tools.nearest_neighbors.get_reproducible_shard_size",
+            side_effect=lambda nsample: get_reproducible_shard_size(
+                nsample, min_shard_size=500
+            ),
+        ), mock.patch(
+            "sccloud.tools.nearest_neighbors.calculate_nearest_neighbors_by_shards",
+            wraps=calculate_nearest_neighbors_by_shards,
+        ) as by_shards:
+            for n_jobs in [1, 2]:
+                data = make_knn_data()
+                sc.tools.neighbors(data, K=15, n_jobs=n_jobs)
+                np.testing.assert_array_equal(data.uns["pca_knn_indices"], sharded[0])
+                np.testing.assert_array_equal(data.uns["pca_knn_distances"], sharded[1])
+                if n_jobs == 1:
+                    W = data.uns["W_pca"]
+                else:
+                    self.assertEqual(abs(data.uns["W_pca"] - W).max(), 0.0)
+        self.assertEqual(by_shards.call_count, 2)
+
+    def test_affinity_matrix(self):
+        bf_distances, bf_indices = brute_force_neighbors(self.X[0:1000], 15)
+        W = sc.tools.calculate_affinity_matrix(
+            bf_indices.astype(np.int32), bf_distances.astype(np.float32)
+        )
+        W_ref = affinity_matrix_reference(bf_indices, bf_distances)
+        self.assertEqual(abs(W - W.T).max(), 0.0)
+        self.assertEqual(W.nnz, W_ref.nnz)
+        self.assertLess(abs(W - W_ref).max(), 1e-5 * W_ref.max())
+
+    def test_kBET(self):
+        K = 25
+        stat_mean, pvalue_mean, accept_rate = sc.tools.calc_kBET(
+            self.data, "Channel", K=K, n_jobs=1
+        )
+
+        # per-cell chi-square test over the kNN (including the cell itself), as computed before vectorization
+        nsample = self.data.shape[0]
+        knn = np.concatenate(
+            (
+                np.arange(nsample).reshape(-1, 1),
+                self.data.uns["pca_knn_indices"][:, 0 : K - 1],
+            ),
+            axis=1,
+        )
+        codes = self.data.obs["Channel"].cat.codes.values
+        expected_counts = np.bincount(codes) / nsample * K
+        stats = np.array(
+            [
+                np.sum(
+                    np.square(np.bincount(codes[row], minlength=3) - expected_counts)
+                    / expected_counts
+                )
+                for row in knn
+            ]
+        )
+        pvals = 1.0 - chi2.cdf(stats, 2)
+
+        self.assertAlmostEqual(stat_mean, stats.mean())
+        self.assertAlmostEqual(pvalue_mean, pvals.mean())
+        self.assertAlmostEqual(accept_rate, (pvals >= 0.05).mean())
+
+    def test_kBET_multiple_attributes_and_Ks(self):
+        rng = np.random.RandomState(1)
+        self.data.obs["Donor"] = pd.Categorical(rng.choice(["x", "y"], self.data.shape[0]))
+        df = sc.tools.calc_kBET(self.data, ["Channel", "Donor"], K=[10, 25], n_jobs=1)
+        self.assertEqual(df.shape, (4, 3))
+        for (attr, K), row in df.iterrows():
+            np.testing.assert_allclose(
+                row.values, sc.tools.calc_kBET(self.data, attr, K=K, n_jobs=1)
+            )
+
+    def test_prune_graph(self):
+        K = 15
+        sc.tools.neighbors(self.data, K=K, n_jobs=1)
+        W = self.data.uns["W_pca"]
+        for method in ["mutual", "jaccard", "topk"]:
+            self.data.uns["W_pca"] = W
+            sc.tools.prune_graph(self.data, K=K, method=method, top_k=5)
+            W_pruned = self.data.uns["W_pca"]
+            self.assertEqual(abs(W_pruned - W_pruned.T).max(), 0.0, method)
+            self.assertLess(W_pruned.nnz, W.nnz, method)
+            # kept edges keep their weights, and every cell keeps at least one edge
+            self.assertEqual((W_pruned - W.multiply(W_pruned != 0)).nnz, 0, method)
+            self.assertTrue((W_pruned.getnnz(axis=1) > 0).all(), method)
+
+    def test_knn_cache(self):
+        indices, distances = sc.tools.get_neighbors(self.data, K=30, n_jobs=1)
+
+        # narrower requests with the same search parameters are served from the cached results
+        narrow_indices, narrow_distances = sc.tools.get_neighbors(self.data, K=10, n_jobs=1)
+        np.testing.assert_array_equal(narrow_indices, indices[:, 0:9])
+        np.testing.assert_array_equal(narrow_distances, distances[:, 0:9])
+        self.assertEqual(self.data.uns["pca_knn_indices"].shape[1], 29)
+
+        # other search parameters are recomputed and replace the cached results
+        for params in [{"random_state": 5}, {"random_state": 5, "efS": 50}]:
+            fresh_indices, fresh_distances = sc.tools.calculate_nearest_neighbors(
+                self.X, K=10, n_jobs=1, **params
+            )
+            new_indices, new_distances = sc.tools.get_neighbors(
+                self.data, K=10, n_jobs=1, **params
+            )
+            np.testing.assert_array_equal(new_indices, fresh_indices)
+            np.testing.assert_array_equal(new_distances, fresh_distances)
+            self.assertEqual(self.data.uns["pca_knn_indices"].shape[1], 9)
+            for key, value in params.items():
+                self.assertEqual(self.data.uns["pca_knn_params"][key], value)
+
+        # a changed representation invalidates the cached results
+        self.data.obsm["X_pca"] = self.X * 2.0
+        indices, distances = sc.tools.get_neighbors(
+            self.data, K=10, n_jobs=1, random_state=5, efS=50
+        )
+        self.assertEqual(self.data.uns["pca_knn_indices"].shape[1], 9)
+        np.testing.assert_allclose(distances, fresh_distances * 2.0, rtol=1e-5)
+
+    def test_saved_index(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            index_file = os.path.join(temp_dir, "pca.hnsw")
+            sc.tools.neighbors(self.data, K=15, n_jobs=1, index_file=index_file)
+            self.assertTrue(os.path.isfile(index_file))
+
+            fresh = make_knn_data()
+            fresh_indices, fresh_distances, fresh_index = sc.tools.calculate_nearest_neighbors(
+                fresh.obsm["X_pca"], K=30, n_jobs=1, return_index=True
+            )
+
+            # a larger K is answered by the saved index, without building a new one
+            with mock.patch(
+                "sccloud.tools.nearest_neighbors.build_hnsw_index",
+                side_effect=AssertionError("index is rebuilt"),
+            ):
+                indices, distances = sc.tools.get_neighbors(self.data, K=30, n_jobs=1)
+            np.testing.assert_array_equal(indices, fresh_indices)
+            np.testing.assert_allclose(distances, fresh_distances, rtol=1e-6)
+
+            # external points are queried against the saved index
+            queries = self.X[0:200] + np.random.RandomState(1).normal(
+                scale=0.1, size=(200, self.X.shape[1])
+            ).astype(np.float32)
+            q_indices, q_distances = sc.tools.query_neighbors(
+                self.data, queries, K=10, n_jobs=1
+            )
+            self.assertEqual(q_indices.dtype, np.int32)
+            fresh_index.set_ef(200)
+            expected_indices, expected_distances = fresh_index.knn_query(queries, k=10)
+            np.testing.assert_array_equal(q_indices, expected_indices)
+            np.testing.assert_allclose(
+                q_distances, np.sqrt(expected_distances), rtol=1e-6
+            )
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
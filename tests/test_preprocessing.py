@@ -1,9 +1,52 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import sccloud as sc
 import anndata
 import numpy as np
-from scipy.sparse import csr_matrix
+import pandas as pd
+from scipy.sparse import csr_matrix, random as sparse_random
+
+
+def make_count_data(ncells=500, ngenes=200, seed=0):
+    """ Random UMI counts with mitochondrial genes under two prefixes
+    """
+    X = sparse_random(
+        ncells, ngenes, density=0.2, format="csr", random_state=seed, dtype=np.float32
+    )
+    X.data = np.ceil(X.data * 10.0)
+    var = pd.DataFrame(
+        index=[
+            "MT-{}".format(i) if i < 5 else ("mt-{}".format(i) if i < 8 else "G{}".format(i))
+            for i in range(ngenes)
+        ]
+    )
+    obs = pd.DataFrame(index=["cell{}".format(i) for i in range(ncells)])
+    return anndata.AnnData(X, obs=obs, var=var)
+
+
+def make_pca_data(ncells=2000, ngenes=300, seed=0):
+    """ Log-transformed counts of six cell types, whose five leading principal components are well separated, plus a few highly expressed genes with rare zeros that exercise clipping
+    """
+    rng = np.random.RandomState(seed)
+    profiles = rng.gamma(0.3, 2.0, (6, ngenes))
+    X = np.log1p(rng.poisson(profiles[rng.randint(6, size=ncells)]))
+    X[:, 0:3] = np.where(rng.rand(ncells, 3) < 0.995, 5.0 + 0.01 * rng.rand(ncells, 3), 0.0)
+    var = pd.DataFrame(
+        {"highly_variable_features": np.arange(ngenes) < 200},
+        index=["G{}".format(i) for i in range(ngenes)],
+    )
+    return anndata.AnnData(csr_matrix(X.astype(np.float32)), var=var)
+
+
+def assert_equal_up_to_sign(test_case, X, Y, atol):
+    """ Compare two projections column by column, allowing each principal component to be flipped
+    """
+    signs = np.sign((X * Y).sum(axis=0))
+    test_case.assertTrue((signs != 0).all())
+    np.testing.assert_allclose(X * signs, Y, rtol=0, atol=atol)
 
 
 class TestPreprocessing(unittest.TestCase):
@@ -16,6 +59,140 @@ class TestPreprocessing(unittest.TestCase):
             np.expm1(adata.X.toarray()).sum(axis=1), 10, rtol=1e-6, atol=0
         )
 
+    def test_qc_metrics(self):
+        data = make_count_data()
+        kwargs = dict(
+            mito_prefix="MT-,mt-",
+            min_genes=35,
+            max_genes=45,
+            min_umis=100,
+            percent_mito=5.0,
+            percent_cells=15.0,
+        )
+        sc.tools.qc_metrics(data, **kwargs)
+
+        X = data.X.toarray()
+        n_genes = (X > 0).sum(axis=1)
+        n_counts = X.sum(axis=1)
+        percent_mito = X[:, 0:8].sum(axis=1) / n_counts * 100.0
+        passed = (
+            (n_genes >= 35)
+            & (n_genes < 45)
+            & (n_counts >= 100)
+            & (n_counts < 600000)
+            & (percent_mito < 5.0)
+        )
+        self.assertTrue(0 < passed.sum() < data.shape[0])
+        np.testing.assert_array_equal(data.obs["n_genes"], n_genes)
+        np.testing.assert_allclose(data.obs["n_counts"], n_counts, rtol=1e-6)
+        np.testing.assert_allclose(data.obs["percent_mito"], percent_mito, rtol=1e-5)
+        np.testing.assert_array_equal(data.obs["passed_qc"], passed)
+
+        n_cells = (X[passed] > 0).sum(axis=0)
+        np.testing.assert_array_equal(data.var["n_cells"], n_cells)
+        np.testing.assert_array_equal(
+            data.var["robust"], n_cells / passed.sum() * 100.0 >= 15.0
+        )
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            h5ad_file = os.path.join(temp_dir, "qc_backed.h5ad")
+            make_count_data().write(h5ad_file)
+            backed = anndata.read_h5ad(h5ad_file, backed="r")
+            sc.tools.qc_metrics(backed, block_size=77, **kwargs)
+            backed.file.close()
+        finally:
+            shutil.rmtree(temp_dir)
+        pd.testing.assert_frame_equal(backed.obs, data.obs)
+        pd.testing.assert_frame_equal(backed.var, data.var)
+
+    def test_log_norm_robust_genes(self):
+        data = make_count_data()
+        robust = np.arange(data.shape[1]) >= 8
+        data.var["robust"] = robust
+        X = data.X.toarray().astype(np.float64)
+        sc.tools.log_norm(data, 1e4)
+        self.assertEqual(data.X.dtype, np.float32)
+        np.testing.assert_allclose(
+            data.X.toarray(),
+            np.log1p(X / X[:, robust].sum(axis=1, keepdims=True) * 1e4),
+            rtol=1e-5,
+            atol=1e-6,
+        )
+
+    def test_log_norm_dtype(self):
+        X = csr_matrix([[1, 11], [2, 20], [5, 6]])
+        for dtype, to_float32, expected in [
+            (np.int64, False, np.float64),
+            (np.float64, False, np.float64),
+            (np.float64, True, np.float32),
+        ]:
+            adata = anndata.AnnData(X.astype(dtype))
+            adata.var["robust"] = True
+            sc.tools.log_norm(adata, 10, to_float32=to_float32)
+            self.assertEqual(adata.X.dtype, expected)
+            np.testing.assert_allclose(
+                adata.X.toarray(),
+                np.log1p(X.toarray() / X.toarray().sum(axis=1, keepdims=True) * 10),
+                rtol=1e-6,
+            )
+
+    def test_sparse_pca(self):
+        for standardize, max_value in [(True, 10), (True, 1.5), (False, None)]:
+            dense = make_pca_data()
+            sc.tools.pca(dense, n_components=5, standardize=standardize, max_value=max_value)
+            sparse = make_pca_data()
+            sc.tools.pca(
+                sparse,
+                n_components=5,
+                standardize=standardize,
+                max_value=max_value,
+                method="sparse",
+                n_jobs=2,
+            )
+            self.assertFalse(any(key.startswith("fmat_") for key in sparse.uns))
+            assert_equal_up_to_sign(
+                self,
+                sparse.obsm["X_pca"],
+                dense.obsm["X_pca"],
+                1e-3 * np.abs(dense.obsm["X_pca"]).max(),
+            )
+            for key in ["variance", "variance_ratio"]:
+                np.testing.assert_allclose(
+                    sparse.uns["pca"][key], dense.uns["pca"][key], rtol=1e-4
+                )
+
+    def test_streaming_pca(self):
+        temp_dir = tempfile.mkdtemp()
+        h5ad_file = os.path.join(temp_dir, "pca_backed.h5ad")
+        make_pca_data().write(h5ad_file)
+        try:
+            for standardize, max_value in [(True, 10), (True, 1.5), (False, None)]:
+                dense = make_pca_data()
+                sc.tools.pca(dense, n_components=5, standardize=standardize, max_value=max_value)
+                backed = anndata.read_h5ad(h5ad_file, backed="r")
+                sc.tools.pca(
+                    backed,
+                    n_components=5,
+                    standardize=standardize,
+                    max_value=max_value,
+                    method="streaming",
+                    block_size=300,
+                )
+                backed.file.close()
+                assert_equal_up_to_sign(
+                    self,
+                    backed.obsm["X_pca"],
+                    dense.obsm["X_pca"],
+                    1e-4 * np.abs(dense.obsm["X_pca"]).max(),
+                )
+                for key in ["variance", "variance_ratio"]:
+                    np.testing.assert_allclose(
+                        backed.uns["pca"][key], dense.uns["pca"][key], rtol=1e-4
+                    )
+        finally:
+            shutil.rmtree(temp_dir)
+
 
 if __name__ == "__main__":
     unittest.main()